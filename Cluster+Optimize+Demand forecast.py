@@ -16,7 +16,7 @@ from datetime import datetime
 from IPython.display import display # Để hiển thị DataFrame đẹp hơn
 
 # Thư viện Preprocessing
-from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder
+from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder, FunctionTransformer
 from sklearn.impute import SimpleImputer
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
@@ -29,6 +29,17 @@ from sklearn.mixture import GaussianMixture
 # Thư viện Đánh giá
 from sklearn.metrics import silhouette_score, davies_bouldin_score
 
+# Lớp truy cập dữ liệu (cache Parquet) - file data_access.py cùng thư mục
+from data_access import load_table
+from model_registry import load_segmentation_model, save_segmentation_model, update_segmentation_scores
+from segmentation import (
+    build_rfm, cast_features, fit_minibatch_kmeans, assign_clusters, save_centroids, CENTROIDS_FILE,
+    k_selection_table, cluster_scores
+)
+from ped_engine import estimate_ped
+# Tổng hợp khi đọc transaction_data.csv theo chunk (AGGREGATE_SOURCE = 'stream')
+from streaming_aggregates import stream_aggregates
+
 # Thư viện Hồi quy
 import statsmodels.api as sm
 import warnings
@@ -45,14 +56,13 @@ print("-- [BƯỚC 0] Tất cả thư viện đã được nhập thành công.
 print("\n-- [BƯỚC 1] Đang tải dữ liệu và xây dựng đặc trưng... --")
 try:
     # Tải TẤT CẢ 4 tệp cần thiết ngay từ đầu
-    df_trans = pd.read_csv('transaction_data.csv')
-    df_cust = pd.read_csv('customer_profile.csv')
-    df_prod = pd.read_csv('product_master.csv')
-    df_macro = pd.read_csv('macro_context.csv')
-
-    # Chuyển đổi kiểu dữ liệu ngày tháng
-    df_trans['Date_Time'] = pd.to_datetime(df_trans['Date_Time'])
-    df_macro['Date'] = pd.to_datetime(df_macro['Date']).dt.date.astype(str)
+    df_trans = load_table('transaction_data')
+    df_cust = load_table('customer_profile')
+    df_prod = load_table('product_master')
+    df_macro = load_table('macro_context')
+
+    # Date_Time / Date đã được parse sẵn trong cache -> chỉ chuẩn hóa Date của macro về string
+    df_macro['Date'] = df_macro['Date'].dt.strftime('%Y-%m-%d')
     print("Tải 4 tệp dữ liệu thành công.")
 except FileNotFoundError:
     print("LỖI: Không tìm thấy 1 trong 4 tệp CSV. Vui lòng đảm bảo 4 tệp (trans, cust, prod, macro) nằm trong cùng thư mục.")
@@ -62,11 +72,15 @@ except FileNotFoundError:
 print("Đang xây dựng đặc trưng RFM...")
 snapshot_date = df_trans['Date_Time'].max() + pd.Timedelta(days=1)
 
-rfm_df = df_trans.groupby('Customer_ID').agg(
-    Recency=('Date_Time', lambda x: (snapshot_date - x.max()).days),
-    Frequency=('Transaction_ID', 'nunique'),
-    Monetary=('Total_Paid', 'sum')
-).reset_index()
+# Nguồn bảng tổng hợp (RFM ở 1.1, Date x Cluster x Category ở 7.2):
+# 'memory': tính trên df_trans đã tải (mặc định) | 'stream': đọc transaction_data.csv theo chunk
+# (streaming_aggregates.py), bộ nhớ chỉ phụ thuộc kích thước chunk và số khóa tổng hợp
+AGGREGATE_SOURCE = 'memory'
+if AGGREGATE_SOURCE == 'stream':
+    rfm_df = stream_aggregates('transaction_data.csv')['rfm_df']
+else:
+    # RFM vector hóa (segmentation.py) - thay cho lambda tính Recency theo từng khách hàng
+    rfm_df = build_rfm(df_trans, snapshot_date)
 
 # 1.2. Kết hợp và Xây dựng đặc trưng Hồ sơ (Profile)
 print("Đang kết hợp dữ liệu và tạo đặc trưng 'Age'...")
@@ -96,6 +110,28 @@ df_model_input = df_analysis[features_to_cluster].copy()
 print(f"Hoàn tất BƯỚC 1. Dữ liệu đầu vào có {df_model_input.shape[0]} khách hàng và {df_model_input.shape[1]} đặc trưng.")
 
 
+# --- BƯỚC 2-4: REGISTRY MÔ HÌNH PHÂN KHÚC ---
+# Chọn K=3 dựa trên biểu đồ (BƯỚC 3)
+N_CLUSTERS = 3
+# 'full' = KMeans(n_init=10) trên toàn bộ X_scaled
+# 'minibatch' = MiniBatchKMeans + partial_fit theo chunk (tập khách hàng rất lớn), lưu tâm cụm ra CENTROIDS_FILE
+SEGMENTATION_MODE = 'full'
+# Kiểu số của ma trận đặc trưng (X_scaled luôn ở dạng thưa CSR).
+# np.float32 giảm 1/2 bộ nhớ nhưng nhãn cụm có thể bị hoán vị so với float64.
+FEATURE_DTYPE = np.float64
+model_name = "K-Means"
+
+# Registry mô hình (model_registry.py): dữ liệu khách hàng/giao dịch và tham số không đổi
+# -> bỏ qua BƯỚC 2-4 (fit preprocessor, chọn K, K-Means, Silhouette), nạp preprocessor,
+#    tâm cụm, tên cụm, nhãn và các chỉ số đã lưu
+seg_params = {
+    'n_clusters': N_CLUSTERS, 'mode': SEGMENTATION_MODE, 'random_state': 42,
+    'features': features_to_cluster, 'feature_dtype': np.dtype(FEATURE_DTYPE).name
+}
+seg_model = load_segmentation_model(seg_params, verbose=True)
+X_scaled = None
+
+
 # --- BƯỚC 2: TIỀN XỬ LÝ (PREPROCESSING PIPELINE) ---
 
 print("\n-- [BƯỚC 2] Xây dựng Pipeline Mã hóa & Chuẩn hóa... --")
@@ -107,48 +143,64 @@ membership_tiers = ['Standard', 'Silver', 'Gold', 'Diamond']
 ordinal_features = ['Income level', 'Membership_Tier']
 nominal_features = ['Occupation', 'Gender']
 
-# 2.2. Xây dựng các đường ống (pipeline) con
-numeric_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='median')),
-    ('scaler', StandardScaler())
-])
-ordinal_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='most_frequent')),
-    ('encoder', OrdinalEncoder(categories=[income_levels, membership_tiers], handle_unknown='use_encoded_value', unknown_value=-1))
-])
-nominal_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='most_frequent')),
-    ('encoder', OneHotEncoder(handle_unknown='ignore', sparse_output=False))
-])
-
-# 2.3. Kết hợp các pipeline con bằng ColumnTransformer
-preprocessor = ColumnTransformer(
-    transformers=[
-        ('num', numeric_transformer, numerical_features),
-        ('ord', ordinal_transformer, ordinal_features),
-        ('nom', nominal_transformer, nominal_features)
-    ],
-    remainder='passthrough'
-)
+if seg_model is not None:
+    preprocessor = seg_model['preprocessor']
+    print(f"Dùng preprocessor đã fit của mô hình v{seg_model['version']:04d}.")
+else:
+    # 2.2. Xây dựng các đường ống (pipeline) con
+    numeric_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='median')),
+        ('scaler', StandardScaler())
+    ])
+    ordinal_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='most_frequent')),
+        ('encoder', OrdinalEncoder(categories=[income_levels, membership_tiers], handle_unknown='use_encoded_value', unknown_value=-1, dtype=FEATURE_DTYPE))
+    ])
+    nominal_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='most_frequent')),
+        ('encoder', OneHotEncoder(handle_unknown='ignore', sparse_output=True, dtype=FEATURE_DTYPE))
+    ])
+
+    # 2.3. Kết hợp các pipeline con bằng ColumnTransformer
+    # sparse_threshold=1.0: giữ khối one-hot ở dạng thưa -> bộ nhớ tỉ lệ với số phần tử khác 0
+    column_transformer = ColumnTransformer(
+        transformers=[
+            ('num', numeric_transformer, numerical_features),
+            ('ord', ordinal_transformer, ordinal_features),
+            ('nom', nominal_transformer, nominal_features)
+        ],
+        remainder='passthrough',
+        sparse_threshold=1.0
+    )
+    preprocessor = Pipeline(steps=[
+        ('columns', column_transformer),
+        ('dtype', FunctionTransformer(cast_features, kw_args={'dtype': FEATURE_DTYPE}))
+    ])
+
+    # 2.4. Áp dụng preprocessor
+    X_scaled = preprocessor.fit_transform(df_model_input)
+    print("Pipeline tiền xử lý hoàn tất.")
 
-# 2.4. Áp dụng preprocessor
-X_scaled = preprocessor.fit_transform(df_model_input)
-print("Pipeline tiền xử lý hoàn tất.")
 
 # --- BƯỚC 3: XÁC ĐỊNH SỐ CỤM TỐI ƯU (K) ---
 
 print("\n-- [BƯỚC 3] Đang xác định K tối ưu (Elbow & Silhouette)... --")
-inertia_values = []
-silhouette_scores = []
 K_range = range(2, 9) # Kiểm tra từ 2 đến 8 cụm
 
-print("Đang chạy K-Means với các K khác nhau...")
-for k in K_range:
-    kmeans_test = KMeans(n_clusters=k, init='k-means++', random_state=42, n_init=10)
-    kmeans_test.fit(X_scaled)
-    inertia_values.append(kmeans_test.inertia_)
-    score = silhouette_score(X_scaled, kmeans_test.labels_)
-    silhouette_scores.append(score)
+seg_scores = seg_model['scores'] if seg_model is not None else None
+if seg_scores is not None:
+    df_k_scores = seg_scores['k_scores']
+else:
+    if X_scaled is None:
+        # Mô hình được lưu từ phần Optimize (chưa có chỉ số) -> chỉ transform, tính chỉ số 1 lần
+        X_scaled = preprocessor.transform(df_model_input)
+    # Mỗi K chạy song song; Silhouette tính trên mẫu (có khoảng tin cậy 95%),
+    # kèm Silhouette rút gọn (theo tâm cụm), Davies-Bouldin, Calinski-Harabasz
+    print("Đang chạy K-Means với các K khác nhau...")
+    df_k_scores = k_selection_table(X_scaled, K_range, random_state=42)
+inertia_values = df_k_scores['Inertia'].tolist()
+silhouette_scores = df_k_scores['Silhouette'].tolist()
+display(df_k_scores)
 
 print("Hoàn tất tính toán WCSS (Inertia) và Silhouette.")
 
@@ -159,23 +211,52 @@ plt.plot(K_range, inertia_values, 'bo-'); plt.xlabel('Số cụm (K)'); plt.ylab
 # 3.2. Vẽ biểu đồ Silhouette
 plt.subplot(1, 2, 2)
 plt.plot(K_range, silhouette_scores, 'rs-'); plt.xlabel('Số cụm (K)'); plt.ylabel('Silhouette Score'); plt.title('Chỉ số Silhouette'); plt.grid(True)
+plt.fill_between(K_range, df_k_scores['Silhouette_CI_Low'], df_k_scores['Silhouette_CI_High'], color='r', alpha=0.2)
 plt.tight_layout()
 plt.show()
 
 # --- BƯỚC 4: HUẤN LUYỆN VÀ ĐÁNH GIÁ MÔ HÌNH K-MEANS ---
 
 print("\n-- [BƯỚC 4] Huấn luyện & Đánh giá mô hình K-Means Clustering... --")
-# Chọn K=3 dựa trên biểu đồ
-N_CLUSTERS = 3
-
-model_name = "K-Means"
-model = KMeans(n_clusters=N_CLUSTERS, init='k-means++', random_state=42, n_init=10)
-print(f"\nĐang huấn luyện mô hình {model_name}...")
-labels = model.fit_predict(X_scaled)
+if seg_model is not None:
+    centroids = seg_model['centroids']
+    cluster_name_map = seg_model['cluster_name_map']
+    labels = (
+        seg_model['customer_clusters'].set_index('Customer_ID')['Cluster']
+        .reindex(df_analysis['Customer_ID']).to_numpy()
+    )
+else:
+    print(f"\nĐang huấn luyện mô hình {model_name} (chế độ {SEGMENTATION_MODE})...")
+    if SEGMENTATION_MODE == 'minibatch':
+        model = fit_minibatch_kmeans(X_scaled, N_CLUSTERS, random_state=42)
+        labels = assign_clusters(X_scaled, model.cluster_centers_)
+        save_centroids(model.cluster_centers_, CENTROIDS_FILE)
+    else:
+        model = KMeans(n_clusters=N_CLUSTERS, init='k-means++', random_state=42, n_init=10)
+        labels = model.fit_predict(X_scaled)
+    centroids = model.cluster_centers_
+    cluster_name_map = {i: f'Cụm {i}' for i in range(N_CLUSTERS)}
 labels_dict = {model_name: labels} # Lưu nhãn
 
-silhouette = silhouette_score(X_scaled, labels)
-davies_bouldin = davies_bouldin_score(X_scaled, labels)
+if seg_scores is None:
+    # Silhouette là O(n^2): với chế độ minibatch chỉ tính trên mẫu ngẫu nhiên
+    silhouette_sample = min(X_scaled.shape[0], 20000) if SEGMENTATION_MODE == 'minibatch' else None
+    seg_scores = {
+        'k_scores': df_k_scores,
+        'silhouette': silhouette_score(X_scaled, labels, sample_size=silhouette_sample, random_state=42),
+        'davies_bouldin': cluster_scores(X_scaled, labels)['Davies_Bouldin'], # X_scaled thưa: tính theo tâm cụm
+    }
+    if seg_model is not None:
+        update_segmentation_scores(seg_model['version'], seg_scores)
+    else:
+        seg_version = save_segmentation_model(
+            preprocessor, centroids, cluster_name_map,
+            pd.DataFrame({'Customer_ID': df_analysis['Customer_ID'], 'Cluster': labels}),
+            seg_params, scores=seg_scores
+        )
+        print(f"Đã lưu mô hình phân khúc vào registry (v{seg_version:04d}).")
+silhouette = seg_scores['silhouette']
+davies_bouldin = seg_scores['davies_bouldin']
 print(f" - {model_name}: Silhouette Score = {silhouette:.4f}, Davies-Bouldin Index = {davies_bouldin:.4f}")
 print("Hoàn tất BƯỚC 4.")
 
@@ -183,6 +264,8 @@ print("Hoàn tất BƯỚC 4.")
 # --- BƯỚC 5: GIẢM CHIỀU DỮ LIỆU BẰNG PCA & TRỰC QUAN HÓA CỤM K-MEANS ---
 
 print("\n-- [BƯỚC 5] Đang giảm chiều dữ liệu bằng PCA và Trực quan hóa K-Means... --")
+if X_scaled is None:
+    X_scaled = preprocessor.transform(df_model_input) # Mô hình nạp từ registry: chỉ transform, không fit
 pca = PCA(n_components=2, random_state=42)
 X_pca = pca.fit_transform(X_scaled)
 df_pca = pd.DataFrame(data=X_pca, columns=['PC1', 'PC2'])
@@ -253,13 +336,21 @@ df_full_segmented['Date'] = pd.to_datetime(df_full_segmented['Date_Time']).dt.da
 # [LOGIC MỚI] Tạo cột Total_List_Price (Tổng giá niêm yết)
 df_full_segmented['Total_List_Price'] = df_full_segmented['Quantity'] * df_full_segmented['Unit_Price_Listed']
 
-# 7.2. Tổng hợp theo Date, Cluster, VÀ CATEGORY
-print("Đang tổng hợp dữ liệu (Lấy TỔNG Q, TỔNG Paid, TỔNG List) theo Category...")
-df_agg_cat = df_full_segmented.groupby(['Date', 'Cluster', 'Category']).agg(
-    Total_Quantity=('Quantity', 'sum'),
-    Total_Paid_Agg=('Total_Paid', 'sum'),
-    Total_List_Price_Agg=('Total_List_Price', 'sum') # [LOGIC MỚI]
-).reset_index()
+# 7.2. Tổng hợp theo Date, Cluster, VÀ CATEGORY (nguồn theo AGGREGATE_SOURCE ở BƯỚC 1)
+if AGGREGATE_SOURCE == 'stream':
+    print("Đang tổng hợp theo Category khi đọc transaction_data.csv theo chunk...")
+    df_agg_cat = stream_aggregates(
+        'transaction_data.csv', df_product=df_prod,
+        customer_cluster=df_analysis.set_index('Customer_ID')['Cluster']
+    )['df_agg_cat']
+    df_agg_cat['Cluster'] = df_agg_cat['Cluster'].astype(df_analysis['Cluster'].dtype)
+else:
+    print("Đang tổng hợp dữ liệu (Lấy TỔNG Q, TỔNG Paid, TỔNG List) theo Category...")
+    df_agg_cat = df_full_segmented.groupby(['Date', 'Cluster', 'Category']).agg(
+        Total_Quantity=('Quantity', 'sum'),
+        Total_Paid_Agg=('Total_Paid', 'sum'),
+        Total_List_Price_Agg=('Total_List_Price', 'sum') # [LOGIC MỚI]
+    ).reset_index()
 
 # 7.3. [LOGIC MỚI] Tạo biến "Price_Index" (cho từng Category)
 df_agg_cat = df_agg_cat[df_agg_cat['Total_List_Price_Agg'] > 0]
@@ -284,58 +375,21 @@ except Exception as e:
     print(f"LỖI NGHIÊM TRỌNG KHI MERGE: {e}")
     # exit()
 
-# 7.5. Phân tích lặp qua từng Cluster VÀ Category
+# 7.5. Danh sách Cluster VÀ Category cần phân tích
 cluster_labels = sorted(df_analysis['Cluster'].unique())
 categories_to_analyze = df_agg_cat_macro['Category'].unique()
-ped_results_list_cat = []
-
 print(f"Bắt đầu chạy hồi quy (Mô hình 5) cho 3 Cụm x {len(categories_to_analyze)} Categories...")
 
-for cluster in cluster_labels:
-    for category in categories_to_analyze:
-
-        df_cat_segment = df_agg_cat_macro[
-            (df_agg_cat_macro['Cluster'] == cluster) &
-            (df_agg_cat_macro['Category'] == category)
-        ].copy()
-
-        # 7.6. Xây dựng mô hình Log-Log Đa biến
-        if df_cat_segment.shape[0] > 10: # Cần đủ dữ liệu
-
-            Y = np.log(df_cat_segment['Total_Quantity'])
-
-            X = pd.DataFrame({
-                'log_Price_Index': np.log(df_cat_segment['Price_Index']),
-                'Promotion': df_cat_segment['Promotion_Campaign'],
-                'Weekend': df_cat_segment['Is_Weekend'],
-                'Holiday': df_cat_segment['Is_Holiday'],
-                'Monthly_Index': df_cat_segment['Monthly_Index']
-            })
-            X = sm.add_constant(X)
-
-            model_ols = sm.OLS(Y, X).fit()
-
-            ped_value = model_ols.params['log_Price_Index']
-            p_value = model_ols.pvalues['log_Price_Index'] # Giữ lại P-Value để lọc
-
-            ped_results_list_cat.append({
-                'Category': category,
-                'Phân khúc (Cluster)': cluster,
-                'PED (β1)': ped_value,
-                'P_Value': p_value
-            })
-
-        else:
-            ped_results_list_cat.append({
-                'Category': category,
-                'Phân khúc (Cluster)': cluster,
-                'PED (β1)': np.nan,
-                'P_Value': np.nan
-            })
+# 7.6. Mô hình Log-Log đa biến cho từng (Cluster, Category) - ped_engine.py:
+# chia dữ liệu 1 lần bằng groupby, hồi quy song song khi có nhiều phân khúc
+df_ped_summary_category = estimate_ped(
+    df_agg_cat_macro,
+    segment_cols=['Cluster', 'Category'],
+    levels={'Cluster': cluster_labels, 'Category': categories_to_analyze}
+)
 
 # 7.7. Hiển thị Bảng kết quả tổng hợp
 print("\n--- [BƯỚC 7 - Mô hình 5] Hoàn tất tính toán PED. ---")
-df_ped_summary_category = pd.DataFrame(ped_results_list_cat) # Lưu kết quả
 
 # Hiển thị bảng lọc |PED| > 1 (Theo yêu cầu cuối cùng của bạn)
 print("\n--- Bảng tóm tắt (Pivot) CHỈ DÀNH CHO KẾT QUẢ CO GIÃN (Elastic) ---")
@@ -344,8 +398,7 @@ df_ped_elastic = df_ped_summary_category[
     (df_ped_summary_category['PED (β1)'].abs() > 1)
 ]
 
-# Đổi tên cụm
-cluster_name_map = { 0: 'Cụm 0', 1: 'Cụm 1', 2: 'Cụm 2' }
+# Đổi tên cụm (cluster_name_map từ BƯỚC 4 / registry mô hình)
 df_ped_elastic['Phân khúc'] = df_ped_elastic['Phân khúc (Cluster)'].map(cluster_name_map)
 
 if df_ped_elastic.empty:
@@ -371,7 +424,7 @@ from datetime import datetime
 from IPython.display import display # Để hiển thị DataFrame đẹp hơn
 
 # Thư viện Preprocessing
-from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder
+from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder, FunctionTransformer
 from sklearn.impute import SimpleImputer
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
@@ -384,6 +437,14 @@ from sklearn.mixture import GaussianMixture
 # Thư viện Đánh giá
 from sklearn.metrics import silhouette_score, davies_bouldin_score
 
+# Lớp truy cập dữ liệu (cache Parquet) - file data_access.py cùng thư mục
+from data_access import load_table
+from model_registry import load_segmentation_model, save_segmentation_model
+from segmentation import (
+    build_rfm, cast_features, fit_minibatch_kmeans, assign_clusters, save_centroids, CENTROIDS_FILE
+)
+from ped_engine import estimate_ped
+
 # Thư viện Hồi quy
 import statsmodels.api as sm
 import warnings
@@ -392,6 +453,18 @@ import warnings
 # import scipy.optimize as opt
 # from scipy.optimize import minimize, NonlinearConstraint
 
+# Engine tối ưu hóa vector hóa (file optimization_engine.py cùng thư mục)
+from optimization_engine import (
+    optimize_prices_vectorized, optimize_prices_analytic, optimize_prices_oracle,
+    optimize_prices_joint, cross_elasticity_matrix, ORACLE_MULTIINDEX_ERROR
+)
+# Hàm cầu từ mô hình dự báo cho method='oracle' (file demand_oracle.py cùng thư mục)
+from demand_oracle import fit_demand_oracle, oracle_demand_fn
+from series_store import load_series_store
+# Bảng tổng hợp đọc theo chunk / kho trạng thái nối thêm hằng đêm (AGGREGATE_SOURCE = 'stream' / 'state')
+from streaming_aggregates import stream_aggregates
+from incremental_store import load_state, state_tables
+
 # Cài đặt hiển thị
 pd.set_option('display.max_columns', None)
 pd.set_option('display.float_format', '{:.2f}'.format)
@@ -404,14 +477,13 @@ print("-- [BƯỚC 0] Tất cả thư viện đã được nhập thành công.
 print("\n-- [BƯỚC 1] Đang tải dữ liệu và xây dựng đặc trưng... --")
 try:
     # [SỬA LỖI] Tải TẤT CẢ 4 tệp cần thiết ngay từ đầu
-    df_trans = pd.read_csv('transaction_data.csv')
-    df_cust = pd.read_csv('customer_profile.csv')
-    df_prod = pd.read_csv('product_master.csv')
-    df_macro = pd.read_csv('macro_context.csv')
-
-    # Chuyển đổi kiểu dữ liệu ngày tháng
-    df_trans['Date_Time'] = pd.to_datetime(df_trans['Date_Time'])
-    df_macro['Date'] = pd.to_datetime(df_macro['Date']).dt.date.astype(str)
+    df_trans = load_table('transaction_data')
+    df_cust = load_table('customer_profile')
+    df_prod = load_table('product_master')
+    df_macro = load_table('macro_context')
+
+    # Date_Time / Date đã được parse sẵn trong cache -> chỉ chuẩn hóa Date của macro về string
+    df_macro['Date'] = df_macro['Date'].dt.strftime('%Y-%m-%d')
     print("Tải 4 tệp dữ liệu thành công.")
 except FileNotFoundError:
     print("LỖI: Không tìm thấy 1 trong 4 tệp CSV. Vui lòng đảm bảo 4 tệp (trans, cust, prod, macro) nằm trong cùng thư mục.")
@@ -421,11 +493,19 @@ except FileNotFoundError:
 print("Đang xây dựng đặc trưng RFM...")
 snapshot_date = df_trans['Date_Time'].max() + pd.Timedelta(days=1)
 
-rfm_df = df_trans.groupby('Customer_ID').agg(
-    Recency=('Date_Time', lambda x: (snapshot_date - x.max()).days),
-    Frequency=('Transaction_ID', 'nunique'),
-    Monetary=('Total_Paid', 'sum')
-).reset_index()
+# Nguồn bảng tổng hợp (RFM ở 1.1, Date x Cluster x Category ở 7.2):
+# 'memory': tính trên df_trans đã tải (mặc định)
+# 'stream': đọc transaction_data.csv theo chunk (streaming_aggregates.py)
+# 'state' : kho trạng thái nối thêm hằng đêm (`python incremental_store.py init` 1 lần,
+#           `... append <csv ngày mới>` mỗi đêm), snapshot = ngày cuối đã nạp + 1
+AGGREGATE_SOURCE = 'memory'
+if AGGREGATE_SOURCE == 'stream':
+    rfm_df = stream_aggregates('transaction_data.csv')['rfm_df']
+elif AGGREGATE_SOURCE == 'state':
+    rfm_df = state_tables(load_state())['rfm_df']
+else:
+    # RFM vector hóa (segmentation.py) - thay cho lambda tính Recency theo từng khách hàng
+    rfm_df = build_rfm(df_trans, snapshot_date)
 
 # 1.2. Kết hợp và Xây dựng đặc trưng Hồ sơ (Profile)
 print("Đang kết hợp dữ liệu và tạo đặc trưng 'Age'...")
@@ -455,6 +535,24 @@ df_model_input = df_analysis[features_to_cluster].copy()
 print(f"Hoàn tất BƯỚC 1. Dữ liệu đầu vào có {df_model_input.shape[0]} khách hàng và {df_model_input.shape[1]} đặc trưng.")
 
 
+# --- BƯỚC 2-4: REGISTRY MÔ HÌNH PHÂN KHÚC ---
+N_CLUSTERS = 3
+# 'full' = KMeans(n_init=10); 'minibatch' = MiniBatchKMeans + partial_fit theo chunk, lưu tâm cụm ra CENTROIDS_FILE
+SEGMENTATION_MODE = 'full'
+# Kiểu số của ma trận đặc trưng (X_scaled luôn ở dạng thưa CSR).
+# np.float32 giảm 1/2 bộ nhớ nhưng nhãn cụm có thể bị hoán vị so với float64.
+FEATURE_DTYPE = np.float64
+model_name = "K-Means"
+
+# Registry mô hình (model_registry.py): dữ liệu khách hàng/giao dịch và tham số không đổi
+# -> bỏ qua BƯỚC 2-4 (fit preprocessor, K-Means), nạp preprocessor, tâm cụm, tên cụm và nhãn đã lưu
+seg_params = {
+    'n_clusters': N_CLUSTERS, 'mode': SEGMENTATION_MODE, 'random_state': 42,
+    'features': features_to_cluster, 'feature_dtype': np.dtype(FEATURE_DTYPE).name
+}
+seg_model = load_segmentation_model(seg_params, verbose=True)
+
+
 # --- BƯỚC 2: TIỀN XỬ LÝ (PREPROCESSING PIPELINE) ---
 
 print("\n-- [BƯỚC 2] Xây dựng Pipeline Mã hóa & Chuẩn hóa... --")
@@ -466,33 +564,43 @@ membership_tiers = ['Standard', 'Silver', 'Gold', 'Diamond']
 ordinal_features = ['Income level', 'Membership_Tier']
 nominal_features = ['Occupation', 'Gender']
 
-# 2.2. Xây dựng các đường ống (pipeline) con
-numeric_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='median')),
-    ('scaler', StandardScaler())
-])
-ordinal_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='most_frequent')),
-    ('encoder', OrdinalEncoder(categories=[income_levels, membership_tiers], handle_unknown='use_encoded_value', unknown_value=-1))
-])
-nominal_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='most_frequent')),
-    ('encoder', OneHotEncoder(handle_unknown='ignore', sparse_output=False))
-])
-
-# 2.3. Kết hợp các pipeline con bằng ColumnTransformer
-preprocessor = ColumnTransformer(
-    transformers=[
-        ('num', numeric_transformer, numerical_features),
-        ('ord', ordinal_transformer, ordinal_features),
-        ('nom', nominal_transformer, nominal_features)
-    ],
-    remainder='passthrough'
-)
+if seg_model is not None:
+    preprocessor = seg_model['preprocessor']
+    print(f"Dùng preprocessor đã fit của mô hình v{seg_model['version']:04d}.")
+else:
+    # 2.2. Xây dựng các đường ống (pipeline) con
+    numeric_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='median')),
+        ('scaler', StandardScaler())
+    ])
+    ordinal_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='most_frequent')),
+        ('encoder', OrdinalEncoder(categories=[income_levels, membership_tiers], handle_unknown='use_encoded_value', unknown_value=-1, dtype=FEATURE_DTYPE))
+    ])
+    nominal_transformer = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='most_frequent')),
+        ('encoder', OneHotEncoder(handle_unknown='ignore', sparse_output=True, dtype=FEATURE_DTYPE))
+    ])
+
+    # 2.3. Kết hợp các pipeline con bằng ColumnTransformer
+    # sparse_threshold=1.0: giữ khối one-hot ở dạng thưa -> bộ nhớ tỉ lệ với số phần tử khác 0
+    column_transformer = ColumnTransformer(
+        transformers=[
+            ('num', numeric_transformer, numerical_features),
+            ('ord', ordinal_transformer, ordinal_features),
+            ('nom', nominal_transformer, nominal_features)
+        ],
+        remainder='passthrough',
+        sparse_threshold=1.0
+    )
+    preprocessor = Pipeline(steps=[
+        ('columns', column_transformer),
+        ('dtype', FunctionTransformer(cast_features, kw_args={'dtype': FEATURE_DTYPE}))
+    ])
 
-# 2.4. Áp dụng preprocessor
-X_scaled = preprocessor.fit_transform(df_model_input)
-print("Pipeline tiền xử lý hoàn tất.")
+    # 2.4. Áp dụng preprocessor
+    X_scaled = preprocessor.fit_transform(df_model_input)
+    print("Pipeline tiền xử lý hoàn tất.")
 
 # --- BƯỚC 3: XÁC ĐỊNH SỐ CỤM TỐI ƯU (K) ---
 # (Bỏ qua phần này để chạy nhanh hơn, giả định K=3)
@@ -501,11 +609,32 @@ print("\n-- [BƯỚC 3] Bỏ qua (Giả định K=3)... --")
 # --- BƯỚC 4: HUẤN LUYỆN VÀ ĐÁNH GIÁ MÔ HÌNH K-MEANS ---
 
 print("\n-- [BƯỚC 4] Huấn luyện & Đánh giá mô hình K-Means Clustering... --")
-N_CLUSTERS = 3
-model_name = "K-Means"
-model = KMeans(n_clusters=N_CLUSTERS, init='k-means++', random_state=42, n_init=10)
-print(f"\nĐang huấn luyện mô hình {model_name}...")
-labels = model.fit_predict(X_scaled)
+if seg_model is not None:
+    centroids = seg_model['centroids']
+    cluster_name_map = seg_model['cluster_name_map']
+    seg_version = seg_model['version']
+    labels = (
+        seg_model['customer_clusters'].set_index('Customer_ID')['Cluster']
+        .reindex(df_analysis['Customer_ID']).to_numpy()
+    )
+else:
+    print(f"\nĐang huấn luyện mô hình {model_name} (chế độ {SEGMENTATION_MODE})...")
+    if SEGMENTATION_MODE == 'minibatch':
+        model = fit_minibatch_kmeans(X_scaled, N_CLUSTERS, random_state=42)
+        labels = assign_clusters(X_scaled, model.cluster_centers_)
+        save_centroids(model.cluster_centers_, CENTROIDS_FILE)
+    else:
+        model = KMeans(n_clusters=N_CLUSTERS, init='k-means++', random_state=42, n_init=10)
+        labels = model.fit_predict(X_scaled)
+    centroids = model.cluster_centers_
+    cluster_name_map = {i: f'Cụm {i}' for i in range(N_CLUSTERS)}
+    # Phần này không tính chỉ số đánh giá (scores=None) -> phần Cluster tính và ghi bổ sung khi nạp lại
+    seg_version = save_segmentation_model(
+        preprocessor, centroids, cluster_name_map,
+        pd.DataFrame({'Customer_ID': df_analysis['Customer_ID'], 'Cluster': labels}),
+        seg_params
+    )
+    print(f"Đã lưu mô hình phân khúc vào registry (v{seg_version:04d}).")
 labels_dict = {model_name: labels} # Lưu nhãn
 print("Hoàn tất BƯỚC 4.")
 
@@ -545,13 +674,29 @@ df_full_segmented['Total_List_Price'] = df_full_segmented['Quantity'] * df_full_
 # Thêm cột 'Effective_Price' vào df_full_segmented
 df_full_segmented['Effective_Price'] = df_full_segmented['Total_Paid'] / df_full_segmented['Quantity']
 
-# 7.2. Tổng hợp theo Date, Cluster, VÀ CATEGORY
-print("Đang tổng hợp dữ liệu (Lấy TỔNG Q, TỔNG Paid, TỔNG List) theo Category...")
-df_agg_cat = df_full_segmented.groupby(['Date', 'Cluster', 'Category']).agg(
-    Total_Quantity=('Quantity', 'sum'),
-    Total_Paid_Agg=('Total_Paid', 'sum'),
-    Total_List_Price_Agg=('Total_List_Price', 'sum')
-).reset_index()
+# 7.2. Tổng hợp theo Date, Cluster, VÀ CATEGORY (nguồn theo AGGREGATE_SOURCE ở BƯỚC 1)
+if AGGREGATE_SOURCE == 'stream':
+    print("Đang tổng hợp theo Category khi đọc transaction_data.csv theo chunk...")
+    df_agg_cat = stream_aggregates(
+        'transaction_data.csv', df_product=df_prod,
+        customer_cluster=df_analysis.set_index('Customer_ID')['Cluster']
+    )['df_agg_cat']
+    df_agg_cat['Cluster'] = df_agg_cat['Cluster'].astype(df_analysis['Cluster'].dtype)
+elif AGGREGATE_SOURCE == 'state':
+    print("Đang đọc bảng tổng hợp theo Category từ kho trạng thái (.hl_state)...")
+    agg_state = load_state()
+    if agg_state['cluster_key'] != seg_version:
+        raise ValueError(f"State dùng nhãn cụm v{agg_state['cluster_key']}, mô hình hiện tại v{seg_version}: "
+                         "chạy lại `python incremental_store.py init`.")
+    df_agg_cat = state_tables(agg_state)['df_agg_cat']
+    df_agg_cat['Cluster'] = df_agg_cat['Cluster'].astype(df_analysis['Cluster'].dtype)
+else:
+    print("Đang tổng hợp dữ liệu (Lấy TỔNG Q, TỔNG Paid, TỔNG List) theo Category...")
+    df_agg_cat = df_full_segmented.groupby(['Date', 'Cluster', 'Category']).agg(
+        Total_Quantity=('Quantity', 'sum'),
+        Total_Paid_Agg=('Total_Paid', 'sum'),
+        Total_List_Price_Agg=('Total_List_Price', 'sum')
+    ).reset_index()
 
 # 7.3. [LOGIC MỚI] Tạo biến "Price_Index" (cho từng Category)
 df_agg_cat = df_agg_cat[df_agg_cat['Total_List_Price_Agg'] > 0]
@@ -569,58 +714,21 @@ df_agg_cat_macro = pd.merge(
 )
 print("Đã thêm các biến kiểm soát (Promotion, Weekend, Holiday, Monthly_Index).")
 
-# 7.5. Phân tích lặp qua từng Cluster VÀ Category
+# 7.5. Danh sách Cluster VÀ Category cần phân tích
 cluster_labels = sorted(df_analysis['Cluster'].unique())
 categories_to_analyze = df_agg_cat_macro['Category'].unique()
-ped_results_list_cat = []
-
 print(f"Bắt đầu chạy hồi quy (Mô hình 5) cho 3 Cụm x {len(categories_to_analyze)} Categories...")
 
-for cluster in cluster_labels:
-    for category in categories_to_analyze:
-
-        df_cat_segment = df_agg_cat_macro[
-            (df_agg_cat_macro['Cluster'] == cluster) &
-            (df_agg_cat_macro['Category'] == category)
-        ].copy()
-
-        # 7.6. Xây dựng mô hình Log-Log Đa biến
-        if df_cat_segment.shape[0] > 10: # Cần đủ dữ liệu
-
-            Y = np.log(df_cat_segment['Total_Quantity'])
-
-            X = pd.DataFrame({
-                'log_Price_Index': np.log(df_cat_segment['Price_Index']),
-                'Promotion': df_cat_segment['Promotion_Campaign'],
-                'Weekend': df_cat_segment['Is_Weekend'],
-                'Holiday': df_cat_segment['Is_Holiday'],
-                'Monthly_Index': df_cat_segment['Monthly_Index']
-            })
-            X = sm.add_constant(X)
-
-            model_ols = sm.OLS(Y, X).fit()
-
-            ped_value = model_ols.params['log_Price_Index']
-            p_value = model_ols.pvalues['log_Price_Index'] # [SỬA LỖI] Giữ lại P-Value
-
-            ped_results_list_cat.append({
-                'Category': category,
-                'Phân khúc (Cluster)': cluster,
-                'PED (β1)': ped_value,
-                'P_Value': p_value # [SỬA LỖI] Giữ lại P-Value
-            })
-
-        else:
-            ped_results_list_cat.append({
-                'Category': category,
-                'Phân khúc (Cluster)': cluster,
-                'PED (β1)': np.nan,
-                'P_Value': np.nan # [SỬA LỖI] Giữ lại P-Value
-            })
+# 7.6. Mô hình Log-Log đa biến cho từng (Cluster, Category) - ped_engine.py:
+# chia dữ liệu 1 lần bằng groupby, hồi quy song song khi có nhiều phân khúc
+df_ped_summary_category = estimate_ped(
+    df_agg_cat_macro,
+    segment_cols=['Cluster', 'Category'],
+    levels={'Cluster': cluster_labels, 'Category': categories_to_analyze}
+)
 
 # 7.7. Hiển thị Bảng kết quả tổng hợp
 print("\n--- [BƯỚC 7 - Mô hình 5] Hoàn tất tính toán PED. ---")
-df_ped_summary_category = pd.DataFrame(ped_results_list_cat) # Lưu kết quả
 
 # Hiển thị bảng lọc |PED| > 1 (Theo yêu cầu cuối cùng của bạn)
 print("\n--- Bảng tóm tắt (Pivot) CHỈ DÀNH CHO KẾT QUẢ CO GIÃN (Elastic) ---")
@@ -629,8 +737,7 @@ df_ped_elastic = df_ped_summary_category[
     (df_ped_summary_category['PED (β1)'].abs() > 1)
 ]
 
-# Đổi tên cụm
-cluster_name_map = { 0: 'Cụm 0', 1: 'Cụm 1', 2: 'Cụm 2' }
+# Đổi tên cụm (cluster_name_map từ BƯỚC 4 / registry mô hình)
 df_ped_elastic['Phân khúc'] = df_ped_elastic['Phân khúc (Cluster)'].map(cluster_name_map)
 
 if df_ped_elastic.empty:
@@ -662,20 +769,23 @@ print(f"    [Ràng buộc 7] Ràng buộc tăng giá tối đa: {MAX_PRICE_INCRE
 
 
 # [BƯỚC 8] Hàm chuẩn bị dữ liệu
-def prepare_base_data_optimization():
+# by_store=True: 1 dòng cho mỗi (Store_ID, Product_ID) - mỗi cửa hàng là 1 thị trường cho method='joint'
+def prepare_base_data_optimization(by_store=False):
     print("    [B8] Đang chuẩn bị Dữ liệu Nền (P_base, Q_base, COGS, PED)...")
     try:
+        keys = ['Store_ID', 'Product_ID'] if by_store else ['Product_ID']
+
         # 1. P_base (Giá bán thực tế TB) cho mỗi SKU
         # (df_full_segmented đã được tạo ở BƯỚC 7)
-        df_p_base = df_full_segmented.groupby('Product_ID')['Effective_Price'].mean().to_frame('P_base')
+        df_p_base = df_full_segmented.groupby(keys)['Effective_Price'].mean().to_frame('P_base')
 
         # 2. Q_base (Tổng sản lượng cơ sở) cho mỗi SKU và từng Cụm
-        df_q_total_base = df_full_segmented.groupby('Product_ID')['Quantity'].sum().to_frame('Q_total_base')
-        df_q_base_pivot = df_full_segmented.groupby(['Product_ID', 'Cluster'])['Quantity'].sum().unstack(fill_value=0)
+        df_q_total_base = df_full_segmented.groupby(keys)['Quantity'].sum().to_frame('Q_total_base')
+        df_q_base_pivot = df_full_segmented.groupby(keys + ['Cluster'])['Quantity'].sum().unstack(fill_value=0)
         df_q_base_pivot.columns = [f'Q_base_{col}' for col in df_q_base_pivot.columns]
 
-        # 3. Lấy COGS cũ (Cần df_prod)
-        df_cogs = df_prod.set_index('Product_ID')[['COGS', 'Category']]
+        # 3. Lấy COGS cũ (Cần df_prod); Product_Name / Size cho thang giá S <= M <= L (method='joint')
+        df_cogs = df_prod.set_index('Product_ID')[['COGS', 'Category', 'Product_Name', 'Size']]
 
         # 4. [LOGIC MỚI] Ánh xạ PED (từ BƯỚC 7) theo Category
         # (df_ped_elastic đã được tạo ở BƯỚC 7)
@@ -704,9 +814,8 @@ def prepare_base_data_optimization():
         print("          -> Đã gán PED = -1.0 (Unit Elastic) cho các phân khúc 'Inelastic' (NaN).")
 
         # 5. Hợp nhất tất cả
-        df_base = pd.concat([
-            df_p_base, df_q_total_base, df_q_base_pivot, df_cogs_with_ped
-        ], axis=1)
+        df_base = pd.concat([df_p_base, df_q_total_base, df_q_base_pivot], axis=1)
+        df_base = df_base.join(df_cogs_with_ped, on='Product_ID')
 
         df_base = df_base.dropna(subset=['P_base', 'Q_total_base'])
         print(f"    [B8] Đã chuẩn bị xong Dữ liệu Nền cho {len(df_base)} SKUs.")
@@ -792,7 +901,12 @@ def optimize_sku_gridsearch(row):
     return pd.Series({'P_optimal': best_p, 'Profit_optimal': best_profit, 'Q_optimal': best_q, 'Profit_at_P_base': profit_at_p_base, 'Status': 'Thành công'})
 
 # [BƯỚC 9 & 11] Hàm chạy chính
-def run_optimization(cogs_input_dict, df_base_data):
+# method='grid'    : Grid Search vector hóa (optimization_engine) - mặc định
+# method='analytic': Nghiệm đóng / golden-section (giá tối ưu chính xác, không xấp xỉ lưới)
+# method='loop'    : Bản lặp từng SKU (optimize_sku_gridsearch) - giữ lại để đối chiếu
+# method='oracle'  : Grid Search với lượng bán dự báo bởi mô hình (demand_fn, xem demand_oracle.py)
+# method='joint'   : Tối ưu đồng thời mọi SKU (co giãn chéo, thang giá S <= M <= L, sàn sản lượng theo Category)
+def run_optimization(cogs_input_dict, df_base_data, method='grid', demand_fn=None, cross_elasticity=None):
     if df_base_data is None:
         print("    [B11] LỖI: Dữ liệu nền (df_base_data) rỗng.")
         return
@@ -802,15 +916,48 @@ def run_optimization(cogs_input_dict, df_base_data):
     if cogs_input_dict:
         cogs_new_series = pd.Series(cogs_input_dict)
         cogs_new_series.name = 'COGS_new_override'
-        df_base = df_base.merge(cogs_new_series, left_index=True, right_index=True, how='left')
+        df_base = df_base.join(cogs_new_series, on='Product_ID')
         df_base['COGS_new'] = df_base['COGS_new_override'].fillna(df_base['COGS_new'])
         df_base = df_base.drop(columns=['COGS_new_override'])
         print(f"    [B9] Đã áp dụng COGS_new cho {len(cogs_input_dict)} SKUs.")
     else:
         print("    [B9] Không có COGS_new nào được nhập. Dùng COGS hiện tại.")
 
-    print(f"    [B11] Đang chạy Tối ưu hóa (Grid Search) cho {len(df_base)} SKUs...")
-    results_list = df_base.apply(optimize_sku_gridsearch, axis=1) # Gọi hàm Grid Search
+    print(f"    [B11] Đang chạy Tối ưu hóa (Grid Search, method='{method}') cho {len(df_base)} SKUs...")
+    if method == 'loop':
+        results_list = df_base.apply(optimize_sku_gridsearch, axis=1) # Gọi hàm Grid Search
+    elif method == 'analytic':
+        results_list = optimize_prices_analytic(
+            df_base,
+            max_quantity_drop_pct=MAX_QUANTITY_DROP_PCT,
+            max_price_increase_pct=MAX_PRICE_INCREASE_PCT
+        )
+    elif method == 'joint':
+        # RÀNG BUỘC 6 áp cho tổng sản lượng từng Category (khách chuyển giữa size / sản phẩm)
+        results_list = optimize_prices_joint(
+            df_base, cross_elasticity,
+            volume_floor_pct=MAX_QUANTITY_DROP_PCT,
+            max_price_increase_pct=MAX_PRICE_INCREASE_PCT,
+            verbose=True
+        )
+    elif method == 'oracle':
+        if isinstance(df_base.index, pd.MultiIndex):
+            raise ValueError(ORACLE_MULTIINDEX_ERROR)
+        # Profit / Q tính trên kỳ dự báo của demand_fn (vd. 90 ngày Q1), không phải kỳ lịch sử
+        # -> Q_total_base cũng lấy theo dự báo tại P_base để Q_Drop_Pct so sánh cùng kỳ
+        q_forecast_base = demand_fn(df_base.index.to_numpy(), df_base[['P_base']].to_numpy())[:, 0]
+        df_base['Q_total_base'] = pd.Series(q_forecast_base, index=df_base.index).fillna(df_base['Q_total_base'])
+        results_list = optimize_prices_oracle(
+            df_base, demand_fn,
+            max_quantity_drop_pct=MAX_QUANTITY_DROP_PCT,
+            max_price_increase_pct=MAX_PRICE_INCREASE_PCT
+        )
+    else:
+        results_list = optimize_prices_vectorized(
+            df_base,
+            max_quantity_drop_pct=MAX_QUANTITY_DROP_PCT,
+            max_price_increase_pct=MAX_PRICE_INCREASE_PCT
+        )
 
     df_final_results = df_base.join(results_list)
 
@@ -831,6 +978,8 @@ def run_optimization(cogs_input_dict, df_base_data):
 
     print("\n--- KẾT QUẢ TỐI ƯU HÓA GIÁ (ĐÃ SẮP XẾP) ---")
     print(f"(Ràng buộc: Tăng giá tối đa {MAX_PRICE_INCREASE_PCT:.0%}, Sụt giảm Sản lượng tối đa {MAX_QUANTITY_DROP_PCT:.0%})")
+    if method == 'joint':
+        print("(method='joint': sụt giảm sản lượng tính trên tổng mỗi Category; giá S <= M <= L trong cùng Product_Name)")
 
     # [SỬA LỖI] Sửa lỗi thụt lề
     display(df_final_results[columns_to_show].style.format({
@@ -859,7 +1008,10 @@ print("\n--- [HOÀN TẤT] BƯỚC 0-7. ---")
 
 # --- CHẠY KHỐI 2 (BƯỚC 8-11) ---
 print("\n--- [BẮT ĐẦU] Chạy BƯỚC 8-11 (Tối ưu hóa)... ---")
-GLOBAL_DF_BASE_DATA = prepare_base_data_optimization()
+# True: tối ưu riêng từng cửa hàng (Store_ID x Product_ID) - dùng với 'grid' / 'analytic' / 'joint'
+# ('oracle' không hỗ trợ: mô hình cầu chỉ theo Product_ID -> run_optimization báo ValueError)
+OPTIMIZE_BY_STORE = False
+GLOBAL_DF_BASE_DATA = prepare_base_data_optimization(by_store=OPTIMIZE_BY_STORE)
 
 if GLOBAL_DF_BASE_DATA is not None:
     # ##################################################################
@@ -899,10 +1051,25 @@ if GLOBAL_DF_BASE_DATA is not None:
         'FR09_M': 26250,  # (Cũ: 20250)
         'FR09_L': 29250,  # (Cũ: 23250)
     }
+    # 'grid' / 'analytic' / 'loop': hàm cầu PED hằng số | 'oracle': lượng bán từ mô hình dự báo (XGBoost)
+    # 'joint': tối ưu đồng thời mọi SKU với ma trận co giãn chéo (mặc định theo cấu trúc menu)
+    OPTIMIZATION_METHOD = 'grid'
     # ##################################################################
 
+    demand_fn = None
+    cross_elasticity = None
+    if OPTIMIZATION_METHOD == 'joint':
+        # Thay bằng ma trận ước lượng (DataFrame Product_ID x Product_ID) nếu có
+        cross_elasticity = cross_elasticity_matrix(df_prod.set_index('Product_ID'))
+    if OPTIMIZATION_METHOD == 'oracle':
+        # Mô hình cầu học trên kho chuỗi memmap; dự báo cho kỳ ngay sau ngày cuối của dữ liệu
+        series = load_series_store('.', verbose=True)
+        demand_oracle = fit_demand_oracle(load_table('macro_context'), verbose=True)
+        demand_fn = oracle_demand_fn(demand_oracle, future_start=series['dates'][-1] + pd.Timedelta(days=1))
+
     print(f"\n--- [KHỐI 2] Bắt đầu chạy Tối ưu hóa (Grid Search) cho {len(cogs_input_cua_ban)} SKU... ---")
-    run_optimization(cogs_input_cua_ban, GLOBAL_DF_BASE_DATA)
+    run_optimization(cogs_input_cua_ban, GLOBAL_DF_BASE_DATA, method=OPTIMIZATION_METHOD,
+                     demand_fn=demand_fn, cross_elasticity=cross_elasticity)
 else:
     print("\nLỖI: Không thể chạy Tối ưu hóa vì Dữ liệu Nền (BƯỚC 8) đã thất bại.")
 
@@ -928,31 +1095,33 @@ from datetime import timedelta
 import warnings
 from IPython.display import display, Markdown
 
-# Thư viện Preprocessing
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
-
-# Thư viện 4 Mô hình
-from sklearn.linear_model import LinearRegression
-from sklearn.ensemble import RandomForestRegressor
-from xgboost import XGBRegressor
+# Thư viện 4 Mô hình: registry model_backends.py (LR, RF, XGB, LSTM)
+# scikit-learn / XGBoost / TensorFlow chỉ được nạp khi mô hình tương ứng được chọn
 # from prophet import Prophet # ĐÃ BỎ DO LỖI KỸ THUẬT
-# Tắt cảnh báo TensorFlow
 import os
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-import tensorflow as tf
-tf.get_logger().setLevel('ERROR')
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import LSTM, Dense
-from tensorflow.keras.callbacks import EarlyStopping
-
-# Thư viện Đánh giá (để tham khảo)
-from sklearn.metrics import mean_absolute_error
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # Tắt cảnh báo TensorFlow
+from model_backends import fit_model, predict_model, models_from_argv
+
+# Lớp truy cập dữ liệu (cache Parquet) - file data_access.py cùng thư mục
+from data_access import load_table
+from series_store import load_series_store, daily_table
+from streaming_aggregates import stream_aggregates
+from lag_features import add_lag_features, lag_feature_names, recursive_forecast
+from forecast_engine import (
+    FORECAST_DIR_NAME, forecast_all_series, read_forecast_table, fit_global_model, forecast_global
+)
+from sequence_model import SEQ_PREFIX, SEQ_WINDOW, SEQ_THREADS, fit_sequence_model, forecast_sequence
+from scenario_engine import NO_PROMO, scenario_grid, forecast_scenarios, profit_surface, best_scenarios
 
 # Cài đặt
 pd.set_option('display.float_format', '{:.2f}'.format)
 warnings.filterwarnings('ignore')
 print("-- [BƯỚC 0] Tất cả thư viện đã được nhập thành công. --")
 
+# Chọn mô hình chạy bằng cờ --models (vd. --models LR,XGB); mặc định cả 4 mô hình
+FORECAST_MODELS = models_from_argv(default=['LR', 'RF', 'XGB', 'LSTM'])
+print(f"-- Mô hình sẽ chạy: {', '.join(FORECAST_MODELS)} --")
+
 
 # --- [GIẢ ĐỊNH KỊCH BẢN] ---
 # Đây là các giả định từ file Tối ưu hóa (Optimization)
@@ -979,36 +1148,25 @@ print(f"-- [GIẢ ĐỊNH] Giá vốn mới: {NEW_COGS_PER_ITEM:,.0f} đ / 1 ly"
 # --- BƯỚC 1: TẢI VÀ TỔNG HỢP DỮ LIỆU (TẠO BẢNG HUẤN LUYỆN 2024) ---
 print("\n-- [BƯỚC 1] Đang tải và tạo Bảng dữ liệu huấn luyện (2024)... --")
 try:
-    df_trans = pd.read_csv('transaction_data.csv')
-    df_prod = pd.read_csv('product_master.csv') # Cần để lấy giá niêm yết
-    df_macro = pd.read_csv('macro_context.csv')
+    # Kho chuỗi memmap (store x product x ngày) của trans + prod, tự ghi lại khi CSV đổi
+    series = load_series_store('.', verbose=True)
+    df_macro = load_table('macro_context')
 except FileNotFoundError:
     print("LỖI: Không tìm thấy tệp CSV. Vui lòng đảm bảo 3 tệp (trans, prod, macro) nằm trong cùng thư mục.")
     # exit()
 
 # Chuyển đổi kiểu dữ liệu
-df_trans['Date_Time'] = pd.to_datetime(df_trans['Date_Time'])
-df_trans['Date'] = df_trans['Date_Time'].dt.date.astype(str)
-df_macro['Date'] = pd.to_datetime(df_macro['Date']).dt.date.astype(str)
-
-# 1.1. Tính toán 'Total_List_Price' cho từng giao dịch
-df_trans = pd.merge(
-    df_trans,
-    df_prod[['Product_ID', 'Unit_Price_List']],
-    on='Product_ID',
-    how='left'
-)
-df_trans = df_trans.rename(columns={'Unit_Price_Listed': 'Unit_Price_Recorded', 'Unit_Price_List': 'Unit_Price_Master'})
-df_trans['Unit_Price_Master'] = df_trans['Unit_Price_Master'].fillna(df_trans['Unit_Price_Recorded'])
-df_trans['Total_List_Price'] = df_trans['Quantity'] * df_trans['Unit_Price_Master']
-
-
-# 1.2. Tổng hợp (Aggregate) toàn bộ giỏ hàng lên cấp độ HÀNG NGÀY
-df_daily_agg = df_trans.groupby('Date').agg(
-    Total_Quantity=('Quantity', 'sum'),
-    Total_Paid_Agg=('Total_Paid', 'sum'),
-    Total_List_Price_Agg=('Total_List_Price', 'sum')
-).reset_index()
+df_macro['Date'] = df_macro['Date'].dt.strftime('%Y-%m-%d')
+
+# 1.1 - 1.2. Tổng hợp toàn bộ giỏ hàng lên cấp độ HÀNG NGÀY từ kho chuỗi
+# ('Total_List_Price' = Quantity x giá niêm yết của product_master, thiếu thì lấy giá ghi nhận)
+# Nguồn df_daily_agg: 'series' = kho chuỗi ở trên (mặc định) | 'stream' = tổng hợp khi đọc
+# transaction_data.csv theo chunk (streaming_aggregates.py), cùng kết quả với daily_table
+AGGREGATE_SOURCE = 'series'
+if AGGREGATE_SOURCE == 'stream':
+    df_daily_agg = stream_aggregates('transaction_data.csv', df_product=load_table('product_master'))['df_daily_agg']
+else:
+    df_daily_agg = daily_table(series)
 
 # 1.3. Tính toán 'Price_Index' (BIẾN NGUYÊN NHÂN CHÍNH)
 df_daily_agg = df_daily_agg[df_daily_agg['Total_List_Price_Agg'] > 0]
@@ -1077,97 +1235,90 @@ X_future_B = X_future_B[feature_cols]
 # Lưu trữ kết quả
 forecast_results = pd.DataFrame(index=future_dates)
 models_summary = {}
+fitted_models = {} # Mô hình đã fit (theo tên backend) - dùng lại cho lưới kịch bản ở BƯỚC 4B
 
 # ---------------------------------
 # MÔ HÌNH 1: LINEAR REGRESSION
 # ---------------------------------
-print("\n... [Mô hình 1] Đang chạy Linear Regression ...")
-model_lr = LinearRegression()
-model_lr.fit(X_train, Y_train)
+if 'LR' in FORECAST_MODELS:
+    print("\n... [Mô hình 1] Đang chạy Linear Regression ...")
+    model_lr = fit_model('LR', X_train, Y_train)
+    fitted_models['LR'] = model_lr
 
-pred_A_lr = model_lr.predict(X_future_A)
-pred_B_lr = model_lr.predict(X_future_B)
+    pred_A_lr = predict_model('LR', model_lr, X_future_A)
+    pred_B_lr = predict_model('LR', model_lr, X_future_B)
 
-forecast_results['LR_A'] = pred_A_lr
-forecast_results['LR_B'] = pred_B_lr
-models_summary['Linear Regression'] = (pred_A_lr.sum(), pred_B_lr.sum())
+    forecast_results['LR_A'] = pred_A_lr
+    forecast_results['LR_B'] = pred_B_lr
+    models_summary['Linear Regression'] = (pred_A_lr.sum(), pred_B_lr.sum())
 
 # ---------------------------------
 # MÔ HÌNH 2: RANDOM FOREST REGRESSOR
 # ---------------------------------
-print("... [Mô hình 2] Đang chạy Random Forest ...")
-model_rf = RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=-1)
-model_rf.fit(X_train, Y_train)
+if 'RF' in FORECAST_MODELS:
+    print("... [Mô hình 2] Đang chạy Random Forest ...")
+    model_rf = fit_model('RF', X_train, Y_train, n_estimators=100, random_state=42, n_jobs=-1)
+    fitted_models['RF'] = model_rf
 
-pred_A_rf = model_rf.predict(X_future_A)
-pred_B_rf = model_rf.predict(X_future_B)
+    pred_A_rf = predict_model('RF', model_rf, X_future_A)
+    pred_B_rf = predict_model('RF', model_rf, X_future_B)
 
-forecast_results['RF_A'] = pred_A_rf
-forecast_results['RF_B'] = pred_B_rf
-models_summary['Random Forest'] = (pred_A_rf.sum(), pred_B_rf.sum())
+    forecast_results['RF_A'] = pred_A_rf
+    forecast_results['RF_B'] = pred_B_rf
+    models_summary['Random Forest'] = (pred_A_rf.sum(), pred_B_rf.sum())
 
 # ---------------------------------
 # MÔ HÌNH 3: XGBOOST
 # ---------------------------------
-print("... [Mô hình 3] Đang chạy XGBoost ...")
-model_xgb = XGBRegressor(n_estimators=100, random_state=42, n_jobs=-1, objective='reg:squarederror')
-model_xgb.fit(X_train, Y_train)
+if 'XGB' in FORECAST_MODELS:
+    print("... [Mô hình 3] Đang chạy XGBoost ...")
+    model_xgb = fit_model('XGB', X_train, Y_train, n_estimators=100, random_state=42, n_jobs=-1)
+    fitted_models['XGB'] = model_xgb
 
-pred_A_xgb = model_xgb.predict(X_future_A)
-pred_B_xgb = model_xgb.predict(X_future_B)
+    pred_A_xgb = predict_model('XGB', model_xgb, X_future_A)
+    pred_B_xgb = predict_model('XGB', model_xgb, X_future_B)
 
-forecast_results['XGB_A'] = pred_A_xgb
-forecast_results['XGB_B'] = pred_B_xgb
-models_summary['XGBoost'] = (pred_A_xgb.sum(), pred_B_xgb.sum())
+    forecast_results['XGB_A'] = pred_A_xgb
+    forecast_results['XGB_B'] = pred_B_xgb
+    models_summary['XGBoost'] = (pred_A_xgb.sum(), pred_B_xgb.sum())
 
 # ---------------------------------
-# MÔ HÌNH 4: LSTM
+# MÔ HÌNH 3B: XGBOOST + ĐẶC TRƯNG TRỄ (DỰ BÁO ĐỆ QUY)
 # ---------------------------------
-print("... [Mô hình 4] Đang chạy LSTM ...")
-# 4.1. Chuẩn hóa dữ liệu cho LSTM
-scaler_X = MinMaxScaler()
-scaler_Y = MinMaxScaler()
-
-X_train_scaled = scaler_X.fit_transform(X_train)
-Y_train_scaled = scaler_Y.fit_transform(Y_train.values.reshape(-1, 1))
+if 'XGB' in FORECAST_MODELS:
+    print("... [Mô hình 3B] Đang chạy XGBoost + Lag (dự báo đệ quy 90 ngày) ...")
+    # Lag / trung bình trượt / EWMA của Total_Quantity và Price_Index (lag_features.py);
+    # mỗi ngày dự báo được đưa ngược vào lịch sử để tính đặc trưng cho ngày kế tiếp
+    lag_feature_cols = feature_cols + lag_feature_names()
+    df_train_lag = add_lag_features(df_train_2024).dropna(subset=lag_feature_cols)
+    model_xgb_lag = fit_model('XGB', df_train_lag[lag_feature_cols], df_train_lag[target_col],
+                              n_estimators=100, random_state=42, n_jobs=-1)
+
+    pred_A_xgb_lag = recursive_forecast(model_xgb_lag, df_train_2024, X_future_A, lag_feature_cols)
+    pred_B_xgb_lag = recursive_forecast(model_xgb_lag, df_train_2024, X_future_B, lag_feature_cols)
+
+    forecast_results['XGB_LAG_A'] = pred_A_xgb_lag
+    forecast_results['XGB_LAG_B'] = pred_B_xgb_lag
+    models_summary['XGBoost + Lag'] = (pred_A_xgb_lag.sum(), pred_B_xgb_lag.sum())
 
-# 4.2. Định hình lại dữ liệu
-X_train_lstm = X_train_scaled.reshape((X_train_scaled.shape[0], 1, X_train_scaled.shape[1]))
-
-# 4.3. Xây dựng mô hình
-model_lstm = Sequential()
-model_lstm.add(LSTM(50, activation='relu', input_shape=(X_train_lstm.shape[1], X_train_lstm.shape[2])))
-model_lstm.add(Dense(1))
-model_lstm.compile(optimizer='adam', loss='mse')
-
-# 4.4. Huấn luyện
-early_stop = EarlyStopping(monitor='loss', patience=5, verbose=0)
-model_lstm.fit(X_train_lstm, Y_train_scaled,
-               epochs=20,
-               batch_size=32,
-               verbose=0,
-               callbacks=[early_stop])
-
-# 4.5. Chuẩn bị dữ liệu tương lai
-X_future_A_scaled = scaler_X.transform(X_future_A)
-X_future_B_scaled = scaler_X.transform(X_future_B)
-
-X_future_A_lstm = X_future_A_scaled.reshape((X_future_A_scaled.shape[0], 1, X_future_A_scaled.shape[1]))
-X_future_B_lstm = X_future_B_scaled.reshape((X_future_B_scaled.shape[0], 1, X_future_B_scaled.shape[1]))
+# ---------------------------------
+# MÔ HÌNH 4: LSTM
+# ---------------------------------
+if 'LSTM' in FORECAST_MODELS:
+    print("... [Mô hình 4] Đang chạy LSTM ...")
+    # Chuẩn hóa MinMax, reshape (n, 1, n_features), LSTM(50) + Dense(1), EarlyStopping(patience=5)
+    # và chuyển đổi ngược nằm trong backend 'LSTM' của model_backends.py
+    model_lstm = fit_model('LSTM', X_train, Y_train, epochs=20, batch_size=32)
+    fitted_models['LSTM'] = model_lstm
 
-# 4.6. Dự báo
-pred_A_lstm_scaled = model_lstm.predict(X_future_A_lstm, verbose=0)
-pred_B_lstm_scaled = model_lstm.predict(X_future_B_lstm, verbose=0)
+    pred_A_lstm = predict_model('LSTM', model_lstm, X_future_A)
+    pred_B_lstm = predict_model('LSTM', model_lstm, X_future_B)
 
-# 4.7. Chuyển đổi ngược
-pred_A_lstm = scaler_Y.inverse_transform(pred_A_lstm_scaled).flatten()
-pred_B_lstm = scaler_Y.inverse_transform(pred_B_lstm_scaled).flatten()
+    forecast_results['LSTM_A'] = pred_A_lstm
+    forecast_results['LSTM_B'] = pred_B_lstm
+    models_summary['LSTM'] = (pred_A_lstm.sum(), pred_B_lstm.sum())
 
-forecast_results['LSTM_A'] = pred_A_lstm
-forecast_results['LSTM_B'] = pred_B_lstm
-models_summary['LSTM'] = (pred_A_lstm.sum(), pred_B_lstm.sum())
-
-print("\n--- [HOÀN TẤT] Đã chạy xong 4 mô hình! ---")
+print(f"\n--- [HOÀN TẤT] Đã chạy xong {len(models_summary)} mô hình! ---")
 
 
 # --- BƯỚC 4: TỔNG HỢP KẾT QUẢ VÀ TÍNH LỢI NHUẬN ---
@@ -1220,12 +1371,40 @@ format_dict = {
 display(df_final_report.style.format(format_dict).background_gradient(cmap='RdYlGn', subset=['Lợi nhuận Tăng/Giảm']))
 
 
+# --- BƯỚC 4B: LƯỚI KỊCH BẢN (PRICE_INDEX x KHUYẾN MÃI x COGS) ---
+print("\n-- [BƯỚC 4B] Đang dự báo lưới kịch bản giá / khuyến mãi / giá vốn... --")
+# Mọi kịch bản x 90 ngày xếp chồng thành 1 ma trận, mỗi mô hình predict 1 lần (scenario_engine.py)
+SCENARIO_PRICE_GRID = np.round(np.arange(0.90, 1.2001, 0.01), 2) # Gồm cả PRICE_INDEX_A, PRICE_INDEX_B
+SCENARIO_PROMO_CALENDARS = {
+    NO_PROMO: [],
+    'KM Tết (2 tuần)': pd.date_range('2025-01-20', '2025-02-02', freq='D'),
+}
+SCENARIO_COGS_GRID = [NEW_COGS_PER_ITEM - 2000, NEW_COGS_PER_ITEM, NEW_COGS_PER_ITEM + 2000]
+
+grid = scenario_grid(SCENARIO_PRICE_GRID, SCENARIO_PROMO_CALENDARS, SCENARIO_COGS_GRID)
+df_scenario_forecast = forecast_scenarios(fitted_models, grid, df_future_2025, feature_cols)
+df_profit_surface = profit_surface(df_scenario_forecast, grid, AVG_LIST_PRICE_PER_ITEM)
+print(f"Hoàn tất BƯỚC 4B. {len(grid['scenarios'])} kịch bản x {len(fitted_models)} mô hình "
+      f"({len(df_scenario_forecast):,} dòng, 1 lần predict / mô hình).")
+
+# Kịch bản lợi nhuận cao nhất theo từng mô hình x giá vốn x lịch khuyến mãi
+display(best_scenarios(df_profit_surface)[['Model', 'Promo_Calendar', 'COGS', 'Price_Index', 'Total_Quantity', 'Profit']])
+
+# Bề mặt lợi nhuận (Price_Index x COGS) của 1 mô hình, không khuyến mãi
+surface_model = 'XGB' if 'XGB' in fitted_models else next(iter(fitted_models))
+df_surface = df_profit_surface[
+    (df_profit_surface['Model'] == surface_model) & (df_profit_surface['Promo_Calendar'] == NO_PROMO)
+].pivot(index='Price_Index', columns='COGS', values='Profit')
+display(df_surface.style.format("{:,.0f} đ").background_gradient(cmap='RdYlGn'))
+
+
 # --- BƯỚC 5: TRỰC QUAN HÓA KẾT QUẢ ---
 print("\n-- [BƯỚC 5] Đang vẽ biểu đồ kết quả... --")
 
-# Lấy kết quả từ mô hình tốt nhất (ví dụ: XGBoost)
-best_model_name = 'XGBoost'
-best_model_prefix = 'XGB'
+# Lấy kết quả từ mô hình tốt nhất (ví dụ: XGBoost), nếu không chạy thì lấy mô hình đầu tiên
+model_display_names = {'LR': 'Linear Regression', 'RF': 'Random Forest', 'XGB': 'XGBoost', 'LSTM': 'LSTM'}
+best_model_prefix = 'XGB' if 'XGB' in FORECAST_MODELS else FORECAST_MODELS[0]
+best_model_name = model_display_names[best_model_prefix]
 
 plt.figure(figsize=(15, 7))
 forecast_results[f'{best_model_prefix}_A'].plot(label=f'Kịch bản A: Giữ giá (Lượng bán)', style='b--')
@@ -1238,6 +1417,48 @@ plt.grid(True)
 plt.savefig('forecast_comparison_chart_4_models.png')
 print("Hoàn tất. Đã lưu biểu đồ vào 'forecast_comparison_chart_4_models.png'.")
 
+
+# --- BƯỚC 6: DỰ BÁO THEO TỪNG CỬA HÀNG x SẢN PHẨM ---
+print("\n-- [BƯỚC 6] Đang dự báo cho từng chuỗi Store_ID x Product_ID... --")
+# 'global'    : 1 XGBoost cho mọi chuỗi (mã chuỗi + đặc trưng trễ), 1 lần predict cho cả Q1
+# 'per_series': mỗi chuỗi 1 bộ mô hình (LR, RF, XGB) trên process pool, ghi ra .hl_forecast/
+# 'sequence'  : 1 LSTM chung cho mọi chuỗi, học trên cửa sổ SEQ_WINDOW ngày (tf.data, CPU SEQ_THREADS luồng)
+SERIES_FORECAST_MODE = 'global'
+series_scenarios = {'A': PRICE_INDEX_A, 'B': PRICE_INDEX_B}
+
+if SERIES_FORECAST_MODE == 'global':
+    global_model = fit_global_model(df_macro, n_days=N_DAYS_FORECAST, verbose=True)
+    df_store_forecast = forecast_global(global_model, future_start=future_dates[0], scenarios=series_scenarios)
+    series_prefix = 'GLOBAL'
+elif SERIES_FORECAST_MODE == 'sequence':
+    seq_model = fit_sequence_model(df_macro, window=SEQ_WINDOW, n_threads=SEQ_THREADS, verbose=True)
+    df_store_forecast = forecast_sequence(seq_model, future_start=future_dates[0], n_days=N_DAYS_FORECAST,
+                                          scenarios=series_scenarios)
+    series_prefix = SEQ_PREFIX
+else:
+    # LSTM theo từng chuỗi quá nặng -> chỉ chạy các mô hình còn lại đã chọn
+    series_models = [m for m in FORECAST_MODELS if m != 'LSTM'] or ['XGB']
+    forecast_dir = forecast_all_series(
+        df_macro,
+        out_dir=FORECAST_DIR_NAME,
+        scenarios=series_scenarios,
+        models=series_models,
+        n_days=N_DAYS_FORECAST,
+        future_start=future_dates[0],
+        verbose=True
+    )
+    df_store_forecast = read_forecast_table(forecast_dir)
+    series_prefix = best_model_prefix if best_model_prefix in series_models else series_models[0]
+
+# Tổng lượng bán Q1/2025 theo cửa hàng
+df_store_summary = (
+    df_store_forecast.groupby('Store_ID')[[f'{series_prefix}_A', f'{series_prefix}_B']]
+    .sum()
+    .sort_values(f'{series_prefix}_A', ascending=False)
+)
+print(f"Hoàn tất BƯỚC 6. Đã dự báo {df_store_forecast.groupby(['Store_ID', 'Product_ID']).ngroups} chuỗi.")
+display(df_store_summary)
+
 # --- [FILE STANDALONE]: ĐÁNH GIÁ MODEL (R2, MAPE) & DỰ BÁO KỊCH BẢN ---
 # Giai đoạn A: Đánh giá model trên dữ liệu 2024
 # Giai đoạn B: Dự báo 2 kịch bản cho Q1/2025
@@ -1271,6 +1492,12 @@ from tensorflow.keras.callbacks import EarlyStopping
 # [MỚI] Thư viện Đánh giá
 from sklearn.metrics import r2_score, mean_absolute_error, mean_absolute_percentage_error, mean_squared_error
 
+# Lớp truy cập dữ liệu (cache Parquet) - file data_access.py cùng thư mục
+from data_access import load_table
+from series_store import load_series_store, daily_table
+from streaming_aggregates import stream_aggregates
+from lag_features import add_lag_features, lag_feature_names, recursive_forecast
+
 # Cài đặt
 pd.set_option('display.float_format', '{:.2f}'.format)
 warnings.filterwarnings('ignore')
@@ -1295,33 +1522,23 @@ print(f"-- [GIẢ ĐỊNH] Giá vốn mới: {NEW_COGS_PER_ITEM:,.0f} đ / 1 ly"
 # --- BƯỚC 1: TẢI VÀ TỔNG HỢP DỮ LIỆU (TẠO BẢNG HUẤN LUYỆN 2024) ---
 print("\n-- [BƯỚC 1] Đang tải và tạo Bảng dữ liệu huấn luyện (2024)... --")
 try:
-    df_trans = pd.read_csv('transaction_data.csv')
-    df_prod = pd.read_csv('product_master.csv') # Cần để lấy giá niêm yết
-    df_macro = pd.read_csv('macro_context.csv')
+    # Kho chuỗi memmap (store x product x ngày) của trans + prod, tự ghi lại khi CSV đổi
+    series = load_series_store('.', verbose=True)
+    df_macro = load_table('macro_context')
 except FileNotFoundError:
     print("LỖI: Không tìm thấy tệp CSV. Vui lòng đảm bảo 3 tệp (trans, prod, macro) nằm trong cùng thư mục.")
     # exit()
 
 # (Thực hiện các bước chuẩn bị dữ liệu như trước)
-df_trans['Date_Time'] = pd.to_datetime(df_trans['Date_Time'])
-df_trans['Date'] = df_trans['Date_Time'].dt.date.astype(str)
-df_macro['Date'] = pd.to_datetime(df_macro['Date']).dt.date.astype(str)
-
-df_trans = pd.merge(
-    df_trans,
-    df_prod[['Product_ID', 'Unit_Price_List']],
-    on='Product_ID',
-    how='left'
-)
-df_trans = df_trans.rename(columns={'Unit_Price_Listed': 'Unit_Price_Recorded', 'Unit_Price_List': 'Unit_Price_Master'})
-df_trans['Unit_Price_Master'] = df_trans['Unit_Price_Master'].fillna(df_trans['Unit_Price_Recorded'])
-df_trans['Total_List_Price'] = df_trans['Quantity'] * df_trans['Unit_Price_Master']
+df_macro['Date'] = df_macro['Date'].dt.strftime('%Y-%m-%d')
 
-df_daily_agg = df_trans.groupby('Date').agg(
-    Total_Quantity=('Quantity', 'sum'),
-    Total_Paid_Agg=('Total_Paid', 'sum'),
-    Total_List_Price_Agg=('Total_List_Price', 'sum')
-).reset_index()
+# Nguồn df_daily_agg: 'series' = kho chuỗi ở trên (mặc định) | 'stream' = tổng hợp khi đọc
+# transaction_data.csv theo chunk (streaming_aggregates.py), cùng kết quả với daily_table
+AGGREGATE_SOURCE = 'series'
+if AGGREGATE_SOURCE == 'stream':
+    df_daily_agg = stream_aggregates('transaction_data.csv', df_product=load_table('product_master'))['df_daily_agg']
+else:
+    df_daily_agg = daily_table(series)
 
 df_daily_agg = df_daily_agg[df_daily_agg['Total_List_Price_Agg'] > 0]
 df_daily_agg['Price_Index'] = df_daily_agg['Total_Paid_Agg'] / df_daily_agg['Total_List_Price_Agg']
@@ -1407,6 +1624,14 @@ model_xgb.fit(X_train, Y_train)
 pred_xgb = model_xgb.predict(X_test)
 test_predictions['XGB'] = calculate_metrics("XGBoost", Y_test, pred_xgb)
 
+# 3b. XGBoost + đặc trưng trễ (lag / rolling / EWMA), dự báo đệ quy từng ngày của tập Test
+lag_feature_cols = feature_cols + lag_feature_names()
+train_lag = add_lag_features(train_data).dropna(subset=lag_feature_cols)
+model_xgb_lag = XGBRegressor(n_estimators=100, random_state=42, n_jobs=-1, objective='reg:squarederror')
+model_xgb_lag.fit(train_lag[lag_feature_cols], train_lag[target_col])
+pred_xgb_lag = recursive_forecast(model_xgb_lag, train_data, test_data.drop(columns=[target_col]), lag_feature_cols)
+test_predictions['XGB_LAG'] = calculate_metrics("XGBoost + Lag", Y_test, pred_xgb_lag)
+
 # 4. LSTM
 scaler_X_eval = MinMaxScaler()
 scaler_Y_eval = MinMaxScaler()
@@ -1640,8 +1865,10 @@ from IPython.display import display, Markdown
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 
 # [MỚI] Thư viện Tinh chỉnh
-from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import TimeSeriesSplit # [QUAN TRỌNG] Dùng cho chuỗi thời gian
+# Tìm kiếm tham số: chia lõi CPU, successive halving theo fold, XGBoost dừng sớm - file tuning_engine.py
+from tuning_engine import (tune_model, EARLY_STOPPING_ROUNDS,
+                           warm_start_model, warm_start_keras, WARM_START_EPOCHS)
 
 # Thư viện 4 Mô hình
 from sklearn.linear_model import LinearRegression
@@ -1659,6 +1886,11 @@ from tensorflow.keras.callbacks import EarlyStopping
 # Thư viện Đánh giá
 from sklearn.metrics import r2_score, mean_absolute_error, mean_absolute_percentage_error, mean_squared_error
 
+# Lớp truy cập dữ liệu (cache Parquet) - file data_access.py cùng thư mục
+from data_access import load_table
+from series_store import load_series_store, daily_table
+from streaming_aggregates import stream_aggregates
+
 # Cài đặt
 pd.set_option('display.float_format', '{:.2f}'.format)
 warnings.filterwarnings('ignore')
@@ -1683,33 +1915,23 @@ print(f"-- [GIẢ ĐỊNH] Giá vốn mới: {NEW_COGS_PER_ITEM:,.0f} đ / 1 ly"
 # --- BƯỚC 1: TẢI VÀ TỔNG HỢP DỮ LIỆU (TẠO BẢNG HUẤN LUYỆN 2024) ---
 print("\n-- [BƯỚC 1] Đang tải và tạo Bảng dữ liệu huấn luyện (2024)... --")
 try:
-    df_trans = pd.read_csv('transaction_data.csv')
-    df_prod = pd.read_csv('product_master.csv') # Cần để lấy giá niêm yết
-    df_macro = pd.read_csv('macro_context.csv')
+    # Kho chuỗi memmap (store x product x ngày) của trans + prod, tự ghi lại khi CSV đổi
+    series = load_series_store('.', verbose=True)
+    df_macro = load_table('macro_context')
 except FileNotFoundError:
     print("LỖI: Không tìm thấy tệp CSV. Vui lòng đảm bảo 3 tệp (trans, prod, macro) nằm trong cùng thư mục.")
     # exit()
 
 # (Thực hiện các bước chuẩn bị dữ liệu như trước)
-df_trans['Date_Time'] = pd.to_datetime(df_trans['Date_Time'])
-df_trans['Date'] = df_trans['Date_Time'].dt.date.astype(str)
-df_macro['Date'] = pd.to_datetime(df_macro['Date']).dt.date.astype(str)
-
-df_trans = pd.merge(
-    df_trans,
-    df_prod[['Product_ID', 'Unit_Price_List']],
-    on='Product_ID',
-    how='left'
-)
-df_trans = df_trans.rename(columns={'Unit_Price_Listed': 'Unit_Price_Recorded', 'Unit_Price_List': 'Unit_Price_Master'})
-df_trans['Unit_Price_Master'] = df_trans['Unit_Price_Master'].fillna(df_trans['Unit_Price_Recorded'])
-df_trans['Total_List_Price'] = df_trans['Quantity'] * df_trans['Unit_Price_Master']
+df_macro['Date'] = df_macro['Date'].dt.strftime('%Y-%m-%d')
 
-df_daily_agg = df_trans.groupby('Date').agg(
-    Total_Quantity=('Quantity', 'sum'),
-    Total_Paid_Agg=('Total_Paid', 'sum'),
-    Total_List_Price_Agg=('Total_List_Price', 'sum')
-).reset_index()
+# Nguồn df_daily_agg: 'series' = kho chuỗi ở trên (mặc định) | 'stream' = tổng hợp khi đọc
+# transaction_data.csv theo chunk (streaming_aggregates.py), cùng kết quả với daily_table
+AGGREGATE_SOURCE = 'series'
+if AGGREGATE_SOURCE == 'stream':
+    df_daily_agg = stream_aggregates('transaction_data.csv', df_product=load_table('product_master'))['df_daily_agg']
+else:
+    df_daily_agg = daily_table(series)
 
 df_daily_agg = df_daily_agg[df_daily_agg['Total_List_Price_Agg'] > 0]
 df_daily_agg['Price_Index'] = df_daily_agg['Total_Paid_Agg'] / df_daily_agg['Total_List_Price_Agg']
@@ -1802,18 +2024,17 @@ param_dist_rf = {
     'max_features': ['sqrt', 'log2', 1.0] # 1.0 là tương đương "auto" cũ
 }
 model_rf = RandomForestRegressor(random_state=42)
-random_search_rf = RandomizedSearchCV(
-    estimator=model_rf,
-    param_distributions=param_dist_rf,
-    n_iter=30, # [MỚI] Tăng số lần thử lên 30
+tuned_rf = tune_model(
+    model_rf,
+    param_dist_rf,
+    X_train, Y_train,
     cv=tscv,   # [MỚI] Dùng TimeSeriesSplit
-    scoring='neg_mean_absolute_percentage_error', # Tối ưu theo MAPE
+    n_iter=30, # [MỚI] Tăng số lần thử lên 30 (successive halving loại dần ứng viên kém)
     random_state=42,
-    n_jobs=-1,
-    verbose=0
+    n_jobs=-1, # Tổng số lõi, chia giữa các process tìm kiếm và luồng của model
+    verbose=True
 )
-random_search_rf.fit(X_train, Y_train)
-best_model_rf = random_search_rf.best_estimator_ # Đây là model RF tốt nhất
+best_model_rf = tuned_rf['best_estimator'] # Đây là model RF tốt nhất (tối ưu theo MAPE)
 pred_rf = best_model_rf.predict(X_test)
 test_predictions['RF'] = calculate_metrics("Random Forest (Tuned)", Y_test, pred_rf)
 best_model_objects['RF'] = best_model_rf # Lưu lại model TỐT NHẤT
@@ -1829,18 +2050,18 @@ param_dist_xgb = {
     'gamma': [0, 0.1, 0.2]
 }
 model_xgb = XGBRegressor(random_state=42, n_jobs=-1, objective='reg:squarederror')
-random_search_xgb = RandomizedSearchCV(
-    estimator=model_xgb,
-    param_distributions=param_dist_xgb,
-    n_iter=30, # [MỚI] Tăng số lần thử lên 30
+tuned_xgb = tune_model(
+    model_xgb,
+    param_dist_xgb,
+    X_train, Y_train,
     cv=tscv,   # [MỚI] Dùng TimeSeriesSplit
-    scoring='neg_mean_absolute_percentage_error',
+    n_iter=30, # [MỚI] Tăng số lần thử lên 30
+    early_stopping_rounds=EARLY_STOPPING_ROUNDS, # n_estimators = số cây khi dừng sớm (trung bình các fold)
     random_state=42,
     n_jobs=-1,
-    verbose=0
+    verbose=True
 )
-random_search_xgb.fit(X_train, Y_train)
-best_model_xgb = random_search_xgb.best_estimator_ # Đây là model XGB tốt nhất
+best_model_xgb = tuned_xgb['best_estimator'] # Đây là model XGB tốt nhất
 pred_xgb = best_model_xgb.predict(X_test)
 test_predictions['XGB'] = calculate_metrics("XGBoost (Tuned)", Y_test, pred_xgb)
 best_model_objects['XGB'] = best_model_xgb # Lưu lại model TỐT NHẤT
@@ -1863,6 +2084,8 @@ model_lstm.fit(X_train_lstm_eval, Y_train_scaled_eval, epochs=30, batch_size=32,
 pred_lstm_scaled = model_lstm.predict(X_test_lstm_eval, verbose=0)
 pred_lstm = scaler_Y_eval.inverse_transform(pred_lstm_scaled).flatten()
 test_predictions['LSTM'] = calculate_metrics("LSTM", Y_test, pred_lstm)
+best_model_objects['LSTM'] = model_lstm # Lưu lại model + scaler để học tiếp ở Giai đoạn B
+best_model_objects['LSTM_scalers'] = (scaler_X_eval, scaler_Y_eval)
 
 # --- BƯỚC 4: BÁO CÁO ĐÁNH GIÁ (R2, MAPE) ---
 df_evaluation_report = pd.DataFrame(evaluation_results).set_index("Model")
@@ -1914,9 +2137,14 @@ print("="*50)
 # --- BƯỚC 6: HUẤN LUYỆN LẠI TRÊN TOÀN BỘ DỮ LIỆU 2024 VÀ DỰ BÁO ---
 print("\n-- [BƯỚC 6] Đang huấn luyện lại 4 mô hình trên TOÀN BỘ dữ liệu 2024... --")
 
+# 'warm': học tiếp các model trong best_model_objects (đã fit trên 10 tháng) với 2 tháng mới
+# 'full': fit lại từ đầu với tham số tốt nhất
+RETRAIN_MODE = 'warm'
+
 # Dữ liệu huấn luyện (full)
 Y_train_full = df_train_2024_full[target_col]
 X_train_full = df_train_2024_full[feature_cols]
+n_prev_rows = len(X_train) # Số dòng các model Giai đoạn A đã học
 
 # Dữ liệu tương lai (Q1/2025)
 df_future_2025 = pd.DataFrame(index=pd.date_range(start='2025-01-01', periods=90, freq='D'))
@@ -1949,10 +2177,14 @@ forecast_results['LR_B'] = pred_B_lr
 models_summary['Linear Regression'] = (pred_A_lr.sum(), pred_B_lr.sum())
 
 print("... [2/4] Re-train Random Forest (với tham số Tốt nhất)...")
-# Tạo model RF mới với tham số tốt nhất từ Giai đoạn A và fit trên 100% data
-best_params_rf = random_search_rf.best_params_
-model_rf_final = RandomForestRegressor(random_state=42, n_jobs=-1, **best_params_rf)
-model_rf_final.fit(X_train_full, Y_train_full) # Fit trên 100% data
+best_params_rf = tuned_rf['best_params']
+if RETRAIN_MODE == 'warm':
+    # Giữ các cây của model tốt nhất, thêm cây fit trên 100% data (warm_start)
+    model_rf_final = warm_start_model(best_model_objects['RF'], X_train_full, Y_train_full, n_prev_rows)
+else:
+    # Tạo model RF mới với tham số tốt nhất từ Giai đoạn A và fit trên 100% data
+    model_rf_final = RandomForestRegressor(random_state=42, n_jobs=-1, **best_params_rf)
+    model_rf_final.fit(X_train_full, Y_train_full) # Fit trên 100% data
 pred_A_rf = model_rf_final.predict(X_future_A)
 pred_B_rf = model_rf_final.predict(X_future_B)
 forecast_results['RF_A'] = pred_A_rf
@@ -1960,10 +2192,14 @@ forecast_results['RF_B'] = pred_B_rf
 models_summary['Random Forest (Tuned)'] = (pred_A_rf.sum(), pred_B_rf.sum())
 
 print("... [3/4] Re-train XGBoost (với tham số Tốt nhất)...")
-# Tạo model XGB mới với tham số tốt nhất và fit trên 100% data
-best_params_xgb = random_search_xgb.best_params_
-model_xgb_final = XGBRegressor(random_state=42, n_jobs=-1, objective='reg:squarederror', **best_params_xgb)
-model_xgb_final.fit(X_train_full, Y_train_full) # Fit trên 100% data
+best_params_xgb = tuned_xgb['best_params']
+if RETRAIN_MODE == 'warm':
+    # Boost thêm cây từ booster của model tốt nhất (xgb_model) trên 100% data
+    model_xgb_final = warm_start_model(best_model_objects['XGB'], X_train_full, Y_train_full, n_prev_rows)
+else:
+    # Tạo model XGB mới với tham số tốt nhất và fit trên 100% data
+    model_xgb_final = XGBRegressor(random_state=42, n_jobs=-1, objective='reg:squarederror', **best_params_xgb)
+    model_xgb_final.fit(X_train_full, Y_train_full) # Fit trên 100% data
 pred_A_xgb = model_xgb_final.predict(X_future_A)
 pred_B_xgb = model_xgb_final.predict(X_future_B)
 forecast_results['XGB_A'] = pred_A_xgb
@@ -1971,18 +2207,28 @@ forecast_results['XGB_B'] = pred_B_xgb
 models_summary['XGBoost (Tuned)'] = (pred_A_xgb.sum(), pred_B_xgb.sum())
 
 print("... [4/4] Re-train LSTM ...")
-# LSTM cũng được fit lại trên 100% data
-scaler_X_full = MinMaxScaler()
-scaler_Y_full = MinMaxScaler()
-X_train_scaled_full = scaler_X_full.fit_transform(X_train_full)
-Y_train_scaled_full = scaler_Y_full.fit_transform(Y_train_full.values.reshape(-1, 1))
+if RETRAIN_MODE == 'warm':
+    # Giữ scaler của Giai đoạn A để trọng số cũ vẫn đúng thang đo, học tiếp vài epoch
+    scaler_X_full, scaler_Y_full = best_model_objects['LSTM_scalers']
+    X_train_scaled_full = scaler_X_full.transform(X_train_full)
+    Y_train_scaled_full = scaler_Y_full.transform(Y_train_full.values.reshape(-1, 1))
+else:
+    # LSTM cũng được fit lại trên 100% data
+    scaler_X_full = MinMaxScaler()
+    scaler_Y_full = MinMaxScaler()
+    X_train_scaled_full = scaler_X_full.fit_transform(X_train_full)
+    Y_train_scaled_full = scaler_Y_full.fit_transform(Y_train_full.values.reshape(-1, 1))
 X_train_lstm_full = X_train_scaled_full.reshape((X_train_scaled_full.shape[0], 1, X_train_scaled_full.shape[1]))
-# Tạo model LSTM mới
-model_lstm_final = Sequential()
-model_lstm_final.add(LSTM(50, activation='relu', input_shape=(X_train_lstm_full.shape[1], X_train_lstm_full.shape[2])))
-model_lstm_final.add(Dense(1))
-model_lstm_final.compile(optimizer='adam', loss='mse')
-model_lstm_final.fit(X_train_lstm_full, Y_train_scaled_full, epochs=30, batch_size=32, verbose=0, callbacks=[early_stop]) # Tăng epochs
+if RETRAIN_MODE == 'warm':
+    model_lstm_final = warm_start_keras(best_model_objects['LSTM'], X_train_lstm_full, Y_train_scaled_full,
+                                        epochs=WARM_START_EPOCHS, callbacks=[early_stop])
+else:
+    # Tạo model LSTM mới
+    model_lstm_final = Sequential()
+    model_lstm_final.add(LSTM(50, activation='relu', input_shape=(X_train_lstm_full.shape[1], X_train_lstm_full.shape[2])))
+    model_lstm_final.add(Dense(1))
+    model_lstm_final.compile(optimizer='adam', loss='mse')
+    model_lstm_final.fit(X_train_lstm_full, Y_train_scaled_full, epochs=30, batch_size=32, verbose=0, callbacks=[early_stop]) # Tăng epochs
 
 X_future_A_scaled = scaler_X_full.transform(X_future_A)
 X_future_B_scaled = scaler_X_full.transform(X_future_B)
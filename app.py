@@ -3,6 +3,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from data_access import load_table
+
 # --- 1. Cấu hình trang ---
 st.set_page_config(page_title="Highlands Pricing Strategy", layout="wide")
 st.title("☕ Highlands Coffee - Chiến lược Tối ưu hóa Giá")
@@ -11,9 +13,9 @@ st.title("☕ Highlands Coffee - Chiến lược Tối ưu hóa Giá")
 @st.cache_data
 def load_data():
     try:
-        # Đọc dữ liệu từ file csv nằm cùng thư mục
-        df = pd.read_csv('transaction_data.csv')
-        cus = pd.read_csv('customer_profile.csv')
+        # Đọc dữ liệu từ file csv nằm cùng thư mục (qua cache Parquet của data_access.py)
+        df = load_table('transaction_data')
+        cus = load_table('customer_profile')
         return df, cus
     except FileNotFoundError:
         return None, None
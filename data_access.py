@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Lớp truy cập dữ liệu dùng chung cho EDA, Cluster/Optimize/Forecast và app.
+
+Mỗi file CSV chỉ parse 1 lần rồi được lưu thành Parquet (đã ép kiểu: ngày giờ
+đã parse, các ID dạng category). Những lần sau đọc thẳng từ cache, cache tự
+hết hạn khi file CSV thay đổi (kích thước / mtime / hash nội dung).
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (engine cho Parquet)
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    # Không có pyarrow -> dùng pickle của pandas (vẫn giữ nguyên dtype)
+    CACHE_FORMAT = "pickle"
+CACHE_EXT = "parquet" if CACHE_FORMAT == "parquet" else "pkl"
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+CACHE_DIR_NAME = ".hl_cache"
+CACHE_SCHEMA_VERSION = 1   # Tăng khi đổi TABLE_SCHEMAS để vô hiệu cache cũ
+HASH_CHUNK_SIZE = 1 << 20  # Đọc 1MB mỗi lần khi tính hash
+
+# Kiểu dữ liệu cho từng bảng đầu vào
+TABLE_SCHEMAS = {
+    "transaction_data": {
+        "parse_dates": ["Date_Time"],
+        "category_cols": ["Transaction_ID", "Customer_ID", "Product_ID", "Store_ID"],
+    },
+    "customer_profile": {
+        "parse_dates": [],
+        "category_cols": [],
+    },
+    "product_master": {
+        "parse_dates": [],
+        "category_cols": [],
+    },
+    "macro_context": {
+        "parse_dates": ["Date"],
+        "category_cols": [],
+    },
+}
+
+
+# ==============================
+# 1. FINGERPRINT FILE NGUỒN
+# ==============================
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, with_hash=True):
+    st = os.stat(path)
+    fp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if with_hash:
+        fp["hash"] = file_hash(path)
+    return fp
+
+
+def fingerprint_matches(path, source_fp):
+    """
+    So file hiện tại với fingerprint đã lưu. Trả về (khớp?, fingerprint mới
+    nếu phải tính lại hash - để người gọi cập nhật mtime, ngược lại None).
+    """
+    # Kiểm tra nhanh bằng size + mtime; chỉ tính hash khi hai giá trị này đổi
+    quick = file_fingerprint(path, with_hash=False)
+    if quick["size"] == source_fp.get("size") and quick["mtime_ns"] == source_fp.get("mtime_ns"):
+        return True, None
+    if quick["size"] != source_fp.get("size"):
+        return False, None
+
+    # Cùng kích thước nhưng mtime khác (vd. copy lại file) -> so hash nội dung
+    full = file_fingerprint(path, with_hash=True)
+    return full["hash"] == source_fp.get("hash"), full
+
+
+# ==============================
+# 2. ĐỌC CSV (KHÔNG CACHE)
+# ==============================
+
+def read_csv_typed(path, table_name):
+    """Đọc CSV và ép kiểu theo TABLE_SCHEMAS (datetime, category)."""
+    schema = TABLE_SCHEMAS.get(table_name, {"parse_dates": [], "category_cols": []})
+    df = pd.read_csv(path)
+
+    for c in schema["parse_dates"]:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c], errors="coerce")
+
+    # Ép category SAU khi parse để giữ kiểu gốc của categories
+    # (vd. Customer_ID vẫn là số, merge được với customer_profile)
+    for c in schema["category_cols"]:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    return df
+
+
+# ==============================
+# 3. CACHE
+# ==============================
+
+def _cache_paths(cache_dir, table_name):
+    data_path = os.path.join(cache_dir, f"{table_name}.{CACHE_EXT}")
+    meta_path = os.path.join(cache_dir, f"{table_name}.meta.json")
+    return data_path, meta_path
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_meta(meta_path, source_fp):
+    meta = {"schema_version": CACHE_SCHEMA_VERSION, "format": CACHE_FORMAT, "source": source_fp}
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def _cache_is_valid(meta, csv_path, data_path, meta_path):
+    if meta is None or not os.path.exists(data_path):
+        return False
+    if meta.get("schema_version") != CACHE_SCHEMA_VERSION or meta.get("format") != CACHE_FORMAT:
+        return False
+
+    matches, refreshed = fingerprint_matches(csv_path, meta.get("source", {}))
+    if matches and refreshed is not None:
+        _write_meta(meta_path, refreshed)  # Cập nhật mtime để lần sau khỏi hash lại
+    return matches
+
+
+def write_frame(df, data_path):
+    tmp_path = data_path + ".tmp"
+    if CACHE_FORMAT == "parquet":
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, data_path)  # Ghi nguyên tử, tránh cache dở dang
+
+
+def read_frame(data_path):
+    if CACHE_FORMAT == "parquet":
+        return pd.read_parquet(data_path)
+    return pd.read_pickle(data_path)
+
+
+def load_table(table_name, data_dir=".", use_cache=True, cache_dir=None, verbose=False):
+    """
+    Đọc 1 bảng đầu vào (vd. "transaction_data") từ `data_dir`.
+    Lần đầu parse CSV và ghi cache; các lần sau đọc từ cache nếu CSV không đổi.
+    """
+    csv_path = os.path.join(data_dir, f"{table_name}.csv")
+    if not use_cache:
+        return read_csv_typed(csv_path, table_name)
+
+    cache_dir = cache_dir or os.path.join(data_dir, CACHE_DIR_NAME)
+    data_path, meta_path = _cache_paths(cache_dir, table_name)
+
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError(csv_path)
+
+    if _cache_is_valid(_read_meta(meta_path), csv_path, data_path, meta_path):
+        if verbose:
+            print(f"[cache] Đọc {table_name} từ {data_path}")
+        return read_frame(data_path)
+
+    if verbose:
+        print(f"[cache] Parse {csv_path} và ghi cache...")
+    source_fp = file_fingerprint(csv_path, with_hash=True)
+    df = read_csv_typed(csv_path, table_name)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_frame(df, data_path)
+        _write_meta(meta_path, source_fp)
+    except OSError as e:
+        # Thư mục chỉ đọc / tạm thời (vd. khi deploy): vẫn trả về bảng đã parse, chỉ không có cache
+        print(f"[cache] Không ghi được cache cho {table_name}: {e}")
+    return df
+
+
+def load_all_tables(data_dir=".", use_cache=True, cache_dir=None, verbose=False):
+    """Trả về (df_customer, df_trans, df_product, df_macro) — cùng thứ tự với load_raw_data."""
+    return tuple(
+        load_table(name, data_dir, use_cache=use_cache, cache_dir=cache_dir, verbose=verbose)
+        for name in ["customer_profile", "transaction_data", "product_master", "macro_context"]
+    )
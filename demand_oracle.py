@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Hàm cầu từ mô hình dự báo cho tối ưu hóa giá (optimization_engine, method="oracle").
+
+Thay công thức PED hằng số của BƯỚC 10 bằng 1 mô hình (registry model_backends,
+mặc định XGBoost) học lượng bán hằng ngày của từng SKU theo Price_Index và lịch
+(cuối tuần, lễ, khuyến mãi, tháng, thứ) từ kho chuỗi memmap. Không dùng đặc trưng
+trễ, nên lượng bán dự báo chỉ phụ thuộc (SKU, Price_Index, lịch):
+
+- Giá ứng viên -> Price_Index = giá / giá niêm yết của SKU, làm tròn theo bucket
+  không rộng hơn khoảng cách giữa 2 giá liền kề của lưới (bucket_width).
+- Kỳ dự báo được gom theo tổ hợp lịch duy nhất (vd. 90 ngày -> ~20 tổ hợp).
+- Dự báo được cache theo (SKU, bucket giá, lịch): mọi khóa còn thiếu của 1 lần
+  tối ưu được gửi trong 1 lần predict, các lần chạy sau (COGS khác) dùng lại cache.
+"""
+
+import numpy as np
+import pandas as pd
+
+from forecast_engine import MACRO_COLS, N_DAYS_FORECAST, future_frame, macro_features
+from model_backends import fit_model, predict_model
+from series_store import SERIES_DIR_NAME, open_series_store
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+PRICE_BUCKET = 0.0025            # Độ rộng bucket Price_Index tối đa của cache
+CALENDAR_COLS = MACRO_COLS + ["Month", "DayOfWeek"]
+ORACLE_FEATURE_COLS = ["Product_Code", "Price_Index"] + CALENDAR_COLS
+ORACLE_MODEL_PARAMS = {
+    # XGBoost: lượng bán không tăng khi Price_Index tăng (tránh tối ưu "ăn" nhiễu của mô hình)
+    "XGB": {"n_estimators": 300, "max_depth": 6, "learning_rate": 0.05,
+            "monotone_constraints": {"Price_Index": -1}},
+}
+
+
+# ==============================
+# 1. HUẤN LUYỆN MÔ HÌNH CẦU THEO SKU
+# ==============================
+
+def sku_daily_frame(series, macro):
+    """
+    Bảng dài SKU x ngày (cộng mọi cửa hàng): Product_Code, Date, Quantity, Price_Index + lịch.
+    Giữ ngày không bán; Price_Index của ngày đó lấy theo ngày bán gần nhất.
+    Trả về (bảng, mảng Product_ID có bán, giá niêm yết / đơn vị của từng SKU đó).
+    """
+    Q = np.asarray(series["Quantity"]).sum(axis=0)
+    paid = np.asarray(series["Total_Paid"]).sum(axis=0)
+    list_total = np.asarray(series["Total_List_Price"]).sum(axis=0)
+    sold = Q.sum(axis=1) > 0
+    Q, paid, list_total = Q[sold], paid[sold], list_total[sold]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        P = np.where(list_total > 0, paid / list_total, np.nan)
+    P = pd.DataFrame(P).ffill(axis=1).bfill(axis=1).fillna(1.0).to_numpy()
+
+    dates = series["dates"]
+    n_products, n_days = Q.shape
+    df = pd.DataFrame({
+        "Product_Code": np.repeat(np.arange(n_products), n_days),
+        "Date": np.tile(dates.to_numpy(), n_products),
+        "Quantity": Q.reshape(-1),
+        "Price_Index": P.reshape(-1),
+    })
+    df = df.join(macro.reindex(dates), on="Date")
+    df["Month"] = df["Date"].dt.month
+    df["DayOfWeek"] = df["Date"].dt.dayofweek
+    list_price = list_total.sum(axis=1) / Q.sum(axis=1)
+    return df.dropna(), series["products"][sold], list_price
+
+
+def fit_demand_oracle(df_macro, store_dir=SERIES_DIR_NAME, model="XGB", params=None, verbose=False):
+    """Mô hình cầu theo SKU (1 mô hình cho mọi SKU). Trả về dict dùng cho oracle_demand_fn."""
+    series = open_series_store(store_dir)
+    df, products, list_price = sku_daily_frame(series, macro_features(df_macro))
+    params = {**ORACLE_MODEL_PARAMS.get(model, {}), **(params or {})}
+    fitted = fit_model(model, df[ORACLE_FEATURE_COLS], df["Quantity"], **params)
+    if verbose:
+        print(f"[oracle] Mô hình cầu {model} cho {len(products)} SKU, {len(df):,} dòng SKU x ngày")
+    return {
+        "model_name": model,
+        "model": fitted,
+        "products": pd.Index(products),
+        "list_price": list_price,
+        "cache": {},   # (Product_Code, độ rộng bucket, bucket Price_Index, lịch) -> lượng bán / ngày
+    }
+
+
+# ==============================
+# 2. DỰ BÁO CÓ CACHE
+# ==============================
+
+def horizon_calendar(future_start, n_days=N_DAYS_FORECAST, promo_dates=None):
+    """Các tổ hợp lịch duy nhất của kỳ dự báo và số ngày của mỗi tổ hợp."""
+    df = future_frame(future_start, n_days)
+    if promo_dates is not None:
+        df["Promotion_Campaign"] = df.index.isin(pd.DatetimeIndex(promo_dates)).astype(int)
+    counts = df.groupby(CALENDAR_COLS, sort=False).size()
+    return counts.index.to_frame(index=False), counts.to_numpy()
+
+
+def bucket_width(price_index, max_bucket=PRICE_BUCKET):
+    """
+    max_bucket / 2^k nhỏ nhất không vượt khoảng cách nhỏ nhất giữa 2 Price_Index khác nhau
+    của cùng SKU: mỗi điểm lưới giá có dự báo riêng (không thành hàm bậc thang), và các lần
+    gọi có lưới giống nhau dùng chung bậc bucket (chung khóa cache).
+    """
+    gaps = np.diff(np.sort(price_index, axis=1), axis=1)
+    gaps = gaps[gaps > 0]
+    if not gaps.size or gaps.min() >= max_bucket:
+        return max_bucket
+    return max_bucket / 2.0 ** np.ceil(np.log2(max_bucket / gaps.min()))
+
+
+def predict_demand(oracle, product_ids, prices, calendar, counts):
+    """
+    Tổng lượng bán trên kỳ dự báo tại từng giá: prices (n, m) của n SKU -> (n, m).
+    SKU không có trong mô hình -> NaN. Chỉ các khóa chưa có trong cache được predict (1 lần).
+    """
+    prices = np.asarray(prices, dtype=float)
+    codes = oracle["products"].get_indexer(product_ids)
+    known = codes >= 0
+    total = np.full(prices.shape, np.nan)
+    if not known.any():
+        return total
+
+    price_index = prices[known] / oracle["list_price"][codes[known]][:, None]
+    bucket = bucket_width(price_index)
+    buckets = np.rint(price_index / bucket).astype(np.int64)
+    pairs = np.stack([np.broadcast_to(codes[known][:, None], buckets.shape).ravel(), buckets.ravel()], axis=1)
+    uniq, inverse = np.unique(pairs, axis=0, return_inverse=True)
+
+    cache = oracle["cache"]
+    cal_keys = list(calendar.itertuples(index=False, name=None))
+    keys = [(int(c), bucket, int(b), cal) for c, b in uniq for cal in cal_keys]
+    missing = [k for k in keys if k not in cache]
+    if missing:
+        X = pd.DataFrame([(c, b * w) + cal for c, w, b, cal in missing], columns=ORACLE_FEATURE_COLS)
+        pred = np.maximum(predict_model(oracle["model_name"], oracle["model"], X), 0)
+        cache.update(zip(missing, pred.tolist()))
+
+    per_day = np.fromiter((cache[k] for k in keys), dtype=float, count=len(keys)).reshape(len(uniq), len(cal_keys))
+    pair_total = per_day @ counts
+    total[known] = pair_total[inverse.ravel()].reshape(buckets.shape)
+    return total
+
+
+def oracle_demand_fn(oracle, future_start, n_days=N_DAYS_FORECAST, promo_dates=None):
+    """demand_fn(product_ids, prices) cho optimization_engine.optimize_prices_oracle."""
+    calendar, counts = horizon_calendar(future_start, n_days, promo_dates)
+
+    def demand_fn(product_ids, prices):
+        return predict_demand(oracle, product_ids, prices, calendar, counts)
+
+    return demand_fn
@@ -13,21 +13,62 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import matplotlib.ticker as ticker
 
+from data_access import load_all_tables
+from streaming_aggregates import stream_aggregates
+
 # ==============================
 # 0. CONFIG
 # ==============================
 
 CURRENT_YEAR = 2024  # dùng để tính Age từ YoB
 
+# Nguồn daily_kpis (Revenue & Profit per Day): "memory" = groupby trên df_master,
+# "stream" = tổng hợp khi đọc transaction_data.csv theo chunk (streaming_aggregates.py)
+AGGREGATE_SOURCE = "memory"
+
+# Kiểu dữ liệu gọn nhất an toàn cho từng cột của df_master (xem compact_dtypes)
+MASTER_SCHEMA = {
+    # Ngày (datetime.date dạng object -> datetime64, groupby / merge nhanh hơn nhiều)
+    "Date": "datetime64[s]",
+    # Cờ 0/1: uint8 vẫn map({0: ..., 1: ...}) và cộng / trung bình như int
+    "Is_Weekend_Trans": "uint8",
+    "Is_Weekend_Macro": "uint8",
+    "Is_Holiday_Flag": "uint8",
+    "Promotion_Campaign_Flag": "uint8",
+    "Used_Discount": "uint8",
+    # Lịch
+    "Year": "int16",
+    "Month": "int8",
+    "Day": "int8",
+    "Hour": "int8",
+    "DayOfWeek": "int8",
+    # Số lượng, giá / chi phí theo đơn vị (VND nguyên)
+    "Customer_ID": "int32",
+    "Quantity": "int16",
+    "Unit_Price_List": "int32",
+    "Unit_Price_Listed": "int32",
+    "COGS": "int32",
+    "Unit_Margin": "int32",
+    # Khách hàng
+    "YoB": "float32",
+    "Age": "Int8",
+    # Tỉ lệ / hệ số
+    "Discount_Rate": "float32",
+    "product_specific_mult": "float32",
+    "Margin_Rate": "float32",
+    "Macro_Monthly_Index": "float32",
+    # Các cột tiền theo giao dịch (Total_Paid, Gross_Revenue, ...) giữ float64:
+    # tổng cả năm ~1e11 VND, cộng dồn bằng float32 sẽ sai số
+    "Gross_Revenue": "float64",
+}
+
 # ==============================
 # 1. LOAD RAW DATA
 # ==============================
 
-def load_raw_data(data_dir="."):
-    df_customer = pd.read_csv(f"{data_dir}/customer_profile.csv")
-    df_trans    = pd.read_csv(f"{data_dir}/transaction_data.csv")
-    df_product  = pd.read_csv(f"{data_dir}/product_master.csv")
-    df_macro    = pd.read_csv(f"{data_dir}/macro_context.csv")
+def load_raw_data(data_dir=".", use_cache=True):
+    # Đọc qua cache Parquet (data_access.py); use_cache=False để parse lại CSV
+    df_customer, df_trans, df_product, df_macro = load_all_tables(data_dir, use_cache=use_cache)
     return df_customer, df_trans, df_product, df_macro
 
 
@@ -36,7 +77,8 @@ def load_raw_data(data_dir="."):
 # ==============================
 
 def preprocess_customer(df_customer, current_year=CURRENT_YEAR):
-    df = df_customer.copy()
+    # Bản sao nông: các bước dưới chỉ gán lại cả cột, không sửa bảng gốc
+    df = df_customer.copy(deep=False)
 
     # Chuẩn hóa tên cột: "Income level" -> "Income_Level"
     df = df.rename(columns={"Income level": "Income_Level"})
@@ -81,7 +123,7 @@ def preprocess_customer(df_customer, current_year=CURRENT_YEAR):
 # ==============================
 
 def preprocess_product(df_product):
-    df = df_product.copy()
+    df = df_product.copy(deep=False)
 
     # Clean text cơ bản
     text_cols = ["Product_Name", "Category", "Size"]
@@ -129,11 +171,13 @@ def preprocess_product(df_product):
 # ==============================
 
 def preprocess_transaction(df_trans):
-    df = df_trans.copy()
+    # Bảng lớn nhất: không sao chép dữ liệu, chỉ thêm / gán lại cột
+    df = df_trans.copy(deep=False)
 
     # 4.1. Chuẩn hóa datetime
     df["Date_Time"] = pd.to_datetime(df["Date_Time"], errors="coerce")
-    df = df.dropna(subset=["Date_Time"]).copy()
+    if df["Date_Time"].isna().any():
+        df = df.dropna(subset=["Date_Time"])
 
     # 4.2. Feature thời gian
     df["Date"]       = df["Date_Time"].dt.date
@@ -172,7 +216,7 @@ def preprocess_transaction(df_trans):
 # ==============================
 
 def preprocess_macro(df_macro):
-    df = df_macro.copy()
+    df = df_macro.copy(deep=False)
 
     # Date -> datetime.date
     df["Date"] = pd.to_datetime(df["Date"], errors="coerce").dt.date
@@ -202,47 +246,144 @@ def preprocess_macro(df_macro):
 # 6. BUILD MASTER TABLE
 # ==============================
 
+def _lookup_positions(keys, dim_keys):
+    """
+    Vị trí dòng trong bảng chiều (product / customer / macro) cho từng khóa
+    của transaction, -1 nếu không có. Khóa dạng category được ánh xạ trên
+    categories (vài nghìn giá trị) rồi tra theo mã số, không so chuỗi từng dòng.
+    """
+    dim_index = pd.Index(np.asarray(dim_keys))
+    if not dim_index.is_unique:
+        return None
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        cat_pos = dim_index.get_indexer(keys.cat.categories)
+        codes = keys.cat.codes.to_numpy()
+        return np.where(codes >= 0, cat_pos[codes], -1)
+    return dim_index.get_indexer(keys)
+
+
+def _take_column(series, positions, allow_fill=False):
+    # allow_fill: vị trí -1 -> NaN/NaT (int được nâng lên float như merge how="left")
+    values = series.array if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) else series.to_numpy()
+    values = pd.api.extensions.take(values, positions, allow_fill=allow_fill)
+    # Giữ nguyên dtype (vd. object không bị suy thành str)
+    return pd.Series(values, dtype=values.dtype, copy=False)
+
+
+def _merged_key_dtype(left_key, right_key):
+    # dtype của cột khóa sau merge (vd. 2 category khác categories -> kiểu giá trị),
+    # lấy từ 1 lần merge trên bảng rỗng
+    key = left_key.name
+    return pd.merge(left_key.iloc[:0].to_frame(), right_key.iloc[:0].to_frame(), on=key, how="left")[key].dtype
+
+
 def build_master_table(df_trans_clean, df_product_clean, df_customer_clean, df_macro_clean):
     """
-    Merge lần lượt:
-    transaction + product
-    -> + customer
-    -> + macro (theo Date)
+    Ghép transaction với product (Product_ID), customer (Customer_ID) và macro
+    (Date), sắp xếp theo Date_Time - cùng kết quả với 3 lần merge how="left"
+    rồi sort_values("Date_Time"), nhưng mỗi cột của df_master chỉ được tạo
+    đúng 1 lần (take theo vị trí đã sắp xếp), không có bảng trung gian.
     """
-    # 6.1. transaction + product
-    df_master = df_trans_clean.merge(
-        df_product_clean,
-        on="Product_ID",
-        how="left",
-        validate="many_to_one"  # nhiều giao dịch - 1 sản phẩm
-    )
+    # Thứ tự sắp xếp theo thời gian (cùng thuật toán với sort_values)
+    order = df_trans_clean["Date_Time"].reset_index(drop=True).sort_values().index.to_numpy()
+
+    columns = {c: _take_column(df_trans_clean[c], order) for c in df_trans_clean.columns}
+
+    dims = [
+        (df_product_clean, "Product_ID", "many_to_one"),  # nhiều giao dịch - 1 sản phẩm
+        (df_customer_clean, "Customer_ID", "many_to_one"),  # nhiều giao dịch - 1 khách hàng
+        (df_macro_clean, "Date", None),
+    ]
+    for df_dim, key, validate in dims:
+        positions = _lookup_positions(df_trans_clean[key], df_dim[key])
+        if positions is None:
+            if validate == "many_to_one":
+                raise pd.errors.MergeError(f"Khóa {key} bị trùng trong bảng chiều (cần many_to_one).")
+            # Khóa trùng (nhân dòng như merge) -> quay về cách merge cũ
+            df_master = pd.DataFrame(columns, copy=False)
+            df_master = df_master.merge(df_dim, on=key, how="left")
+            columns = {c: df_master[c] for c in df_master.columns}
+            continue
+
+        key_dtype = _merged_key_dtype(df_trans_clean[key], df_dim[key])
+        if columns[key].dtype != key_dtype:
+            columns[key] = columns[key].astype(key_dtype)
+
+        positions = positions[order]
+        for c in df_dim.columns:
+            if c == key:
+                continue
+            name = c
+            if c in columns:
+                # Trùng tên cột: giống hậu tố mặc định của merge
+                columns = {(f"{k}_x" if k == c else k): v for k, v in columns.items()}
+                name = f"{c}_y"
+            columns[name] = _take_column(df_dim[c], positions, allow_fill=True)
+
+    return pd.DataFrame(columns, copy=False)
 
-    # 6.2. + customer
-    df_master = df_master.merge(
-        df_customer_clean,
-        on="Customer_ID",
-        how="left",
-        validate="many_to_one"  # nhiều giao dịch - 1 khách hàng
-    )
 
-    # 6.3. + macro theo Date
-    df_master = df_master.merge(
-        df_macro_clean,
-        on="Date",
-        how="left"
-    )
+# ==============================
+# 7. COMPACT DTYPES
+# ==============================
 
-    # Sắp xếp theo thời gian
-    df_master = df_master.sort_values("Date_Time").reset_index(drop=True)
+def _fits_dtype(series, dtype):
+    # Chỉ ép kiểu số nguyên khi mọi giá trị nằm trong miền của kiểu đích
+    dtype = pd.api.types.pandas_dtype(dtype)
+    if dtype.kind not in "iu":
+        return True
+    nullable = hasattr(dtype, "numpy_dtype")
+    if not nullable and series.isna().any():
+        return False  # NaN không ép được sang int NumPy
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = pd.Series(series.cat.categories)  # Xét các giá trị có thể có của category
+    if series.dtype.kind == "b":
+        return True
+    if series.dtype.kind not in "iuf":
+        return False  # Chuỗi / object: giữ nguyên thay vì để astype báo lỗi
+    info = np.iinfo(dtype.numpy_dtype if nullable else dtype)
+    values = series.dropna()
+    if len(values) == 0:
+        return True
+    if series.dtype.kind == "f" and not np.array_equal(values, np.round(values)):
+        return False
+    return info.min <= values.min() and values.max() <= info.max
+
+
+def compact_dtypes(df, schema=MASTER_SCHEMA, verbose=False):
+    """
+    Ép các cột có trong `schema` về kiểu gọn hơn (downcast số, Date -> datetime64,
+    cờ -> uint8). Cột không ép được an toàn (tràn miền, số lẻ) được giữ nguyên.
+    Trả về DataFrame mới, không sửa `df`.
+    """
+    mem_before = df.memory_usage(deep=True).sum()
+    df = df.copy(deep=False)
+    skipped = []
+
+    for col, dtype in schema.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if str(dtype).startswith("datetime64"):
+            df[col] = pd.to_datetime(df[col]).astype(dtype)
+        elif _fits_dtype(df[col], dtype):
+            df[col] = df[col].astype(dtype)
+        else:
+            skipped.append(col)
 
-    return df_master
+    if verbose:
+        mem_after = df.memory_usage(deep=True).sum()
+        print(f"[dtypes] df_master: {mem_before / 1e6:,.1f} MB -> {mem_after / 1e6:,.1f} MB "
+              f"(giảm {1 - mem_after / mem_before:.0%})")
+        if skipped:
+            print("[dtypes] Giữ nguyên kiểu (không ép an toàn được):", skipped)
+    return df
 
 
 # ==============================
-# 7. RUN ALL – TIỀN XỬ LÍ FULL PIPELINE
+# 8. RUN ALL – TIỀN XỬ LÍ FULL PIPELINE
 # ==============================
 
-def run_full_pipeline(data_dir=".", current_year=CURRENT_YEAR, verbose=True):
+def run_full_pipeline(data_dir=".", current_year=CURRENT_YEAR, verbose=True, compact=True):
     # 1. Load
     df_customer_raw, df_trans_raw, df_product_raw, df_macro_raw = load_raw_data(data_dir)
 
@@ -260,6 +401,10 @@ def run_full_pipeline(data_dir=".", current_year=CURRENT_YEAR, verbose=True):
         df_macro_clean
     )
 
+    # 4. Schema gọn cho df_master
+    if compact:
+        df_master = compact_dtypes(df_master, verbose=verbose)
+
     if verbose:
         print("=== SHAPES ===")
         print("df_customer_clean:", df_customer_clean.shape)
@@ -282,7 +427,7 @@ def run_full_pipeline(data_dir=".", current_year=CURRENT_YEAR, verbose=True):
 
 
 # ==============================
-# 8. EXAMPLE USAGE
+# 9. EXAMPLE USAGE
 # ==============================
 
 if __name__ == "__main__":
@@ -623,14 +768,19 @@ print("...Column 'Transaction_Margin' created successfully.")
 
 
 # 2. Revenue & Profit per Day
-daily_kpis = (
-    df_master.groupby("Date")
-    .agg(
-        Daily_Revenue=("Total_Paid", "sum"),
-        Daily_Profit=("Transaction_Margin", "sum")
+if AGGREGATE_SOURCE == "stream":
+    daily_kpis = stream_aggregates("transaction_data.csv", df_product=dfs["df_product"])["daily_kpis"]
+    # Date dạng chuỗi -> cùng kiểu với df_master["Date"] (datetime64 sau compact_dtypes) để merge
+    daily_kpis["Date"] = pd.to_datetime(daily_kpis["Date"]).astype(df_master["Date"].dtype)
+else:
+    daily_kpis = (
+        df_master.groupby("Date")
+        .agg(
+            Daily_Revenue=("Total_Paid", "sum"),
+            Daily_Profit=("Transaction_Margin", "sum")
+        )
+        .reset_index()
     )
-    .reset_index()
-)
 print(daily_kpis.head())
 
 
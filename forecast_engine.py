@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""Dự báo nhu cầu theo từng chuỗi Store_ID x Product_ID (mở rộng BƯỚC 1 - 3 của file dự báo).
+
+Mỗi chuỗi dùng cùng bộ đặc trưng với mô hình toàn chuỗi cửa hàng
+(Price_Index, Is_Weekend, Is_Holiday, Promotion_Campaign, Month, DayOfWeek),
+dữ liệu lấy từ kho chuỗi memmap (series_store.py). Các chuỗi được chia thành lô
+và huấn luyện trên process pool; số lô đang chạy được giới hạn và kết quả của
+mỗi lô được ghi ra đĩa ngay khi xong, nên bộ nhớ không tăng theo số chuỗi.
+
+Chế độ toàn cục (fit_global_model / forecast_global): 1 XGBoost duy nhất trên
+bảng dài của mọi chuỗi (mã Store_ID, Product_ID là biến category + đặc trưng trễ),
+dự báo mọi chuỗi x ngày x kịch bản trong 1 lần predict.
+
+Mô hình lấy từ registry model_backends.py: XGBoost / TensorFlow chỉ được nạp khi
+mô hình tương ứng được chọn. Chạy từ dòng lệnh (vd. cron):
+
+    python forecast_engine.py --mode global
+    python forecast_engine.py --mode per_series --models LR,RF
+
+    .hl_forecast/
+        part-00000.parquet        (Store_ID, Product_ID, Date, LR_A, LR_B, RF_A, ...)
+        part-00001.parquet
+"""
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from threadpoolctl import threadpool_limits
+
+from data_access import CACHE_EXT, load_table, read_frame, write_frame
+from model_backends import MODEL_BACKENDS, add_models_argument, fit_model, parse_models, predict_model
+from series_store import SERIES_DIR_NAME, load_series_store, open_series_store, series_view
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+TARGET_COL = "Total_Quantity"
+FEATURE_COLS = ["Price_Index", "Is_Weekend", "Is_Holiday", "Promotion_Campaign", "Month", "DayOfWeek"]
+MACRO_COLS = ["Is_Weekend", "Is_Holiday", "Promotion_Campaign"]
+
+N_DAYS_FORECAST = 90
+DEFAULT_SCENARIOS = {"A": 0.95, "B": 1.02}   # Kịch bản Price_Index (giữ giá / tăng giá)
+DEFAULT_MODELS = ["LR", "RF", "XGB"]         # LSTM theo từng chuỗi quá nặng cho process pool
+
+# Mô hình toàn cục (1 XGBoost cho mọi chuỗi): đặc trưng trễ / trung bình trượt
+# kết thúc trước ngày cần dự báo ít nhất n_days ngày -> biết trước cho cả kỳ dự báo
+GLOBAL_EXTRA_LAGS = (0, 7)       # Qty_lag_{n_days + k}
+GLOBAL_ROLL_WINDOWS = (7, 28)    # Qty_roll_{w}: trung bình w ngày, kết thúc tại t - n_days
+GLOBAL_MODEL = "XGB"             # Backend (model_backends) của mô hình toàn cục
+GLOBAL_MODEL_PARAMS = {
+    "n_estimators": 300,
+    "learning_rate": 0.1,
+    "max_depth": 8,
+    "tree_method": "hist",
+    "enable_categorical": True,   # Store_ID, Product_ID dạng category
+    "objective": "reg:squarederror",
+    "random_state": 42,
+}
+
+MIN_SERIES_ROWS = 30          # Chuỗi có ít dòng giao dịch hơn -> bỏ qua
+SERIES_BATCH_SIZE = 32        # Số chuỗi mỗi tác vụ gửi sang process
+MAX_PENDING_PER_WORKER = 2    # Số lô tối đa đang chờ / chạy trên mỗi process
+FORECAST_DIR_NAME = ".hl_forecast"
+
+
+# ==============================
+# 1. BẢNG HUẤN LUYỆN / TƯƠNG LAI CHO 1 CHUỖI
+# ==============================
+
+def macro_features(df_macro):
+    """Bảng Date (Timestamp) -> Is_Weekend, Is_Holiday, Promotion_Campaign."""
+    macro = df_macro[["Date"] + MACRO_COLS].copy()
+    macro["Date"] = pd.to_datetime(macro["Date"])
+    return macro.set_index("Date")
+
+
+def series_training_frame(series, store, product, macro):
+    """
+    Bảng huấn luyện của 1 chuỗi, cùng cột với df_train_2024.
+    Khác bảng toàn chuỗi cửa hàng: giữ cả ngày không bán (Total_Quantity = 0) vì
+    cửa hàng cần dự báo cả ngày vắng; Price_Index của ngày đó lấy theo ngày bán gần nhất.
+    """
+    paid = series_view(series, "Total_Paid", store, product)
+    list_price = series_view(series, "Total_List_Price", store, product)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        price_index = np.where(list_price > 0, paid / list_price, np.nan)
+
+    df = pd.DataFrame({
+        TARGET_COL: np.asarray(series_view(series, "Quantity", store, product)),
+        "Price_Index": price_index,
+    }, index=series["dates"])
+    df["Price_Index"] = df["Price_Index"].ffill().bfill().fillna(1.0)
+    df = df.join(macro, how="left")
+    df["Month"] = df.index.month
+    df["DayOfWeek"] = df.index.dayofweek
+    return df.dropna()
+
+
+def future_frame(start, n_days=N_DAYS_FORECAST, price_index=1.0):
+    """Bảng đặc trưng tương lai (BƯỚC 2): không lễ, không khuyến mãi, Price_Index cố định."""
+    df = pd.DataFrame(index=pd.date_range(start=start, periods=n_days, freq="D"))
+    df["Price_Index"] = price_index
+    df["Is_Weekend"] = (df.index.dayofweek >= 5).astype(int)
+    df["Is_Holiday"] = 0
+    df["Promotion_Campaign"] = 0
+    df["Month"] = df.index.month
+    df["DayOfWeek"] = df.index.dayofweek
+    return df[FEATURE_COLS]
+
+
+# ==============================
+# 2. MÔ HÌNH
+# ==============================
+
+def _model_params(name, n_jobs=1):
+    # Trong process pool mỗi mô hình chạy 1 luồng; song song hóa ở cấp chuỗi
+    return {"n_jobs": n_jobs} if "n_jobs" in MODEL_BACKENDS[name]["defaults"] else {}
+
+
+def forecast_series(df_train, future_start, n_days=N_DAYS_FORECAST, scenarios=DEFAULT_SCENARIOS,
+                    models=DEFAULT_MODELS):
+    """Huấn luyện từng mô hình trên 1 chuỗi, dự báo mọi kịch bản. Cột: LR_A, LR_B, RF_A..."""
+    X_train = df_train[FEATURE_COLS]
+    Y_train = df_train[TARGET_COL]
+    futures = {name: future_frame(future_start, n_days, p) for name, p in scenarios.items()}
+
+    result = pd.DataFrame(index=pd.date_range(start=future_start, periods=n_days, freq="D"))
+    for model_name in models:
+        model = fit_model(model_name, X_train, Y_train, **_model_params(model_name))
+        for scenario, X_future in futures.items():
+            # Lượng bán không âm
+            result[f"{model_name}_{scenario}"] = np.maximum(predict_model(model_name, model, X_future), 0)
+    return result
+
+
+# ==============================
+# 3. HUẤN LUYỆN 1 LÔ CHUỖI (CHẠY TRONG PROCESS)
+# ==============================
+
+def _forecast_batch(task):
+    store_dir, pairs, macro, future_start, n_days, scenarios, models, n_threads = task
+    # Mỗi process tự mở memmap: chỉ các trang của chuỗi trong lô được nạp
+    series = open_series_store(store_dir)
+    frames = []
+    with threadpool_limits(limits=n_threads):
+        for store, product in pairs:
+            df_train = series_training_frame(series, store, product, macro)
+            if len(df_train) == 0:
+                continue
+            df = forecast_series(df_train, future_start, n_days, scenarios, models)
+            df = df.rename_axis("Date").reset_index()
+            df.insert(0, "Store_ID", store)
+            df.insert(1, "Product_ID", product)
+            frames.append(df)
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+# ==============================
+# 4. LỊCH HUẤN LUYỆN TOÀN BỘ CHUỖI
+# ==============================
+
+def series_pairs(series, min_rows=MIN_SERIES_ROWS):
+    """Các cặp (Store_ID, Product_ID) có ít nhất `min_rows` dòng giao dịch."""
+    s_idx, p_idx = np.nonzero(series["pair_rows"] >= min_rows)
+    return list(zip(series["stores"][s_idx], series["products"][p_idx]))
+
+
+def forecast_all_series(df_macro, store_dir=SERIES_DIR_NAME, out_dir=None, scenarios=DEFAULT_SCENARIOS,
+                        models=DEFAULT_MODELS, n_days=N_DAYS_FORECAST, future_start=None,
+                        min_rows=MIN_SERIES_ROWS, batch_size=SERIES_BATCH_SIZE, n_jobs=-1, verbose=False):
+    """
+    Dự báo mọi chuỗi Store_ID x Product_ID của kho chuỗi `store_dir`.
+
+    - n_jobs   : số process (-1 = tất cả CPU, 1 = tuần tự)
+    - out_dir  : ghi mỗi lô thành 1 file part-*.parquet và trả về out_dir
+                 (đọc lại bằng read_forecast_table); None -> trả về DataFrame
+    - future_start: ngày đầu dự báo, mặc định ngày sau ngày cuối của kho
+    """
+    series = open_series_store(store_dir)
+    pairs = series_pairs(series, min_rows)
+    if future_start is None:
+        future_start = series["dates"][-1] + pd.Timedelta(days=1)
+    macro = macro_features(df_macro)
+
+    batches = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(batches)))
+    n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+    tasks = ((store_dir, batch, macro, future_start, n_days, scenarios, models, n_threads) for batch in batches)
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(out_dir, f"part-*.{CACHE_EXT}")):
+            os.remove(path)  # Xóa kết quả của lần chạy trước
+    frames = []
+    n_done = 0
+
+    def _collect(df):
+        nonlocal n_done
+        n_done += 1
+        if df is not None:
+            if out_dir is not None:
+                write_frame(df, os.path.join(out_dir, f"part-{n_done - 1:05d}.{CACHE_EXT}"))
+            else:
+                frames.append(df)
+        if verbose:
+            print(f"  [forecast] Lô {n_done}/{len(batches)} xong")
+
+    if verbose:
+        print(f"[forecast] {len(pairs):,} chuỗi x {len(models)} mô hình, {len(batches)} lô, {n_jobs} process")
+    if n_jobs == 1:
+        for task in tasks:
+            _collect(_forecast_batch(task))
+    else:
+        # Chỉ giữ tối đa n_jobs * MAX_PENDING_PER_WORKER lô trong hàng đợi
+        max_pending = n_jobs * MAX_PENDING_PER_WORKER
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            pending = set()
+            for task in tasks:
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _collect(future.result())
+                pending.add(executor.submit(_forecast_batch, task))
+            for future in pending:
+                _collect(future.result())
+
+    if out_dir is not None:
+        return out_dir
+    if not frames:
+        return pd.DataFrame(columns=["Store_ID", "Product_ID", "Date"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_forecast_table(out_dir=FORECAST_DIR_NAME):
+    """Ghép các file part-* của forecast_all_series thành 1 bảng."""
+    paths = sorted(glob.glob(os.path.join(out_dir, f"part-*.{CACHE_EXT}")))
+    if not paths:
+        raise FileNotFoundError(f"Không có kết quả dự báo trong {out_dir}")
+    return pd.concat([read_frame(p) for p in paths], ignore_index=True)
+
+
+# ==============================
+# 5. MÔ HÌNH TOÀN CỤC (1 MÔ HÌNH CHO MỌI CHUỖI)
+# ==============================
+
+def _shift_days(A, k):
+    # Dịch mảng (chuỗi x ngày) sang phải k ngày: giá trị của ngày t - k
+    out = np.full(A.shape, np.nan)
+    if k < A.shape[1]:
+        out[:, k:] = A[:, :A.shape[1] - k]
+    return out
+
+
+def _rolling_mean_days(A, w):
+    # Trung bình w ngày kết thúc tại t (NaN nếu cửa sổ thiếu dữ liệu), dùng tổng tích lũy
+    finite = np.isfinite(A)
+    csum = np.zeros((A.shape[0], A.shape[1] + 1))
+    ccnt = np.zeros((A.shape[0], A.shape[1] + 1))
+    np.cumsum(np.where(finite, A, 0.0), axis=1, out=csum[:, 1:])
+    np.cumsum(finite, axis=1, out=ccnt[:, 1:])
+    out = np.full(A.shape, np.nan)
+    if w <= A.shape[1]:
+        total = csum[:, w:] - csum[:, :-w]
+        count = ccnt[:, w:] - ccnt[:, :-w]
+        out[:, w - 1:] = np.where(count == w, total / w, np.nan)
+    return out
+
+
+def global_lag_features(Q, lag_offset):
+    """
+    Đặc trưng trễ cho mọi chuỗi cùng lúc. Q: mảng (chuỗi x ngày), NaN ở các ngày
+    tương lai. Mọi đặc trưng của ngày t chỉ dùng Q đến ngày t - lag_offset.
+    """
+    feats = {}
+    for k in GLOBAL_EXTRA_LAGS:
+        feats[f"Qty_lag_{lag_offset + k}"] = _shift_days(Q, lag_offset + k)
+    for w in GLOBAL_ROLL_WINDOWS:
+        feats[f"Qty_roll_{w}"] = _shift_days(_rolling_mean_days(Q, w), lag_offset)
+    return feats
+
+
+def series_matrix(series, pairs):
+    # Lấy (chuỗi x ngày) của các cặp đã chọn: Quantity và Price_Index (ngày không bán -> ngày bán gần nhất)
+    s_idx = series["stores"].get_indexer([s for s, _ in pairs])
+    p_idx = series["products"].get_indexer([p for _, p in pairs])
+    Q = np.asarray(series["Quantity"][s_idx, p_idx, :], dtype=np.float64)
+    paid = series["Total_Paid"][s_idx, p_idx, :]
+    list_price = series["Total_List_Price"][s_idx, p_idx, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        P = np.where(list_price > 0, paid / list_price, np.nan)
+    P = pd.DataFrame(P).ffill(axis=1).bfill(axis=1).fillna(1.0).to_numpy()
+    return Q, P, s_idx, p_idx
+
+
+def long_frame(series, s_idx, p_idx, dates, columns):
+    """Ghép các mảng (chuỗi x ngày) thành bảng dài: 1 dòng / chuỗi / ngày."""
+    n_series, n_dates = len(s_idx), len(dates)
+    df = pd.DataFrame({
+        "Store_ID": pd.Categorical.from_codes(np.repeat(s_idx, n_dates), categories=series["stores"]),
+        "Product_ID": pd.Categorical.from_codes(np.repeat(p_idx, n_dates), categories=series["products"]),
+        "Date": np.tile(dates.to_numpy(), n_series),
+    })
+    for col, values in columns.items():
+        values = np.asarray(values)
+        df[col] = values.reshape(-1) if values.ndim == 2 else np.tile(values, n_series)
+    df["Month"] = df["Date"].dt.month
+    df["DayOfWeek"] = df["Date"].dt.dayofweek
+    return df
+
+
+def global_feature_cols(lag_offset=N_DAYS_FORECAST):
+    lag_cols = [f"Qty_lag_{lag_offset + k}" for k in GLOBAL_EXTRA_LAGS] + [f"Qty_roll_{w}" for w in GLOBAL_ROLL_WINDOWS]
+    return ["Store_ID", "Product_ID"] + FEATURE_COLS + lag_cols
+
+
+def fit_global_model(df_macro, store_dir=SERIES_DIR_NAME, n_days=N_DAYS_FORECAST,
+                     min_rows=MIN_SERIES_ROWS, params=None, verbose=False):
+    """
+    1 XGBoost huấn luyện trên bảng dài của mọi chuỗi Store_ID x Product_ID
+    (mã chuỗi + đặc trưng ngày / giá + trễ). Trả về dict dùng cho forecast_global.
+    """
+    series = open_series_store(store_dir)
+    pairs = series_pairs(series, min_rows)
+    Q, P, s_idx, p_idx = series_matrix(series, pairs)
+    dates = series["dates"]
+    macro = macro_features(df_macro).reindex(dates)
+
+    columns = {TARGET_COL: Q, "Price_Index": P}
+    columns.update({c: macro[c].to_numpy(dtype=np.float64) for c in MACRO_COLS})
+    columns.update(global_lag_features(Q, n_days))
+    df_train = long_frame(series, s_idx, p_idx, dates, columns).dropna()
+
+    feature_cols = global_feature_cols(n_days)
+    model = fit_model(GLOBAL_MODEL, df_train[feature_cols], df_train[TARGET_COL],
+                      **{**GLOBAL_MODEL_PARAMS, **(params or {})})
+    if verbose:
+        print(f"[global] 1 mô hình cho {len(pairs):,} chuỗi, {len(df_train):,} dòng huấn luyện")
+    return {
+        "model_name": GLOBAL_MODEL,
+        "model": model,
+        "feature_cols": feature_cols,
+        "pairs": pairs,
+        "store_dir": store_dir,
+        "n_days": n_days,
+    }
+
+
+def forecast_global(global_model, future_start=None, scenarios=DEFAULT_SCENARIOS, prefix="GLOBAL"):
+    """
+    Dự báo n_days ngày cho mọi chuỗi và mọi kịch bản bằng đúng 1 lần model.predict.
+    Kết quả cùng dạng với forecast_all_series: Store_ID, Product_ID, Date, GLOBAL_A, GLOBAL_B...
+    """
+    series = open_series_store(global_model["store_dir"])
+    n_days = global_model["n_days"]
+    Q, _, s_idx, p_idx = series_matrix(series, global_model["pairs"])
+    if future_start is None:
+        future_start = series["dates"][-1] + pd.Timedelta(days=1)
+
+    # Lưới lịch sử + tương lai để tính đặc trưng trễ cho các ngày tương lai
+    all_dates = pd.date_range(series["dates"][0], pd.Timestamp(future_start) + pd.Timedelta(days=n_days - 1), freq="D")
+    Q_all = np.full((len(s_idx), len(all_dates)), np.nan)
+    Q_all[:, :Q.shape[1]] = Q
+    lag_feats = global_lag_features(Q_all, n_days)
+    future_pos = all_dates.get_indexer(pd.date_range(future_start, periods=n_days, freq="D"))
+    future_cols = {name: values[:, future_pos] for name, values in lag_feats.items()}
+
+    frames = []
+    for scenario, price_index in scenarios.items():
+        X_future = future_frame(future_start, n_days, price_index)
+        columns = {c: X_future[c].to_numpy(dtype=np.float64) for c in FEATURE_COLS if c not in ("Month", "DayOfWeek")}
+        columns.update(future_cols)
+        df = long_frame(series, s_idx, p_idx, X_future.index, columns)
+        df["Scenario"] = scenario
+        frames.append(df)
+    df_future = pd.concat(frames, ignore_index=True)
+
+    # 1 lần predict cho mọi chuỗi x ngày x kịch bản
+    pred = predict_model(global_model["model_name"], global_model["model"], df_future[global_model["feature_cols"]])
+    df_future[prefix] = np.maximum(pred, 0)
+
+    result = df_future.pivot_table(index=["Store_ID", "Product_ID", "Date"], columns="Scenario",
+                                   values=prefix, observed=True, sort=True)
+    result.columns = [f"{prefix}_{c}" for c in result.columns]
+    result = result.reset_index()
+    for c in ["Store_ID", "Product_ID"]:
+        result[c] = result[c].astype(result[c].cat.categories.dtype)
+    return result
+
+
+# ==============================
+# 6. DÒNG LỆNH
+# ==============================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dự báo nhu cầu Q1 theo từng Store_ID x Product_ID.")
+    parser.add_argument("--mode", choices=["global", "per_series"], default="per_series",
+                        help="global: 1 XGBoost cho mọi chuỗi; per_series: mỗi chuỗi 1 bộ mô hình")
+    add_models_argument(parser, DEFAULT_MODELS)
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--out-dir", default=FORECAST_DIR_NAME)
+    parser.add_argument("--n-days", type=int, default=N_DAYS_FORECAST)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    args = parser.parse_args(argv)
+
+    models = parse_models(args.models)
+    # --mode global luôn dùng đúng 1 mô hình (GLOBAL_MODEL): chỉ nhận --models khi trùng mô hình đó
+    models_given = any(a == "--models" or a.startswith("--models=") for a in (sys.argv[1:] if argv is None else argv))
+    if args.mode == "global" and models_given and models != [GLOBAL_MODEL]:
+        parser.error(f"--mode global chỉ dùng {GLOBAL_MODEL}; --models {args.models} không áp dụng "
+                     f"(bỏ --models hoặc dùng --mode per_series)")
+    series = load_series_store(args.data_dir, verbose=True)
+    store_dir = os.path.join(args.data_dir, SERIES_DIR_NAME)
+    df_macro = load_table("macro_context", data_dir=args.data_dir)
+    out_dir = os.path.join(args.data_dir, args.out_dir)
+
+    if args.mode == "global":
+        global_model = fit_global_model(df_macro, store_dir, n_days=args.n_days, verbose=True)
+        df = forecast_global(global_model)
+        os.makedirs(out_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(out_dir, f"part-*.{CACHE_EXT}")):
+            os.remove(path)
+        write_frame(df, os.path.join(out_dir, f"part-00000.{CACHE_EXT}"))
+    else:
+        forecast_all_series(df_macro, store_dir, out_dir=out_dir, models=models, n_days=args.n_days,
+                            future_start=series["dates"][-1] + pd.Timedelta(days=1), n_jobs=args.n_jobs,
+                            verbose=True)
+    print(f"[forecast] Đã ghi kết quả vào {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
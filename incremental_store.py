@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""Kho trạng thái (state store) cho chế độ nối thêm từng ngày (daily append).
+
+Lưu trên đĩa các partial aggregates của streaming_aggregates:
+- theo khách hàng: ngày mua cuối, số đơn, tổng chi (-> rfm_df)
+- theo ngày và theo Date x Cluster x Category (-> df_train_2024, df_agg_cat_macro)
+- doanh thu theo cửa hàng
+Mỗi đêm chỉ cần đưa vào giao dịch của ngày mới: chi phí tính toán tỉ lệ với
+số dòng mới, không phải tính lại toàn bộ lịch sử.
+
+Chi phí mỗi đêm: phần tổng hợp giao dịch mới tỉ lệ với số dòng mới, nhưng
+_upsert_sum (nối khóa mới bằng concat) và save_state (ghi lại nguyên từng bảng)
+vẫn tỉ lệ với kích thước state, tức số khóa tổng hợp (khách hàng, ngày, ngày x
+cụm x Category) chứ không phải số dòng giao dịch: vài chục nghìn dòng sau nhiều năm.
+
+Job hằng đêm (dòng lệnh):
+
+    python incremental_store.py init                  # 1 lần, từ transaction_data.csv
+    python incremental_store.py append new_day.csv    # mỗi đêm
+
+Bước tính PED của phần Optimize (BƯỚC 7) đọc df_agg_cat từ state khi đặt
+AGGREGATE_SOURCE = 'state'.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_access import CACHE_EXT, load_table, read_csv_typed, read_frame, write_frame
+from model_registry import REGISTRY_DIR_NAME, SEGMENTATION_MODEL_NAME, load_segmentation_version, read_registry
+from streaming_aggregates import (
+    DEFAULT_CHUNKSIZE, chunk_partials, finalize_aggregates, product_lookup_table, stream_partials
+)
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+STATE_DIR_NAME = ".hl_state"
+STATE_SCHEMA_VERSION = 1
+STATE_TABLES = {
+    # tên bảng -> cột index
+    "customer": ["Customer_ID"],
+    "daily": ["Date"],
+    "store": ["Store_ID"],
+    "segment": ["Date", "Cluster", "Category"],
+}
+
+
+# ==============================
+# 1. KHỞI TẠO / LƯU / ĐỌC STATE
+# ==============================
+
+def init_state(transactions_path, df_product=None, customer_cluster=None, cluster_key=None,
+               chunksize=DEFAULT_CHUNKSIZE, verbose=False):
+    """
+    Tạo state từ toàn bộ lịch sử (đọc streaming, chỉ chạy 1 lần).
+    `cluster_key` ghi lại phiên bản nhãn cụm đã dùng cho bảng segment.
+    """
+    acc, seen = stream_partials(transactions_path, chunksize, df_product, customer_cluster, verbose)
+    return {
+        "acc": acc,
+        "last_transaction_ids": sorted(seen, key=str),
+        "cluster_key": cluster_key,
+    }
+
+
+def save_state(state, state_dir=STATE_DIR_NAME):
+    os.makedirs(state_dir, exist_ok=True)
+    acc = state["acc"]
+    for name in STATE_TABLES:
+        if name in acc:
+            write_frame(acc[name].reset_index(), os.path.join(state_dir, f"{name}.{CACHE_EXT}"))
+
+    meta = {
+        "schema_version": STATE_SCHEMA_VERSION,
+        "max_date_time": str(acc["max_date_time"]),
+        # Giữ nguyên kiểu ID (số hoặc chuỗi) để isin() khớp khi nạp lại
+        "last_transaction_ids": [t.item() if hasattr(t, "item") else t for t in state["last_transaction_ids"]],
+        "cluster_key": state.get("cluster_key"),
+    }
+    with open(os.path.join(state_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def load_state(state_dir=STATE_DIR_NAME):
+    meta_path = os.path.join(state_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(meta_path)
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("schema_version") != STATE_SCHEMA_VERSION:
+        raise ValueError(f"State tại {state_dir} khác phiên bản, cần chạy lại init_state.")
+
+    acc = {"max_date_time": pd.Timestamp(meta["max_date_time"])}
+    for name, keys in STATE_TABLES.items():
+        path = os.path.join(state_dir, f"{name}.{CACHE_EXT}")
+        if os.path.exists(path):
+            acc[name] = read_frame(path).set_index(keys)
+
+    return {
+        "acc": acc,
+        "last_transaction_ids": meta["last_transaction_ids"],
+        "cluster_key": meta.get("cluster_key"),
+    }
+
+
+# ==============================
+# 2. NỐI THÊM 1 NGÀY
+# ==============================
+
+def _upsert_sum(table, part, max_cols=()):
+    """
+    Cộng `part` vào `table` theo index: khóa đã có -> cộng dồn (hoặc lấy max với
+    `max_cols`), khóa mới -> nối thêm. Chỉ chạm vào các khóa có trong `part`.
+    """
+    if len(part) == 0:
+        return table
+    is_old = part.index.isin(table.index)
+    old_keys = part.index[is_old]
+
+    if len(old_keys):
+        current = table.loc[old_keys]
+        incoming = part.loc[old_keys, table.columns]
+        for col in table.columns:
+            if col in max_cols:
+                table.loc[old_keys, col] = np.maximum(current[col].to_numpy(), incoming[col].to_numpy())
+            else:
+                table.loc[old_keys, col] = current[col].to_numpy() + incoming[col].fillna(0).to_numpy()
+
+    if (~is_old).any():
+        table = pd.concat([table, part.loc[~is_old, table.columns]])
+    return table
+
+
+def append_day(state, df_new, df_product=None, customer_cluster=None, cluster_key=None):
+    """
+    Cập nhật state với giao dịch mới (1 ngày, hoặc vài ngày liền nhau).
+    `df_new` là DataFrame transaction_data (Date_Time đã parse) hoặc đường dẫn CSV.
+    Ngày đã có trong state sẽ bị từ chối để tránh cộng trùng khi chạy lại job.
+    """
+    if isinstance(df_new, str):
+        df_new = read_csv_typed(df_new, "transaction_data")
+    if len(df_new) == 0:
+        return state
+
+    acc = state["acc"]
+    if "segment" in acc and customer_cluster is None:
+        raise ValueError("State có bảng segment: cần truyền customer_cluster khi nối thêm ngày mới.")
+    if "segment" in acc and cluster_key != state.get("cluster_key"):
+        raise ValueError(
+            f"Nhãn cụm đã đổi ({state.get('cluster_key')} -> {cluster_key}): "
+            "bảng segment cần được tạo lại bằng init_state."
+        )
+
+    new_days = pd.to_datetime(df_new["Date_Time"]).dt.normalize().unique()
+    overlap = acc["daily"].index.intersection(pd.DatetimeIndex(new_days))
+    if len(overlap):
+        raise ValueError(f"Ngày đã được nạp trước đó: {[d.strftime('%Y-%m-%d') for d in overlap]}")
+
+    part = chunk_partials(
+        df_new,
+        product_lookup_table(df_product),
+        customer_cluster,
+        seen_transactions=set(state["last_transaction_ids"]),
+    )
+
+    acc["customer"] = _upsert_sum(acc["customer"], part["customer"], max_cols=("Last_Purchase",))
+    acc["daily"] = _upsert_sum(acc["daily"], part["daily"]).sort_index()
+    acc["store"] = _upsert_sum(acc["store"], part["store"])
+    if "segment" in part:
+        if "segment" in acc:
+            acc["segment"] = _upsert_sum(acc["segment"], part["segment"]).sort_index()
+        else:
+            acc["segment"] = part["segment"]
+    acc["max_date_time"] = max(acc["max_date_time"], part["max_date_time"])
+
+    state["last_transaction_ids"] = list(df_new["Transaction_ID"].unique())
+    state["cluster_key"] = cluster_key if "segment" in acc else state.get("cluster_key")
+    return state
+
+
+# ==============================
+# 3. XUẤT BẢNG CHO CÁC PIPELINE
+# ==============================
+
+def _macro_with_str_date(df_macro):
+    df = df_macro.copy()
+    df["Date"] = pd.to_datetime(df["Date"]).dt.strftime("%Y-%m-%d")
+    return df
+
+
+def build_agg_cat_macro(df_agg_cat, df_macro):
+    """Bảng đầu vào hồi quy PED (BƯỚC 7.3 - 7.4): Price_Index + biến kiểm soát."""
+    df = df_agg_cat[df_agg_cat["Total_List_Price_Agg"] > 0].copy()
+    df["Price_Index"] = df["Total_Paid_Agg"] / df["Total_List_Price_Agg"]
+    df = df[df["Price_Index"] > 0]
+    return pd.merge(
+        df,
+        _macro_with_str_date(df_macro)[["Date", "Promotion_Campaign", "Is_Weekend", "Is_Holiday", "Monthly_Index"]],
+        on="Date",
+        how="left"
+    )
+
+
+def build_daily_training_table(df_daily_agg, df_macro):
+    """Bảng huấn luyện dự báo theo ngày (BƯỚC 1.3 - 1.6 của file dự báo)."""
+    df = df_daily_agg[df_daily_agg["Total_List_Price_Agg"] > 0].copy()
+    df["Price_Index"] = df["Total_Paid_Agg"] / df["Total_List_Price_Agg"]
+    df = pd.merge(
+        df,
+        _macro_with_str_date(df_macro)[["Date", "Is_Weekend", "Is_Holiday", "Promotion_Campaign"]],
+        on="Date",
+        how="left"
+    )
+    df["Date"] = pd.to_datetime(df["Date"])
+    df = df.set_index("Date")
+    df["Month"] = df.index.month
+    df["DayOfWeek"] = df.index.dayofweek
+    return df.dropna()
+
+
+def state_tables(state, df_macro=None, snapshot_date=None):
+    """
+    Các bảng dùng trong pipeline: rfm_df, df_daily_agg, daily_kpis, rev_by_store,
+    df_agg_cat (nếu có nhãn cụm) và — khi có df_macro — df_agg_cat_macro, df_train.
+    """
+    tables = finalize_aggregates(state["acc"], snapshot_date=snapshot_date)
+    if df_macro is not None:
+        tables["df_train"] = build_daily_training_table(tables["df_daily_agg"], df_macro)
+        if "df_agg_cat" in tables:
+            tables["df_agg_cat_macro"] = build_agg_cat_macro(tables["df_agg_cat"], df_macro)
+    return tables
+
+
+# ==============================
+# 4. JOB HẰNG ĐÊM
+# ==============================
+
+def latest_segmentation_version(data_dir="."):
+    """Phiên bản mô hình phân khúc mới nhất trong registry (None nếu chưa có)."""
+    registry = read_registry(os.path.join(data_dir, REGISTRY_DIR_NAME), SEGMENTATION_MODEL_NAME)
+    return max([v["version"] for v in registry["versions"]], default=None)
+
+
+def _customer_cluster(version, data_dir="."):
+    if version is None:
+        return None
+    model = load_segmentation_version(version, data_dir)
+    return model["customer_clusters"].set_index("Customer_ID")["Cluster"]
+
+
+def build_state(data_dir=".", state_dir=None, segmentation_version=None, chunksize=DEFAULT_CHUNKSIZE,
+                verbose=False):
+    """
+    Tạo và lưu state từ transaction_data.csv của `data_dir`. Bảng segment dùng nhãn
+    cụm của `segmentation_version` (mặc định: phiên bản mới nhất trong registry).
+    """
+    state_dir = state_dir or os.path.join(data_dir, STATE_DIR_NAME)
+    if segmentation_version is None:
+        segmentation_version = latest_segmentation_version(data_dir)
+    state = init_state(
+        os.path.join(data_dir, "transaction_data.csv"),
+        df_product=load_table("product_master", data_dir=data_dir),
+        customer_cluster=_customer_cluster(segmentation_version, data_dir),
+        cluster_key=segmentation_version,
+        chunksize=chunksize,
+        verbose=verbose,
+    )
+    save_state(state, state_dir)
+    if verbose:
+        print(f"[state] Đã tạo state tại {state_dir} (nhãn cụm: v{segmentation_version})")
+    return state
+
+
+def run_nightly(df_new, data_dir=".", state_dir=None, snapshot_date=None, verbose=False):
+    """
+    Job hằng đêm: load_state -> append_day(df_new) -> save_state -> state_tables.
+    `df_new`: đường dẫn CSV (hoặc DataFrame) giao dịch của ngày mới. Nhãn cụm lấy
+    theo phiên bản đã dùng khi tạo state. Trả về các bảng của state_tables (kèm
+    df_agg_cat_macro, df_train) cho bước tính PED / định giá lại.
+    """
+    state_dir = state_dir or os.path.join(data_dir, STATE_DIR_NAME)
+    state = load_state(state_dir)
+    cluster_key = state.get("cluster_key")
+    state = append_day(
+        state, df_new,
+        df_product=load_table("product_master", data_dir=data_dir),
+        customer_cluster=_customer_cluster(cluster_key, data_dir),
+        cluster_key=cluster_key,
+    )
+    save_state(state, state_dir)
+
+    df_macro = load_table("macro_context", data_dir=data_dir)
+    tables = state_tables(state, df_macro=df_macro, snapshot_date=snapshot_date)
+    if verbose:
+        print(f"[state] Đã nối thêm đến {state['acc']['max_date_time']}: "
+              f"{len(tables['rfm_df']):,} khách hàng, {len(tables['df_daily_agg']):,} ngày")
+    return tables
+
+
+# ==============================
+# 5. DÒNG LỆNH
+# ==============================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kho trạng thái tổng hợp giao dịch nối thêm từng ngày.")
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--state-dir", default=None, help=f"mặc định: <data-dir>/{STATE_DIR_NAME}")
+    sub = parser.add_subparsers(dest="command", required=True)
+    init_parser = sub.add_parser("init", help="Tạo state từ toàn bộ transaction_data.csv")
+    init_parser.add_argument("--segmentation-version", type=int, default=None,
+                             help="Phiên bản nhãn cụm trong registry (mặc định: mới nhất)")
+    init_parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    append_parser = sub.add_parser("append", help="Nối thêm giao dịch của ngày mới vào state")
+    append_parser.add_argument("transactions", help="CSV giao dịch mới (cùng cột với transaction_data.csv)")
+    args = parser.parse_args(argv)
+
+    if args.command == "init":
+        build_state(args.data_dir, args.state_dir, args.segmentation_version, args.chunksize, verbose=True)
+    else:
+        run_nightly(args.transactions, args.data_dir, args.state_dir, verbose=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Đặc trưng tự hồi quy (lag, trung bình / độ lệch chuẩn trượt, EWMA) cho bảng huấn luyện theo ngày.
+
+Áp dụng cho bảng 1 chuỗi (df_train_2024, index Date) hoặc bảng dài nhiều chuỗi
+(group_cols = ["Store_ID", "Product_ID"]). Bảng được sắp xếp 1 lần theo
+(chuỗi, ngày); mọi cửa sổ được tính bằng dịch mảng / tổng tích lũy trên toàn bộ
+các chuỗi cùng lúc, không lặp Python theo chuỗi. Đặc trưng của ngày t chỉ dùng
+dữ liệu đến ngày t - 1, nên khi dự báo nhiều bước (recursive_forecast) giá trị
+dự báo của ngày t được đưa ngược vào làm đầu vào cho ngày t + 1.
+
+Giả định mỗi chuỗi có đủ các ngày liên tiếp (lag tính theo số dòng).
+"""
+
+import numpy as np
+import pandas as pd
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+LAG_SOURCE_COLS = ["Total_Quantity", "Price_Index"]
+LAGS = (1, 7, 14, 28)
+ROLL_WINDOWS = (7, 28)
+EWMA_SPANS = (7, 28)
+
+
+# ==============================
+# 1. TÊN ĐẶC TRƯNG
+# ==============================
+
+def lag_feature_names(cols=LAG_SOURCE_COLS, lags=LAGS, windows=ROLL_WINDOWS, spans=EWMA_SPANS):
+    names = []
+    for c in cols:
+        names += [f"{c}_lag_{L}" for L in lags]
+        for w in windows:
+            names += [f"{c}_roll_mean_{w}", f"{c}_roll_std_{w}"]
+        names += [f"{c}_ewm_{s}" for s in spans]
+    return names
+
+
+# ==============================
+# 2. SẮP XẾP THEO (CHUỖI, NGÀY)
+# ==============================
+
+def _group_codes(df, group_cols):
+    if not group_cols:
+        return np.zeros(len(df), dtype=np.int64)
+    return df.groupby(list(group_cols), sort=False, observed=True).ngroup().to_numpy()
+
+
+def _date_values(df, date_col):
+    dates = df.index if date_col is None else df[date_col]
+    return pd.to_datetime(np.asarray(dates)).asi8
+
+
+def _layout(gid, dates):
+    """Thứ tự (chuỗi, ngày), mã chuỗi và vị trí của từng dòng trong chuỗi (đã sắp xếp)."""
+    order = np.lexsort((dates, gid))
+    gid_sorted = gid[order]
+    starts = np.flatnonzero(np.r_[True, gid_sorted[1:] != gid_sorted[:-1]])
+    sizes = np.diff(np.r_[starts, len(gid_sorted)])
+    pos = np.arange(len(gid_sorted)) - np.repeat(starts, sizes)
+    return order, gid_sorted, pos
+
+
+def _sorted_layout(df, group_cols, date_col):
+    return _layout(_group_codes(df, group_cols), _date_values(df, date_col))
+
+
+# ==============================
+# 3. ĐẶC TRƯNG TRÊN BẢNG ĐÃ SẮP XẾP
+# ==============================
+
+def _window_sums(x, w):
+    # Tổng, tổng bình phương và số giá trị hữu hạn của x[i - w .. i - 1] (tổng tích lũy)
+    finite = np.isfinite(x)
+    v = np.where(finite, x, 0.0)
+    cs = np.r_[0.0, np.cumsum(v)]
+    cs2 = np.r_[0.0, np.cumsum(v * v)]
+    cnt = np.r_[0, np.cumsum(finite)]
+    i = np.arange(len(x))
+    lo = np.maximum(i - w, 0)
+    return cs[i] - cs[lo], cs2[i] - cs2[lo], cnt[i] - cnt[lo]
+
+
+def _column_features(x, gid, pos, name, lags, windows, spans):
+    feats = {}
+    n = len(x)
+    idx = np.arange(n)
+    for L in lags:
+        feats[f"{name}_lag_{L}"] = np.where(pos >= L, x[np.maximum(idx - L, 0)], np.nan)
+
+    for w in windows:
+        s, s2, cnt = _window_sums(x, w)
+        # Cửa sổ phải nằm trọn trong chuỗi và đủ w giá trị
+        valid = (pos >= w) & (cnt == w)
+        mean = s / w
+        var = np.maximum(s2 - s * s / w, 0.0) / (w - 1)
+        feats[f"{name}_roll_mean_{w}"] = np.where(valid, mean, np.nan)
+        feats[f"{name}_roll_std_{w}"] = np.where(valid, np.sqrt(var), np.nan)
+
+    if spans:
+        grouped = pd.Series(x).groupby(gid, sort=False)
+        for span in spans:
+            # EWMA đến ngày t - 1 = EWMA (adjust=False) đến ngày t, dịch 1 dòng trong chuỗi
+            ewm = grouped.ewm(span=span, adjust=False).mean().to_numpy()
+            feats[f"{name}_ewm_{span}"] = np.where(pos >= 1, ewm[np.maximum(idx - 1, 0)], np.nan)
+    return feats
+
+
+def add_lag_features(df, group_cols=None, date_col=None, cols=LAG_SOURCE_COLS,
+                     lags=LAGS, windows=ROLL_WINDOWS, spans=EWMA_SPANS):
+    """
+    Thêm các cột lag / roll_mean / roll_std / ewm của `cols` vào bản sao của `df`
+    (thứ tự dòng giữ nguyên). Ngày trong `date_col` (None -> index).
+    Các dòng đầu mỗi chuỗi chưa đủ lịch sử mang NaN - bỏ bằng dropna trước khi fit.
+    """
+    order, gid, pos = _sorted_layout(df, group_cols, date_col)
+    df = df.copy()
+    for c in cols:
+        x = df[c].to_numpy(dtype=np.float64)[order]
+        for name, values in _column_features(x, gid, pos, c, lags, windows, spans).items():
+            out = np.empty(len(df))
+            out[order] = values
+            df[name] = out
+    return df
+
+
+# ==============================
+# 4. DỰ BÁO NHIỀU BƯỚC (ĐỆ QUY)
+# ==============================
+
+def _right_aligned(values, gid, pos, n_groups, n_hist, width):
+    # Mảng (chuỗi x width): lịch sử mỗi chuỗi căn phải tại cột n_hist - 1, thiếu -> NaN
+    M = np.full((n_groups, width), np.nan)
+    lengths = np.bincount(gid, minlength=n_groups)
+    M[gid, n_hist - lengths[gid] + pos] = values
+    return M
+
+
+def recursive_forecast(model, df_history, df_future, feature_cols, group_cols=None, date_col=None,
+                       target_col="Total_Quantity", cols=LAG_SOURCE_COLS, lags=LAGS,
+                       windows=ROLL_WINDOWS, spans=EWMA_SPANS, clip_min=0.0):
+    """
+    Dự báo từng ngày của `df_future` (mỗi chuỗi cùng số ngày, nối tiếp df_history).
+    Mỗi bước dự báo 1 ngày cho mọi chuỗi bằng 1 lần model.predict; giá trị dự báo
+    được ghi vào lịch sử để tính lag / cửa sổ / EWMA cho ngày kế tiếp.
+    Các cột nguồn khác `target_col` (vd. Price_Index kịch bản) lấy từ df_future.
+    Trả về mảng dự báo theo thứ tự dòng của df_future.
+    """
+    group_cols = list(group_cols or [])
+    n_hist = len(df_history)
+    both = pd.concat([df_history[group_cols], df_future[group_cols]], ignore_index=True) if group_cols else None
+    gid_all = _group_codes(both, group_cols) if group_cols else np.zeros(n_hist + len(df_future), dtype=np.int64)
+    n_groups = gid_all.max() + 1
+
+    h_order, h_gid, h_pos = _layout(gid_all[:n_hist], _date_values(df_history, date_col))
+    f_order, f_gid, _ = _layout(gid_all[n_hist:], _date_values(df_future, date_col))
+    n_steps = len(df_future) // n_groups
+    if n_steps * n_groups != len(df_future) or np.bincount(f_gid, minlength=n_groups).min() != n_steps:
+        raise ValueError("df_future phải có cùng số ngày cho mọi chuỗi.")
+    # rows[g, j]: dòng (theo thứ tự gốc) của chuỗi g, bước j trong df_future
+    rows = f_order.reshape(n_groups, n_steps)
+
+    n_hist_max = np.bincount(h_gid, minlength=n_groups).max()
+    width = n_hist_max + n_steps
+    buffers, ewm_state = {}, {}
+    for c in cols:
+        B = _right_aligned(df_history[c].to_numpy(dtype=np.float64)[h_order], h_gid, h_pos, n_groups, n_hist_max, width)
+        if c != target_col:
+            B[:, n_hist_max:] = df_future[c].to_numpy(dtype=np.float64)[rows]
+        buffers[c] = B
+        for span in spans:
+            # Trạng thái EWMA sau ngày lịch sử cuối (cùng công thức adjust=False)
+            ewm = pd.DataFrame(B[:, :n_hist_max].T).ewm(span=span, adjust=False).mean().to_numpy()
+            ewm_state[(c, span)] = ewm[-1]
+
+    X_future = df_future.copy()
+    lag_names = [n for n in feature_cols if n in set(lag_feature_names(cols, lags, windows, spans))]
+    for name in lag_names:
+        X_future[name] = np.nan
+    preds = np.empty(len(df_future))
+
+    for j in range(n_steps):
+        t = n_hist_max + j
+        step_feats = {}
+        for c in cols:
+            B = buffers[c]
+            for L in lags:
+                step_feats[f"{c}_lag_{L}"] = B[:, t - L]
+            for w in windows:
+                window = B[:, t - w:t]
+                step_feats[f"{c}_roll_mean_{w}"] = window.mean(axis=1)
+                step_feats[f"{c}_roll_std_{w}"] = window.std(axis=1, ddof=1)
+            for span in spans:
+                step_feats[f"{c}_ewm_{span}"] = ewm_state[(c, span)]
+
+        X_step = X_future.iloc[rows[:, j]][feature_cols].copy()
+        for name in lag_names:
+            X_step[name] = step_feats[name]
+        y = np.asarray(model.predict(X_step), dtype=np.float64)
+        if clip_min is not None:
+            y = np.maximum(y, clip_min)
+        preds[rows[:, j]] = y
+
+        # Đưa dự báo vào lịch sử rồi cập nhật EWMA cho bước sau
+        buffers[target_col][:, t] = y
+        for c in cols:
+            x_t = buffers[c][:, t]
+            for span in spans:
+                alpha = 2.0 / (span + 1.0)
+                prev = ewm_state[(c, span)]
+                ewm_state[(c, span)] = np.where(np.isnan(prev), x_t, alpha * x_t + (1 - alpha) * prev)
+    return preds
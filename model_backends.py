@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Registry các mô hình dự báo (LR, RF, XGB, LSTM) dạng plugin, nạp thư viện khi cần.
+
+Mỗi backend gồm hàm build / fit / predict và tham số mặc định. Thư viện nặng
+(scikit-learn, XGBoost, TensorFlow) chỉ được import bên trong các hàm đó, nên
+`import model_backends` (và các module dùng nó như forecast_engine) không nạp
+TensorFlow / XGBoost cho tới khi mô hình tương ứng thật sự được chọn.
+
+    model = fit_model("XGB", X_train, Y_train)
+    pred = predict_model("XGB", model, X_future)
+
+Thêm mô hình mới: register_backend("TEN", build, fit, predict, defaults).
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+MODEL_BACKENDS = {}
+ALL_MODELS = ["LR", "RF", "XGB", "LSTM"]
+
+
+# ==============================
+# 1. REGISTRY
+# ==============================
+
+def _fit_estimator(model, X, y):
+    return model.fit(X, y)
+
+
+def _predict_estimator(model, X):
+    return np.asarray(model.predict(X)).ravel()
+
+
+def register_backend(name, build, fit=None, predict=None, defaults=None):
+    """
+    Đăng ký 1 backend. `build(**params)` tạo mô hình chưa fit; `fit(model, X, y)`
+    trả về mô hình đã fit; `predict(model, X)` trả về mảng 1 chiều.
+    Mặc định fit / predict theo API scikit-learn.
+    """
+    MODEL_BACKENDS[name] = {
+        "build": build,
+        "fit": fit or _fit_estimator,
+        "predict": predict or _predict_estimator,
+        "defaults": dict(defaults or {}),
+    }
+
+
+def _backend(name):
+    try:
+        return MODEL_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Mô hình không hỗ trợ: {name} (có: {', '.join(MODEL_BACKENDS)})") from None
+
+
+def make_model(name, **params):
+    """Mô hình chưa fit với tham số mặc định của backend, ghi đè bởi `params`."""
+    backend = _backend(name)
+    return backend["build"](**{**backend["defaults"], **params})
+
+
+def fit_model(name, X, y, **params):
+    return _backend(name)["fit"](make_model(name, **params), X, y)
+
+
+def predict_model(name, model, X):
+    return _backend(name)["predict"](model, X)
+
+
+# ==============================
+# 2. SCIKIT-LEARN / XGBOOST
+# ==============================
+
+def _build_lr(**params):
+    from sklearn.linear_model import LinearRegression
+    return LinearRegression(**params)
+
+
+def _build_rf(**params):
+    from sklearn.ensemble import RandomForestRegressor
+    return RandomForestRegressor(**params)
+
+
+def _build_xgb(**params):
+    from xgboost import XGBRegressor
+    return XGBRegressor(**params)
+
+
+register_backend("LR", _build_lr)
+register_backend("RF", _build_rf, defaults={"n_estimators": 100, "random_state": 42, "n_jobs": -1})
+register_backend("XGB", _build_xgb, defaults={"n_estimators": 100, "random_state": 42, "n_jobs": -1,
+                                              "objective": "reg:squarederror"})
+
+
+# ==============================
+# 3. LSTM (TENSORFLOW)
+# ==============================
+
+def _build_lstm(**params):
+    # Mạng chỉ dựng được khi biết số đặc trưng -> giữ tham số, dựng trong _fit_lstm
+    return {"params": params}
+
+
+def _fit_lstm(model, X, y):
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+    from sklearn.preprocessing import MinMaxScaler
+    from tensorflow.keras.callbacks import EarlyStopping
+    from tensorflow.keras.layers import LSTM, Dense
+    from tensorflow.keras.models import Sequential
+
+    params = model["params"]
+    scaler_X = MinMaxScaler()
+    scaler_Y = MinMaxScaler()
+    X_scaled = scaler_X.fit_transform(X)
+    Y_scaled = scaler_Y.fit_transform(np.asarray(y).reshape(-1, 1))
+    X_lstm = X_scaled.reshape((X_scaled.shape[0], 1, X_scaled.shape[1]))
+
+    network = Sequential()
+    network.add(LSTM(params["units"], activation="relu", input_shape=(X_lstm.shape[1], X_lstm.shape[2])))
+    network.add(Dense(1))
+    network.compile(optimizer="adam", loss="mse")
+    early_stop = EarlyStopping(monitor="loss", patience=params["patience"], verbose=0)
+    network.fit(X_lstm, Y_scaled, epochs=params["epochs"], batch_size=params["batch_size"],
+                verbose=0, callbacks=[early_stop])
+    return {"params": params, "network": network, "scaler_X": scaler_X, "scaler_Y": scaler_Y}
+
+
+def _predict_lstm(model, X):
+    X_scaled = model["scaler_X"].transform(X)
+    X_lstm = X_scaled.reshape((X_scaled.shape[0], 1, X_scaled.shape[1]))
+    pred_scaled = model["network"].predict(X_lstm, verbose=0)
+    return model["scaler_Y"].inverse_transform(pred_scaled).flatten()
+
+
+register_backend("LSTM", _build_lstm, _fit_lstm, _predict_lstm,
+                 defaults={"units": 50, "epochs": 20, "batch_size": 32, "patience": 5})
+
+
+# ==============================
+# 4. CHỌN MÔ HÌNH (CLI)
+# ==============================
+
+def parse_models(value):
+    """'LR,XGB' -> ['LR', 'XGB'] (kiểm tra tên); 'all' -> mọi backend đã đăng ký."""
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(",") if v.strip()]
+    if [v.lower() for v in value] == ["all"]:
+        return list(MODEL_BACKENDS)
+    models = [v.upper() for v in value]
+    for name in models:
+        _backend(name)
+    return models
+
+
+def add_models_argument(parser, default=ALL_MODELS):
+    parser.add_argument("--models", default=",".join(default),
+                        help=f"Các mô hình chạy, cách nhau dấu phẩy ({', '.join(MODEL_BACKENDS)} hoặc all)")
+    return parser
+
+
+def models_from_argv(argv=None, default=ALL_MODELS):
+    """
+    Đọc cờ --models từ dòng lệnh; bỏ qua các tham số khác (vd. của Jupyter / Colab).
+    Không có cờ -> `default`.
+    """
+    parser = add_models_argument(argparse.ArgumentParser(add_help=False), default)
+    args, _ = parser.parse_known_args(argv)
+    return parse_models(args.models)
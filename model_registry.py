@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Registry lưu mô hình phân khúc (BƯỚC 2-4) đã huấn luyện, có đánh phiên bản.
+
+Mỗi phiên bản gồm preprocessor (ColumnTransformer đã fit), tâm cụm, bảng tên
+cụm, nhãn cụm của từng Customer_ID và các chỉ số đánh giá (bảng chọn K,
+Silhouette, Davies-Bouldin), kèm fingerprint của các file dữ liệu nguồn và tham
+số huấn luyện. Khi dữ liệu và tham số không đổi, các lần chạy Optimize /
+Forecast bỏ qua toàn bộ BƯỚC 2-4 (tiền xử lý, chọn K, K-Means) và nạp lại mô hình.
+
+    .hl_models/segmentation/
+        registry.json
+        v0001/model.joblib            (preprocessor, centroids, cluster_name_map, scores)
+        v0001/customer_clusters.parquet
+"""
+
+import json
+import os
+from datetime import datetime
+
+import joblib
+
+from data_access import CACHE_EXT, file_fingerprint, fingerprint_matches, read_frame, write_frame
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+REGISTRY_DIR_NAME = ".hl_models"
+REGISTRY_SCHEMA_VERSION = 2
+SEGMENTATION_MODEL_NAME = "segmentation"
+SEGMENTATION_SOURCES = ["customer_profile.csv", "transaction_data.csv"]
+
+
+# ==============================
+# 1. ĐỌC / GHI REGISTRY
+# ==============================
+
+def _model_dir(registry_dir, model_name):
+    return os.path.join(registry_dir, model_name)
+
+
+def _version_dir(registry_dir, model_name, version):
+    return os.path.join(_model_dir(registry_dir, model_name), f"v{version:04d}")
+
+
+def read_registry(registry_dir=REGISTRY_DIR_NAME, model_name=SEGMENTATION_MODEL_NAME):
+    path = os.path.join(_model_dir(registry_dir, model_name), "registry.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            registry = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"schema_version": REGISTRY_SCHEMA_VERSION, "versions": []}
+    if registry.get("schema_version") != REGISTRY_SCHEMA_VERSION:
+        return {"schema_version": REGISTRY_SCHEMA_VERSION, "versions": []}
+    return registry
+
+
+def _write_registry(registry, registry_dir, model_name):
+    path = os.path.join(_model_dir(registry_dir, model_name), "registry.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(registry, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _normalize_params(params):
+    # Qua 1 lần JSON để so sánh ổn định (tuple -> list, khóa số -> chuỗi)
+    return json.loads(json.dumps(params, default=str))
+
+
+# ==============================
+# 2. LƯU / NẠP MÔ HÌNH PHÂN KHÚC
+# ==============================
+
+def _dump_artifact(artifact, model_dir):
+    path = os.path.join(model_dir, "model.joblib")
+    tmp_path = path + ".tmp"
+    joblib.dump(artifact, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_segmentation_model(preprocessor, centroids, cluster_name_map, customer_clusters, params,
+                            scores=None, data_dir=".", sources=SEGMENTATION_SOURCES, registry_dir=None):
+    """
+    Lưu 1 phiên bản mới. `customer_clusters`: DataFrame Customer_ID, Cluster.
+    `params`: tham số huấn luyện (số cụm, chế độ, random_state, đặc trưng...).
+    `scores`: chỉ số đánh giá (vd. k_scores, silhouette, davies_bouldin); None nếu chưa tính.
+    Trả về số phiên bản.
+    """
+    registry_dir = registry_dir or os.path.join(data_dir, REGISTRY_DIR_NAME)
+    registry = read_registry(registry_dir, SEGMENTATION_MODEL_NAME)
+    version = max([v["version"] for v in registry["versions"]], default=0) + 1
+
+    out_dir = _version_dir(registry_dir, SEGMENTATION_MODEL_NAME, version)
+    os.makedirs(out_dir, exist_ok=True)
+    _dump_artifact(
+        {
+            "preprocessor": preprocessor,
+            "centroids": centroids,
+            "cluster_name_map": dict(cluster_name_map),
+            "scores": scores,
+        },
+        out_dir,
+    )
+    write_frame(customer_clusters[["Customer_ID", "Cluster"]],
+                os.path.join(out_dir, f"customer_clusters.{CACHE_EXT}"))
+
+    registry["versions"].append({
+        "version": version,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "params": _normalize_params(params),
+        "sources": {name: file_fingerprint(os.path.join(data_dir, name)) for name in sources},
+    })
+    _write_registry(registry, registry_dir, SEGMENTATION_MODEL_NAME)
+    return version
+
+
+def find_segmentation_version(params, data_dir=".", sources=SEGMENTATION_SOURCES, registry_dir=None):
+    """Phiên bản mới nhất có cùng tham số và dữ liệu nguồn không đổi (None nếu không có)."""
+    registry_dir = registry_dir or os.path.join(data_dir, REGISTRY_DIR_NAME)
+    registry = read_registry(registry_dir, SEGMENTATION_MODEL_NAME)
+    params = _normalize_params(params)
+
+    for entry in sorted(registry["versions"], key=lambda v: v["version"], reverse=True):
+        if entry["params"] != params or set(entry["sources"]) != set(sources):
+            continue
+        refreshed = {}
+        for name in sources:
+            path = os.path.join(data_dir, name)
+            if not os.path.exists(path):
+                return None
+            matches, new_fp = fingerprint_matches(path, entry["sources"][name])
+            if not matches:
+                break
+            if new_fp is not None:
+                refreshed[name] = new_fp
+        else:
+            if refreshed:
+                # Cùng nội dung nhưng mtime khác -> cập nhật để lần sau khỏi hash lại
+                entry["sources"].update(refreshed)
+                _write_registry(registry, registry_dir, SEGMENTATION_MODEL_NAME)
+            return entry["version"]
+    return None
+
+
+def update_segmentation_scores(version, scores, data_dir=".", registry_dir=None):
+    """Ghi chỉ số đánh giá vào 1 phiên bản đã lưu không kèm scores (vd. lưu từ phần Optimize)."""
+    registry_dir = registry_dir or os.path.join(data_dir, REGISTRY_DIR_NAME)
+    model_dir = _version_dir(registry_dir, SEGMENTATION_MODEL_NAME, version)
+    artifact = joblib.load(os.path.join(model_dir, "model.joblib"))
+    artifact["scores"] = scores
+    _dump_artifact(artifact, model_dir)
+
+
+def load_segmentation_version(version, data_dir=".", registry_dir=None):
+    registry_dir = registry_dir or os.path.join(data_dir, REGISTRY_DIR_NAME)
+    model_dir = _version_dir(registry_dir, SEGMENTATION_MODEL_NAME, version)
+    artifact = joblib.load(os.path.join(model_dir, "model.joblib"))
+    artifact["customer_clusters"] = read_frame(os.path.join(model_dir, f"customer_clusters.{CACHE_EXT}"))
+    artifact["version"] = version
+    return artifact
+
+
+def load_segmentation_model(params, data_dir=".", sources=SEGMENTATION_SOURCES, registry_dir=None,
+                            verbose=False):
+    """
+    Nạp mô hình phân khúc khớp với dữ liệu + tham số hiện tại, hoặc None nếu
+    cần huấn luyện lại. Kết quả: dict preprocessor, centroids, cluster_name_map,
+    scores, customer_clusters, version.
+    """
+    version = find_segmentation_version(params, data_dir, sources, registry_dir)
+    if version is None:
+        if verbose:
+            print("[registry] Không có mô hình phân khúc khớp dữ liệu hiện tại -> huấn luyện lại.")
+        return None
+    if verbose:
+        print(f"[registry] Dùng lại mô hình phân khúc v{version:04d}.")
+    return load_segmentation_version(version, data_dir, registry_dir)
@@ -0,0 +1,697 @@
+# -*- coding: utf-8 -*-
+"""Engine tối ưu hóa giá (BƯỚC 10-11) dạng vector hóa.
+
+Thay cho vòng lặp `df_base.apply(optimize_sku_gridsearch, axis=1)`:
+toàn bộ SKU x điểm giá x cụm được tính trong một tensor NumPy.
+- optimize_prices_vectorized: Grid Search 100 điểm (khớp bản lặp).
+- optimize_prices_analytic : nghiệm đóng / golden-section (nghiệm chính xác).
+- optimize_prices_oracle   : Grid Search với hàm cầu từ mô hình dự báo (demand_oracle.py).
+- optimize_prices_joint    : tối ưu đồng thời mọi SKU của 1 thị trường (menu / cửa hàng) với
+                             co giãn chéo, thang giá S <= M <= L và sàn sản lượng theo Category.
+"""
+
+import numpy as np
+import pandas as pd
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+MAX_QUANTITY_DROP_PCT = 0.15   # RÀNG BUỘC 6: Không giảm sản lượng quá 15%
+MAX_PRICE_INCREASE_PCT = 0.20  # RÀNG BUỘC 7: Tăng giá tối đa 20%
+N_GRID_POINTS = 100            # Số điểm quét giá
+N_COARSE_POINTS = 9            # [analytic] Lưới thô để khoanh vùng trước golden-section
+N_GOLDEN_ITER = 40             # [analytic] 0.618^40 ~ 4e-9 độ rộng khoảng giá
+N_BISECT_ITER = 60             # [analytic] Tìm giá trần theo ràng buộc sản lượng
+DEFAULT_CLUSTERS = (0, 1, 2)
+DEFAULT_PED = -1.0             # PED mặc định (Unit Elastic) khi thiếu
+
+RESULT_COLUMNS = ['P_optimal', 'Profit_optimal', 'Q_optimal', 'Profit_at_P_base', 'Status']
+ORACLE_MULTIINDEX_ERROR = ("method='oracle' chỉ hỗ trợ df_base theo Product_ID: mô hình cầu (demand_oracle) "
+                           "không có chiều Store_ID. Dùng OPTIMIZE_BY_STORE = False.")
+
+# [joint] Co giãn chéo mặc định (thay thế giữa các SKU) khi chưa có ma trận ước lượng.
+# Menu 9 Product_Name x 3 size: tổng mỗi dòng = 2 x 0.15 + 6 x 0.05 + 18 x 0.01 = 0.78 < |DEFAULT_PED|
+# (tăng giá đồng loạt vẫn làm giảm sản lượng)
+SIZE_ORDER = ('S', 'M', 'L')   # Thang giá: giá S <= M <= L trong cùng Product_Name
+CROSS_ELASTICITY_SIZE = 0.15   # Giữa các size của cùng Product_Name
+CROSS_ELASTICITY_CATEGORY = 0.05  # Giữa các Product_Name cùng Category
+CROSS_ELASTICITY_MENU = 0.01   # Giữa các Category khác nhau
+N_AL_OUTER = 8                 # [joint] Số vòng cập nhật nhân tử Lagrange (sàn sản lượng)
+N_PG_ITER = 60                 # [joint] Số bước projected gradient mỗi vòng
+N_DYKSTRA_ITER = 100           # [joint] Số vòng chiếu xen kẽ tối đa (hộp giá <-> thang giá)
+DYKSTRA_TOL = 1e-10            # [joint] Dừng chiếu xen kẽ khi log giá thay đổi ít hơn ngưỡng
+N_REPAIR_ITER = 30             # [joint] Chia đôi đoạn [giá gốc, nghiệm] khi còn vi phạm sàn
+PG_STEP = 0.05                 # [joint] Bước khởi đầu trên log giá
+PENALTY_RHO = 50.0             # [joint] Hệ số phạt của Lagrangian tăng cường
+
+
+# ==============================
+# 1. CHUẨN BỊ MẢNG ĐẦU VÀO
+# ==============================
+
+def extract_base_arrays(df_base, clusters=DEFAULT_CLUSTERS):
+    """
+    Lấy các mảng NumPy từ df_base (đã có cột COGS_new):
+    p_base (n,), cogs_new (n,), q_base (n, k), ped (n, k).
+    Cột Q_base_{c} / PED_{c} thiếu -> 0 / -1.0 (giống row.get(...) trong bản lặp).
+    """
+    n = len(df_base)
+    p_base = df_base['P_base'].to_numpy(dtype=float)
+    cogs_new = df_base['COGS_new'].to_numpy(dtype=float)
+
+    q_base = np.zeros((n, len(clusters)))
+    ped = np.full((n, len(clusters)), DEFAULT_PED)
+    for j, c in enumerate(clusters):
+        if f'Q_base_{c}' in df_base.columns:
+            q_base[:, j] = df_base[f'Q_base_{c}'].to_numpy(dtype=float)
+        if f'PED_{c}' in df_base.columns:
+            ped[:, j] = df_base[f'PED_{c}'].to_numpy(dtype=float)
+
+    return p_base, cogs_new, q_base, ped
+
+
+def price_bounds(p_base, cogs_new, max_price_increase_pct=MAX_PRICE_INCREASE_PCT):
+    # RÀNG BUỘC 4 (Chi phí): P >= COGS_new
+    p_min = np.maximum(p_base, cogs_new)
+    # RÀNG BUỘC 7 ("Business Sense"): Tăng giá tối đa
+    p_max = p_base * (1 + max_price_increase_pct)
+    return p_min, p_max
+
+
+def demand_and_profit(prices, p_base, cogs_new, q_base, ped):
+    """
+    Tính tổng Q và tổng Profit tại các mức giá `prices` (n, m).
+    Cộng dồn theo từng cụm theo đúng thứ tự của bản lặp (bỏ qua cụm có Q_base = 0).
+    """
+    total_q = np.zeros(prices.shape)
+    total_profit = np.zeros(prices.shape)
+    ratio = prices / p_base[:, None]
+    margin = prices - cogs_new[:, None]
+
+    for j in range(q_base.shape[1]):
+        active = (q_base[:, j] != 0)[:, None]
+        # RÀNG BUỘC 1, 2, 5 (Hàm cầu, PED, 1 Giá)
+        q_new_c = q_base[:, j][:, None] * ratio ** ped[:, j][:, None]
+        profit_new_c = margin * q_new_c
+        total_q = np.where(active, total_q + q_new_c, total_q)
+        total_profit = np.where(active, total_profit + profit_new_c, total_profit)
+
+    return total_q, total_profit
+
+
+# ==============================
+# 2. GRID SEARCH VECTOR HÓA
+# ==============================
+
+def _optimize_batch_grid(p_base, cogs_new, q_base, ped, n_grid,
+                         max_quantity_drop_pct, max_price_increase_pct):
+    # 1. Profit tại P_base (với COGS_new)
+    profit_at_p_base = np.zeros(len(p_base))
+    q_at_p_base = np.zeros(len(p_base))
+    for j in range(q_base.shape[1]):
+        profit_at_p_base += (p_base - cogs_new) * q_base[:, j]
+        q_at_p_base += q_base[:, j]
+
+    # 2. Ràng buộc
+    p_min, p_max = price_bounds(p_base, cogs_new, max_price_increase_pct)
+    q_min_allowed = q_at_p_base * (1 - max_quantity_drop_pct)
+    infeasible = p_min > p_max
+
+    # 3. Tensor giá (n, n_grid) -> Q, Profit
+    price_grid = np.linspace(p_min, p_max, n_grid, axis=1)
+    total_q, total_profit = demand_and_profit(price_grid, p_base, cogs_new, q_base, ped)
+
+    p_opt, profit_opt, q_opt = _select_grid_point(price_grid, total_q, total_profit, p_base, q_at_p_base,
+                                                  profit_at_p_base, q_min_allowed, infeasible)
+    return p_opt, profit_opt, q_opt, profit_at_p_base, infeasible, p_max
+
+
+def _select_grid_point(price_grid, total_q, total_profit, p_base, q_at_p_base, profit_at_p_base,
+                       q_min_allowed, infeasible):
+    n_grid = price_grid.shape[1]
+    # RÀNG BUỘC 6 (Thị phần) + chỉ nhận điểm có Profit >= Profit tại P_base
+    feasible = (total_q >= q_min_allowed[:, None]) & (total_profit >= profit_at_p_base[:, None])
+    masked_profit = np.where(feasible, total_profit, -np.inf)
+
+    # Bản lặp dùng `>=` nên khi hòa sẽ lấy điểm giá CUỐI CÙNG -> argmax trên mảng đảo ngược
+    idx = n_grid - 1 - np.argmax(masked_profit[:, ::-1], axis=1)
+    rows = np.arange(len(p_base))
+    has_better = feasible.any(axis=1) & ~infeasible
+
+    p_opt = np.where(has_better, price_grid[rows, idx], p_base)
+    profit_opt = np.where(has_better, total_profit[rows, idx], profit_at_p_base)
+    q_opt = np.where(has_better, total_q[rows, idx], q_at_p_base)
+    return p_opt, profit_opt, q_opt
+
+
+def optimize_prices_vectorized(df_base, clusters=DEFAULT_CLUSTERS, n_grid=N_GRID_POINTS,
+                               max_quantity_drop_pct=MAX_QUANTITY_DROP_PCT,
+                               max_price_increase_pct=MAX_PRICE_INCREASE_PCT,
+                               batch_size=50_000):
+    """
+    Grid Search cho tất cả SKU cùng lúc. Trả về DataFrame (cùng index với df_base)
+    gồm P_optimal, Profit_optimal, Q_optimal, Profit_at_P_base, Status.
+    P_optimal và Status giống hệt optimize_sku_gridsearch; Profit/Q chỉ lệch
+    ở mức làm tròn (~1 ulp) do np.power vector hóa khác pow() vô hướng.
+
+    `batch_size` giới hạn số dòng mỗi lần tính để tensor (batch x n_grid x cụm)
+    không chiếm quá nhiều bộ nhớ khi chạy hàng nghìn Store x SKU.
+    """
+    p_base, cogs_new, q_base, ped = extract_base_arrays(df_base, clusters)
+
+    parts = []
+    for start in range(0, len(df_base), batch_size):
+        sl = slice(start, start + batch_size)
+        parts.append(_optimize_batch_grid(
+            p_base[sl], cogs_new[sl], q_base[sl], ped[sl], n_grid,
+            max_quantity_drop_pct, max_price_increase_pct
+        ))
+
+    if not parts:
+        return pd.DataFrame(columns=RESULT_COLUMNS, index=df_base.index)
+
+    p_opt, profit_opt, q_opt, profit_base, infeasible, p_max = (
+        np.concatenate(arrs) for arrs in zip(*parts)
+    )
+    return _build_result_frame(df_base.index, p_opt, profit_opt, q_opt, profit_base,
+                               infeasible, cogs_new, p_max)
+
+
+def _build_result_frame(index, p_opt, profit_opt, q_opt, profit_base, infeasible, cogs_new, p_max):
+    status = np.full(len(index), 'Thành công', dtype=object)
+    for i in np.flatnonzero(infeasible):
+        status[i] = f'Lỗi: COGS_new ({cogs_new[i]:,.0f}) > P_max ({p_max[i]:,.0f})'
+
+    return pd.DataFrame({
+        'P_optimal': p_opt,
+        'Profit_optimal': profit_opt,
+        'Q_optimal': q_opt,
+        'Profit_at_P_base': profit_base,
+        'Status': status,
+    }, index=index)
+
+
+# ==============================
+# 3. NGHIỆM ĐÓNG / GOLDEN-SECTION (method="analytic")
+# ==============================
+# Với hàm cầu co giãn hằng số của 1 cụm: Profit(p) = q0 (p - C) (p / p0)^e
+#   dProfit/dp = 0  ->  p* = e C / (1 + e)   (chỉ khi e < -1)
+#   e >= -1        ->  Profit tăng theo p    -> p* = cận trên
+# Ràng buộc sản lượng Q(p) >= (1 - drop) Q0 với e < 0 tương đương p <= p_q:
+#   1 cụm: p_q = p0 (1 - drop)^(1/e);  nhiều cụm: Q(p) giảm dần -> chia đôi (bisection).
+# Hỗn hợp nhiều cụm: Profit(p) trơn trên [p_min, p_upper] -> lưới thô khoanh vùng
+# rồi golden-section trong khoảng lân cận điểm tốt nhất.
+
+def _quantity_upper_bound(p_lo, p_hi, p_base, q_base, ped, q_min_allowed, dominant_ped, dominant):
+    # Nghiệm đóng cho SKU chỉ có 1 hệ số co giãn
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q_total = q_base.sum(axis=1)
+        share = np.where(q_total > 0, q_min_allowed / q_total, 1.0)
+        p_q_closed = np.where((dominant_ped < 0) & (q_total > 0),
+                              p_base * share ** (1.0 / dominant_ped), np.inf)
+
+    # Chia đôi cho SKU hỗn hợp: tìm p lớn nhất trong [p_lo, p_hi] có Q(p) >= Q_min
+    lo, hi = p_lo.copy(), p_hi.copy()
+    q_lo, _ = demand_and_profit(lo[:, None], p_base, np.zeros_like(p_base), q_base, ped)
+    q_hi, _ = demand_and_profit(hi[:, None], p_base, np.zeros_like(p_base), q_base, ped)
+    lo_ok = q_lo[:, 0] >= q_min_allowed
+    hi_ok = q_hi[:, 0] >= q_min_allowed
+    for _ in range(N_BISECT_ITER):
+        mid = 0.5 * (lo + hi)
+        q_mid, _ = demand_and_profit(mid[:, None], p_base, np.zeros_like(p_base), q_base, ped)
+        ok = q_mid[:, 0] >= q_min_allowed
+        lo = np.where(ok, mid, lo)
+        hi = np.where(ok, hi, mid)
+    # Ngay tại p_lo đã vi phạm -> không có giá khả thi (trả về -inf)
+    p_q_bisect = np.where(hi_ok, p_hi, np.where(lo_ok, lo, -np.inf))
+
+    return np.where(dominant, p_q_closed, p_q_bisect)
+
+
+def _golden_section_max(lo, hi, p_base, cogs_new, q_base, ped):
+    """Golden-section vector hóa: tìm max Profit trên [lo, hi] cho từng dòng."""
+    inv_phi = (np.sqrt(5.0) - 1) / 2
+    a, b = lo.copy(), hi.copy()
+    x1 = b - inv_phi * (b - a)
+    x2 = a + inv_phi * (b - a)
+    _, f1 = demand_and_profit(x1[:, None], p_base, cogs_new, q_base, ped)
+    _, f2 = demand_and_profit(x2[:, None], p_base, cogs_new, q_base, ped)
+    f1, f2 = f1[:, 0], f2[:, 0]
+
+    for _ in range(N_GOLDEN_ITER):
+        go_right = f1 < f2
+        a = np.where(go_right, x1, a)
+        b = np.where(go_right, b, x2)
+        # Mỗi vòng chỉ cần tính Profit tại 1 điểm mới
+        x_new = np.where(go_right, a + inv_phi * (b - a), b - inv_phi * (b - a))
+        _, f_new = demand_and_profit(x_new[:, None], p_base, cogs_new, q_base, ped)
+        f_new = f_new[:, 0]
+        x1, x2 = np.where(go_right, x2, x_new), np.where(go_right, x_new, x1)
+        f1, f2 = np.where(go_right, f2, f_new), np.where(go_right, f_new, f1)
+
+    return 0.5 * (a + b)
+
+
+def _optimize_batch_analytic(p_base, cogs_new, q_base, ped,
+                             max_quantity_drop_pct, max_price_increase_pct):
+    n = len(p_base)
+    profit_at_p_base = np.zeros(n)
+    q_at_p_base = np.zeros(n)
+    for j in range(q_base.shape[1]):
+        profit_at_p_base += (p_base - cogs_new) * q_base[:, j]
+        q_at_p_base += q_base[:, j]
+
+    p_min, p_max = price_bounds(p_base, cogs_new, max_price_increase_pct)
+    q_min_allowed = q_at_p_base * (1 - max_quantity_drop_pct)
+    infeasible = p_min > p_max
+
+    # "1 cụm chi phối": tất cả cụm có Q_base > 0 cùng một PED -> hàm cầu tổng là co giãn hằng số
+    active = q_base != 0
+    ped_active = np.where(active, ped, np.nan)
+    with np.errstate(invalid='ignore'):
+        ped_lo = np.nanmin(np.where(active.any(axis=1)[:, None], ped_active, DEFAULT_PED), axis=1)
+        ped_hi = np.nanmax(np.where(active.any(axis=1)[:, None], ped_active, DEFAULT_PED), axis=1)
+    dominant = ped_lo == ped_hi
+    dominant_ped = np.where(dominant, ped_lo, np.nan)
+
+    # RÀNG BUỘC 6 (Thị phần) -> giá trần p_upper
+    p_hi = np.maximum(p_min, p_max)
+    p_q = _quantity_upper_bound(p_min, p_hi, p_base, q_base, ped, q_min_allowed, dominant_ped, dominant)
+    p_upper = np.minimum(p_max, p_q)
+    no_feasible_price = p_upper < p_min
+    p_upper = np.maximum(p_upper, p_min)
+
+    # --- Nhánh nghiệm đóng ---
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_star = np.where(dominant_ped < -1, dominant_ped * cogs_new / (1 + dominant_ped), np.inf)
+    p_closed = np.clip(p_star, p_min, p_upper)
+
+    # --- Nhánh hỗn hợp: lưới thô + golden-section ---
+    coarse = np.linspace(p_min, p_upper, N_COARSE_POINTS, axis=1)
+    _, coarse_profit = demand_and_profit(coarse, p_base, cogs_new, q_base, ped)
+    k = np.argmax(coarse_profit, axis=1)
+    rows = np.arange(n)
+    lo = coarse[rows, np.maximum(k - 1, 0)]
+    hi = coarse[rows, np.minimum(k + 1, N_COARSE_POINTS - 1)]
+    p_golden = _golden_section_max(lo, hi, p_base, cogs_new, q_base, ped)
+
+    p_cand = np.where(dominant, p_closed, p_golden)
+    q_cand, profit_cand = demand_and_profit(p_cand[:, None], p_base, cogs_new, q_base, ped)
+    q_cand, profit_cand = q_cand[:, 0], profit_cand[:, 0]
+
+    # Giống bản Grid Search: chỉ đổi giá khi khả thi và Profit >= Profit tại P_base
+    has_better = ~infeasible & ~no_feasible_price & (profit_cand >= profit_at_p_base)
+
+    p_opt = np.where(has_better, p_cand, p_base)
+    profit_opt = np.where(has_better, profit_cand, profit_at_p_base)
+    q_opt = np.where(has_better, q_cand, q_at_p_base)
+
+    return p_opt, profit_opt, q_opt, profit_at_p_base, infeasible, p_max
+
+
+def optimize_prices_analytic(df_base, clusters=DEFAULT_CLUSTERS,
+                             max_quantity_drop_pct=MAX_QUANTITY_DROP_PCT,
+                             max_price_increase_pct=MAX_PRICE_INCREASE_PCT,
+                             batch_size=50_000):
+    """
+    Tối ưu giá chính xác (không xấp xỉ lưới 100 điểm), cùng schema kết quả với
+    optimize_prices_vectorized. Các ràng buộc 4, 6, 7 được xử lý đúng trên khoảng giá.
+
+    SKU có PED > 0 ở một cụm đang bán (hàm cầu tổng không đơn điệu) được chuyển
+    sang Grid Search vector hóa.
+    """
+    p_base, cogs_new, q_base, ped = extract_base_arrays(df_base, clusters)
+    needs_grid = ((ped > 0) & (q_base != 0)).any(axis=1)
+
+    parts = []
+    for start in range(0, len(df_base), batch_size):
+        sl = slice(start, start + batch_size)
+        parts.append(_optimize_batch_analytic(
+            p_base[sl], cogs_new[sl], q_base[sl], ped[sl],
+            max_quantity_drop_pct, max_price_increase_pct
+        ))
+
+    if not parts:
+        return pd.DataFrame(columns=RESULT_COLUMNS, index=df_base.index)
+
+    p_opt, profit_opt, q_opt, profit_base, infeasible, p_max = (
+        np.concatenate(arrs) for arrs in zip(*parts)
+    )
+    df_result = _build_result_frame(df_base.index, p_opt, profit_opt, q_opt, profit_base,
+                                    infeasible, cogs_new, p_max)
+
+    if needs_grid.any():
+        df_result.loc[needs_grid] = optimize_prices_vectorized(
+            df_base.loc[needs_grid], clusters=clusters,
+            max_quantity_drop_pct=max_quantity_drop_pct,
+            max_price_increase_pct=max_price_increase_pct
+        )
+    return df_result
+
+
+# ==============================
+# 4. HÀM CẦU TỪ MÔ HÌNH DỰ BÁO (method="oracle")
+# ==============================
+
+def optimize_prices_oracle(df_base, demand_fn, clusters=DEFAULT_CLUSTERS, n_grid=N_GRID_POINTS,
+                           max_quantity_drop_pct=MAX_QUANTITY_DROP_PCT,
+                           max_price_increase_pct=MAX_PRICE_INCREASE_PCT):
+    """
+    Grid Search như optimize_prices_vectorized nhưng lượng bán lấy từ
+    `demand_fn(product_ids, prices)`: prices (n, m) -> tổng lượng bán (n, m) trên kỳ
+    dự báo (vd. demand_oracle.oracle_demand_fn). P_base và toàn bộ lưới giá của mọi
+    SKU được gửi trong 1 lần gọi; ràng buộc 6 so với lượng bán dự báo tại P_base.
+
+    Q_optimal / Profit tính trên kỳ dự báo của demand_fn. SKU mà demand_fn trả về
+    NaN (không có trong mô hình) -> Grid Search theo PED.
+    Mô hình cầu chỉ theo Product_ID: df_base theo (Store_ID, Product_ID) -> ValueError.
+    """
+    if isinstance(df_base.index, pd.MultiIndex):
+        raise ValueError(ORACLE_MULTIINDEX_ERROR)
+    p_base, cogs_new, _, _ = extract_base_arrays(df_base, clusters)
+    p_min, p_max = price_bounds(p_base, cogs_new, max_price_increase_pct)
+    infeasible = p_min > p_max
+    price_grid = np.linspace(p_min, p_max, n_grid, axis=1)
+
+    q = demand_fn(df_base.index.to_numpy(), np.concatenate([p_base[:, None], price_grid], axis=1))
+    q_at_p_base, total_q = q[:, 0], q[:, 1:]
+    profit_at_p_base = (p_base - cogs_new) * q_at_p_base
+    total_profit = (price_grid - cogs_new[:, None]) * total_q
+    q_min_allowed = q_at_p_base * (1 - max_quantity_drop_pct)
+
+    p_opt, profit_opt, q_opt = _select_grid_point(price_grid, total_q, total_profit, p_base, q_at_p_base,
+                                                  profit_at_p_base, q_min_allowed, infeasible)
+    df_result = _build_result_frame(df_base.index, p_opt, profit_opt, q_opt, profit_at_p_base,
+                                    infeasible, cogs_new, p_max)
+
+    unknown = np.isnan(q).any(axis=1)
+    if unknown.any():
+        df_result.loc[unknown] = optimize_prices_vectorized(
+            df_base.loc[unknown], clusters=clusters, n_grid=n_grid,
+            max_quantity_drop_pct=max_quantity_drop_pct,
+            max_price_increase_pct=max_price_increase_pct
+        )
+    return df_result
+
+
+# ==============================
+# 5. TỐI ƯU ĐỒNG THỜI NHIỀU SKU (method="joint")
+# ==============================
+# Hàm cầu co giãn hằng số mở rộng với co giãn chéo X (n x n, đường chéo = 0):
+#   Q_ic(p) = Q_base_ic (p_i / p0_i)^PED_ic  prod_{j != i} (p_j / p0_j)^X_ij
+# Biến tối ưu y = log p (theo từng thị trường = 1 cửa hàng hoặc cả menu), tối đa
+# tổng Profit của thị trường với:
+# - RÀNG BUỘC 4, 7: hộp giá [max(P_base, COGS_new), P_base (1 + tăng tối đa)]
+# - Thang giá     : p_S <= p_M <= p_L trong cùng Product_Name
+# - RÀNG BUỘC 6   : áp cho tổng sản lượng từng Category thay vì từng SKU
+# Hộp giá + thang giá là tập lồi -> chiếu Dykstra (hộp <-> hồi quy đơn điệu) tới khi hội tụ,
+# bước cuối kẹp dãy đơn điệu vào hộp đã "đơn điệu hóa" (giữ cả hộp lẫn thang giá);
+# sàn sản lượng -> Lagrangian tăng cường. Mọi thị trường chạy cùng lúc trên tensor (M, n).
+# Sau khi giải, thang giá và sàn sản lượng được kiểm tra lại; vi phạm ghi vào Status.
+
+def cross_elasticity_matrix(df_products, size=CROSS_ELASTICITY_SIZE, category=CROSS_ELASTICITY_CATEGORY,
+                            menu=CROSS_ELASTICITY_MENU):
+    """
+    Ma trận co giãn chéo X (DataFrame Product_ID x Product_ID, đường chéo = 0) theo cấu trúc
+    menu: X_ij = `size` nếu cùng Product_Name, `category` nếu cùng Category, còn lại `menu`.
+    `df_products`: index Product_ID, cột Product_Name, Category (vd. product_master).
+    """
+    name = df_products['Product_Name'].to_numpy()
+    cat = df_products['Category'].to_numpy()
+    X = np.where(cat[:, None] == cat[None, :], category, menu)
+    X = np.where(name[:, None] == name[None, :], size, X).astype(float)
+    np.fill_diagonal(X, 0.0)
+    return pd.DataFrame(X, index=df_products.index, columns=df_products.index)
+
+
+def size_ladders(df_products, size_order=SIZE_ORDER):
+    """Mảng (số Product_Name, số size) vị trí SKU theo thứ tự size; -1 nếu thiếu size."""
+    rank = df_products['Size'].map({s: k for k, s in enumerate(size_order)})
+    names = pd.Index(df_products['Product_Name'].unique())
+    ladder = np.full((len(names), len(size_order)), -1)
+    ok = rank.notna().to_numpy()
+    ladder[names.get_indexer(df_products['Product_Name'])[ok], rank[ok].astype(int)] = np.flatnonzero(ok)
+    return ladder
+
+
+def _isotonic(v, mask):
+    """
+    Hồi quy đơn điệu không giảm theo trục cuối (chiếu Euclid), bỏ qua vị trí mask = False:
+    x_i = min_{b >= i} max_{a <= i} mean(v[a..b]).
+    """
+    k = v.shape[-1]
+    w = mask.astype(float)
+    zeros = np.zeros(v.shape[:-1] + (1,))
+    S = np.concatenate([zeros, np.cumsum(np.where(mask, v, 0.0), axis=-1)], axis=-1)
+    C = np.concatenate([zeros, np.cumsum(w, axis=-1)], axis=-1)
+    x = v.copy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(k):
+            best = np.full(v.shape[:-1], np.nan)
+            for b in range(i, k):
+                inner = np.full(v.shape[:-1], np.nan)
+                for a in range(i + 1):
+                    inner = np.fmax(inner, (S[..., b + 1] - S[..., a]) / (C[..., b + 1] - C[..., a]))
+                best = np.fmin(best, inner)
+            x[..., i] = np.where(mask[..., i], best, v[..., i])
+    return x
+
+
+def _ladder_bounds(lo, hi, idx, ladder_mask):
+    """
+    Hộp (M, số Product_Name, số size) đã đơn điệu hóa theo thang giá: cận dưới
+    max_{a <= i} lo_a, cận trên min_{b >= i} hi_b (chỉ xét vị trí ladder_mask).
+    Dãy đơn điệu kẹp vào hộp này vẫn đơn điệu và nằm trong [lo, hi].
+    """
+    lo_l = np.maximum.accumulate(np.where(ladder_mask, lo[:, idx], -np.inf), axis=-1)
+    hi_l = np.minimum.accumulate(np.where(ladder_mask, hi[:, idx], np.inf)[..., ::-1], axis=-1)[..., ::-1]
+    return lo_l, hi_l
+
+
+def _project(y, lo, hi, ladder, ladder_mask):
+    """
+    Chiếu y (M, n) lên {lo <= y <= hi} giao {thang giá đơn điệu}: Dykstra tới khi hội tụ
+    (tối đa N_DYKSTRA_ITER vòng), bước cuối hồi quy đơn điệu rồi kẹp vào hộp đã đơn điệu
+    hóa nên kết quả luôn nằm trong hộp và đúng thang giá khi hai ràng buộc tương thích.
+    `ladder_mask` (M, số Product_Name, số size): vị trí được xét trong thang giá.
+    """
+    valid = ladder >= 0
+    if not valid.any():
+        return np.clip(y, lo, hi)
+    idx = np.where(valid, ladder, 0)
+    x, p, q = y, np.zeros_like(y), np.zeros_like(y)
+    for _ in range(N_DYKSTRA_ITER):
+        a = np.clip(x + p, lo, hi)
+        p = x + p - a
+        b = a + q
+        b[:, ladder[valid]] = _isotonic(b[:, idx], ladder_mask)[:, valid]
+        q = a + q - b
+        converged = np.abs(b - x).max() < DYKSTRA_TOL
+        x = b
+        if converged:
+            break
+
+    # Thang giá không tương thích với hộp (lo_l > hi_l, vd. SKU giá cố định) -> ưu tiên hộp;
+    # vi phạm thang giá còn lại được báo trong Status
+    lo_l, hi_l = _ladder_bounds(lo, hi, idx, ladder_mask)
+    x = np.clip(x, lo, hi)
+    x_l = np.clip(_isotonic(x[:, idx], ladder_mask), lo_l, hi_l)
+    x[:, ladder[valid]] = np.clip(x_l, lo[:, idx], hi[:, idx])[:, valid]
+    return x
+
+
+def _ladder_violations(y, ladder, ladder_mask, tol=1e-9):
+    """(M, n) True với mọi SKU thuộc Product_Name có giá size nhỏ > giá size lớn hơn."""
+    valid = ladder >= 0
+    bad = np.zeros(y.shape, dtype=bool)
+    if not valid.any():
+        return bad
+    x = np.where(ladder_mask, y[:, np.where(valid, ladder, 0)], -np.inf)
+    prev = np.concatenate([np.full(x.shape[:-1] + (1,), -np.inf),
+                           np.maximum.accumulate(x, axis=-1)[..., :-1]], axis=-1)
+    bad_name = (ladder_mask & (x < prev - tol)).any(axis=-1)
+    bad[:, ladder[valid]] = np.broadcast_to(bad_name[..., None], ladder_mask.shape)[:, valid]
+    return bad
+
+
+def _joint_demand(y, y0, q_base, ped, cross):
+    """Q (M, n), own (M, n) = sum_c Q_c PED_c (dQ_i / dy_i phần giá riêng) tại log giá y."""
+    d = y - y0
+    log_cross = d @ cross.T
+    q_c = q_base * np.exp(ped * d[..., None] + log_cross[..., None])
+    return q_c.sum(axis=-1), (q_c * ped).sum(axis=-1)
+
+
+def _joint_objective(y, y0, q_base, ped, cross, cogs, cat_onehot, cat_floor, revenue0, lam, rho):
+    """
+    Lagrangian tăng cường (đã chia doanh thu gốc của thị trường) và gradient theo y.
+    Sàn g_k = Q_cat_k / Q_cat0_k - (1 - drop_k) >= 0 (cat_floor đã chia Q_cat0).
+    """
+    price = np.exp(y)
+    q, own = _joint_demand(y, y0, q_base, ped, cross)
+    margin = price - cogs
+    profit = (margin * q).sum(axis=1)
+    grad = price * q + margin * own + (margin * q) @ cross
+
+    # Sàn sản lượng theo Category: dQ_cat_k / dy_j = sum_{i in k} Q_i X_ij + 1[j in k] own_j
+    g = q @ cat_onehot * cat_floor['scale'] - cat_floor['floor']
+    mu = np.maximum(0.0, lam - rho * g)
+    dg = np.einsum('mi,ik,ij->mkj', q, cat_onehot, cross) + cat_onehot.T[None] * own[:, None, :]
+    grad_g = np.einsum('mk,mkj->mj', mu * cat_floor['scale'], dg)
+
+    value = profit / revenue0 - ((mu ** 2 - lam ** 2) / (2 * rho)).sum(axis=1)
+    return value, grad / revenue0[:, None] + grad_g, profit, q, g
+
+
+def _dense_markets(df_base, products):
+    """Mã thị trường (M,) và vị trí (dòng -> (thị trường, SKU)) của df_base."""
+    if isinstance(df_base.index, pd.MultiIndex):
+        markets = df_base.index.droplevel('Product_ID').unique()
+        m_pos = markets.get_indexer(df_base.index.droplevel('Product_ID'))
+        p_pos = products.get_indexer(df_base.index.get_level_values('Product_ID'))
+    else:
+        markets = pd.Index(['Menu'])
+        m_pos = np.zeros(len(df_base), dtype=int)
+        p_pos = products.get_indexer(df_base.index)
+    if (p_pos < 0).any():
+        raise ValueError("df_base có Product_ID không có trong ma trận co giãn chéo.")
+    return markets, m_pos, p_pos
+
+
+def optimize_prices_joint(df_base, cross_elasticity, df_products=None, clusters=DEFAULT_CLUSTERS,
+                          volume_floor_pct=MAX_QUANTITY_DROP_PCT,
+                          max_price_increase_pct=MAX_PRICE_INCREASE_PCT,
+                          size_order=SIZE_ORDER, verbose=False):
+    """
+    Tối ưu đồng thời giá mọi SKU của từng thị trường, cùng schema kết quả với
+    optimize_prices_vectorized (Profit / Q của từng SKU tại bộ giá chung).
+
+    - df_base         : index Product_ID (1 thị trường = cả menu) hoặc MultiIndex
+                        (Store_ID, Product_ID) (mỗi cửa hàng 1 thị trường); cột như các
+                        method khác + Category, Product_Name, Size (hoặc qua df_products)
+    - cross_elasticity: DataFrame Product_ID x Product_ID (xem cross_elasticity_matrix)
+    - volume_floor_pct: sụt giảm tối đa của tổng sản lượng mỗi Category (float hoặc dict)
+
+    Thị trường chỉ đổi giá khi tổng Profit >= tổng Profit tại P_base (như Grid Search).
+    """
+    products = pd.Index(cross_elasticity.index, name='Product_ID')
+    cross = cross_elasticity.reindex(index=products, columns=products).fillna(0.0).to_numpy(dtype=float, copy=True)
+    np.fill_diagonal(cross, 0.0)
+    if df_products is None:
+        df_products = df_base.reset_index().drop_duplicates('Product_ID').set_index('Product_ID')
+    df_products = df_products.reindex(products)
+
+    markets, m_pos, p_pos = _dense_markets(df_base, products)
+    n_markets, n = len(markets), len(products)
+    p_base_r, cogs_r, q_base_r, ped_r = extract_base_arrays(df_base, clusters)
+
+    # Tensor (thị trường x SKU); SKU không bán ở thị trường: Q = 0, giá cố định
+    p_base = np.ones((n_markets, n))
+    cogs = np.zeros((n_markets, n))
+    q_base = np.zeros((n_markets, n, len(clusters)))
+    ped = np.full((n_markets, n, len(clusters)), DEFAULT_PED)
+    p_base[m_pos, p_pos] = p_base_r
+    cogs[m_pos, p_pos] = cogs_r
+    q_base[m_pos, p_pos] = q_base_r
+    ped[m_pos, p_pos] = ped_r
+    active = q_base.sum(axis=-1) > 0
+
+    p_min, p_max = price_bounds(p_base, cogs, max_price_increase_pct)
+    infeasible = p_min > p_max
+    fixed = ~active | infeasible
+    y0 = np.log(p_base)
+    lo = np.where(fixed, y0, np.log(np.maximum(p_min, 1e-9)))
+    hi = np.where(fixed, y0, np.log(p_max))
+
+    ladder = size_ladders(df_products, size_order)
+    ladder_mask = (ladder >= 0)[None] & active[:, np.where(ladder >= 0, ladder, 0)]
+
+    # Sàn sản lượng theo Category
+    categories = pd.Index(df_products['Category'].dropna().unique())
+    cat_onehot = (df_products['Category'].to_numpy()[:, None] == categories.to_numpy()[None, :]).astype(float)
+    if isinstance(volume_floor_pct, dict):
+        drop = np.array([volume_floor_pct.get(c, MAX_QUANTITY_DROP_PCT) for c in categories])
+    else:
+        drop = np.full(len(categories), float(volume_floor_pct))
+    q0 = q_base.sum(axis=-1)
+    q_cat0 = q0 @ cat_onehot
+    with np.errstate(divide='ignore'):
+        scale = np.where(q_cat0 > 0, 1.0 / q_cat0, 0.0)
+    cat_floor = {'scale': scale, 'floor': np.where(q_cat0 > 0, 1.0 - drop, 0.0)}
+    revenue0 = np.maximum((p_base * q0).sum(axis=1), 1e-9)
+    profit0 = ((p_base - cogs) * q0).sum(axis=1)
+
+    # Lagrangian tăng cường + projected gradient với bước riêng cho từng thị trường
+    args = (y0, q_base, ped, cross, cogs, cat_onehot, cat_floor, revenue0)
+    y_start = _project(y0, lo, hi, ladder, ladder_mask)
+    y = y_start
+    start_ok = (_joint_objective(y_start, *args, np.zeros((n_markets, len(categories))), PENALTY_RHO)[4]
+                >= -1e-9).all(axis=1)
+    if verbose and not start_ok.all():
+        print(f"[joint] {(~start_ok).sum()} thị trường: đưa P_base về đúng thang giá đã vi phạm sàn sản lượng")
+    lam = np.zeros((n_markets, len(categories)))
+    step = np.full(n_markets, PG_STEP)
+    for _ in range(N_AL_OUTER):
+        value, grad, _, _, _ = _joint_objective(y, *args, lam, PENALTY_RHO)
+        for _ in range(N_PG_ITER):
+            y_new = _project(y + step[:, None] * grad, lo, hi, ladder, ladder_mask)
+            value_new, grad_new, _, _, _ = _joint_objective(y_new, *args, lam, PENALTY_RHO)
+            better = value_new >= value
+            y = np.where(better[:, None], y_new, y)
+            value = np.where(better, value_new, value)
+            grad = np.where(better[:, None], grad_new, grad)
+            step = np.where(better, step * 1.2, step * 0.5)
+        _, _, _, _, g = _joint_objective(y, *args, lam, PENALTY_RHO)
+        lam = np.maximum(0.0, lam - PENALTY_RHO * g)
+        step = np.full(n_markets, PG_STEP)
+
+    # Còn vi phạm sàn -> lùi về phía điểm xuất phát: y(t) = y_start + t (y - y_start), t lớn nhất khả thi
+    def floor_ok(y_t):
+        return (_joint_objective(y_t, *args, lam, PENALTY_RHO)[4] >= -1e-9).all(axis=1)
+
+    ok = floor_ok(y)
+    t_lo, t_hi = np.zeros(n_markets), np.ones(n_markets)
+    for _ in range(N_REPAIR_ITER):
+        t = np.where(ok, 1.0, 0.5 * (t_lo + t_hi))
+        ok_t = floor_ok(y_start + t[:, None] * (y - y_start))
+        t_lo = np.where(ok_t, t, t_lo)
+        t_hi = np.where(ok_t, t_hi, t)
+    t = np.where(ok, 1.0, t_lo)
+    y = y_start + t[:, None] * (y - y_start)
+
+    _, _, profit, q, _ = _joint_objective(y, *args, lam, PENALTY_RHO)
+    has_better = profit >= profit0
+    price = np.where(has_better[:, None], np.exp(y), p_base)
+    q = np.where(has_better[:, None], q, q0)
+    if verbose:
+        print(f"[joint] {n_markets} thị trường x {n} SKU: {has_better.sum()} thị trường đổi giá, "
+              f"Profit {profit0.sum():,.0f} -> {np.where(has_better, profit, profit0).sum():,.0f}")
+
+    # Kiểm tra lại nghiệm cuối: thang giá (kể cả khi giữ P_base) và sàn sản lượng theo Category
+    y_final = np.log(price)
+    ladder_bad = _ladder_violations(y_final, ladder, ladder_mask)
+    floor_bad = _joint_objective(y_final, *args, lam, PENALTY_RHO)[4] < -1e-6
+    if verbose and (ladder_bad.any() or floor_bad.any()):
+        print(f"[joint] Cảnh báo: {ladder_bad.any(axis=1).sum()} thị trường vi phạm thang giá, "
+              f"{floor_bad.any(axis=1).sum()} thị trường vi phạm sàn sản lượng")
+
+    profit_sku = (price - cogs) * q
+    profit_base_sku = (p_base - cogs) * q0
+    df_result = _build_result_frame(df_base.index, price[m_pos, p_pos], profit_sku[m_pos, p_pos],
+                                     q[m_pos, p_pos], profit_base_sku[m_pos, p_pos],
+                                     infeasible[m_pos, p_pos], cogs_r, p_max[m_pos, p_pos])
+    sku_cat = cat_onehot.argmax(axis=1)
+    has_cat = cat_onehot.any(axis=1)
+    status = df_result['Status'].to_numpy(dtype=object, copy=True)
+    for r, (m, i) in enumerate(zip(m_pos, p_pos)):
+        warnings = []
+        if ladder_bad[m, i]:
+            warnings.append(f"vi phạm thang giá {' <= '.join(size_order)}")
+        if has_cat[i] and floor_bad[m, sku_cat[i]]:
+            warnings.append(f"vi phạm sàn sản lượng Category {categories[sku_cat[i]]}")
+        if warnings:
+            prefix = status[r] + '; ' if status[r].startswith('Lỗi') else ''
+            status[r] = prefix + 'Cảnh báo: ' + ', '.join(warnings)
+    df_result['Status'] = status
+    return df_result
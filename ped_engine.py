@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""Engine ước lượng PED (BƯỚC 7 - Mô hình 5) cho nhiều phân khúc cùng lúc.
+
+Mô hình cho mỗi phân khúc (mặc định Cluster x Category):
+    log(Total_Quantity) ~ const + log(Price_Index) + Promotion + Weekend + Holiday + Monthly_Index
+
+Dữ liệu chỉ được chia 1 lần bằng groupby (thay vì lọc boolean toàn bảng cho
+từng cặp). Mặc định mọi phân khúc được giải cùng lúc bằng phương trình chuẩn
+(X'X) b = X'y xếp chồng cho np.linalg.solve; statsmodels chỉ dùng cho phân khúc
+suy biến và khi cần báo cáo chẩn đoán (segment_report).
+Có thể dùng phân khúc mịn hơn, vd. Store_ID x Cluster x Product_ID.
+"""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from scipy import stats
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+DEFAULT_SEGMENT_COLS = ["Cluster", "Category"]
+MIN_SEGMENT_ROWS = 10          # Phân khúc cần > 10 ngày dữ liệu mới hồi quy
+PARALLEL_MIN_SEGMENTS = 200    # Ít phân khúc hơn -> chạy tuần tự (tránh overhead process pool)
+RCOND_BATCHED = 1e-10          # X'X có sv_min / sv_max nhỏ hơn -> coi là suy biến, dùng statsmodels
+
+# Biến giải thích: tên trong mô hình -> cột trong bảng tổng hợp
+PED_REGRESSORS = {
+    "Promotion": "Promotion_Campaign",
+    "Weekend": "Is_Weekend",
+    "Holiday": "Is_Holiday",
+    "Monthly_Index": "Monthly_Index",
+}
+CONTROL_COLS = list(PED_REGRESSORS.values())
+REGRESSOR_NAMES = ["log_Price_Index"] + list(PED_REGRESSORS)
+
+# Tên cột trong df_ped_summary_category
+SEGMENT_LABELS = {"Cluster": "Phân khúc (Cluster)"}
+PED_COL = "PED (β1)"
+PVALUE_COL = "P_Value"
+
+
+# ==============================
+# 1. BẢNG TỔNG HỢP THEO PHÂN KHÚC (BƯỚC 7.2 - 7.4)
+# ==============================
+
+def aggregate_segments(df_full_segmented, df_macro, segment_cols=DEFAULT_SEGMENT_COLS):
+    """
+    Tổng hợp theo Date x segment_cols (Q, Paid, List), tạo Price_Index và nối
+    biến kiểm soát từ df_macro (cột Date dạng string 'YYYY-MM-DD').
+    """
+    df = df_full_segmented
+    df_agg = df.groupby(["Date"] + list(segment_cols), observed=True, sort=True).agg(
+        Total_Quantity=("Quantity", "sum"),
+        Total_Paid_Agg=("Total_Paid", "sum"),
+        Total_List_Price_Agg=("Total_List_Price", "sum")
+    ).reset_index()
+
+    df_agg = df_agg[df_agg["Total_List_Price_Agg"] > 0]
+    df_agg["Price_Index"] = df_agg["Total_Paid_Agg"] / df_agg["Total_List_Price_Agg"]
+    df_agg = df_agg[df_agg["Price_Index"] > 0]
+    df_agg["Date"] = df_agg["Date"].astype(str)
+
+    return pd.merge(df_agg, df_macro[["Date"] + CONTROL_COLS], on="Date", how="left")
+
+
+# ==============================
+# 2. HỒI QUY 1 PHÂN KHÚC
+# ==============================
+
+def design_matrix(df_agg):
+    """Y = log(Q) và X (chưa có hằng số) cho toàn bảng, tính 1 lần trước khi chia phân khúc."""
+    y = np.log(df_agg["Total_Quantity"].to_numpy(dtype=float))
+    X = np.column_stack(
+        [np.log(df_agg["Price_Index"].to_numpy(dtype=float))]
+        + [df_agg[c].to_numpy(dtype=float) for c in CONTROL_COLS]
+    )
+    return y, X
+
+
+def fit_segment_ols(y, X):
+    """
+    OLS bằng statsmodels, giống hệt vòng lặp cũ (add_constant bỏ qua hằng số
+    nếu phân khúc đã có 1 cột hằng khác 0). Trả về (PED, p-value).
+    """
+    Xc = sm.add_constant(X)
+    price_pos = Xc.shape[1] - X.shape[1]   # 1 nếu đã thêm const, 0 nếu không
+    model_ols = sm.OLS(y, Xc).fit()
+    return model_ols.params[price_pos], model_ols.pvalues[price_pos]
+
+
+def _fit_batch(batch):
+    return [fit_segment_ols(y, X) for y, X in batch]
+
+
+def _resolve_n_jobs(n_jobs, n_segments):
+    if n_jobs is None:
+        n_jobs = -1 if n_segments >= PARALLEL_MIN_SEGMENTS else 1
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    return max(1, min(n_jobs, n_segments))
+
+
+def _fit_statsmodels(y_all, X_all, row_groups, n_jobs=None):
+    """Hồi quy statsmodels cho từng nhóm dòng, tuần tự hoặc trên process pool."""
+    batches = [(y_all[rows], X_all[rows]) for rows in row_groups]
+    n_jobs = _resolve_n_jobs(n_jobs, max(len(batches), 1))
+    if n_jobs == 1:
+        return _fit_batch(batches)
+
+    # Gửi theo lô để giảm chi phí pickle giữa các process
+    size = max(1, -(-len(batches) // (n_jobs * 4)))
+    chunks = [batches[i:i + size] for i in range(0, len(batches), size)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return [r for chunk in executor.map(_fit_batch, chunks) for r in chunk]
+
+
+# ==============================
+# 3. HỒI QUY HÀNG LOẠT (PHƯƠNG TRÌNH CHUẨN)
+# ==============================
+
+def fit_segments_batched(y_all, X_all, row_groups):
+    """
+    OLS cho tất cả phân khúc trong 1 lần gọi np.linalg.solve.
+
+    X'X (p x p) và X'y của mỗi phân khúc được cộng dồn bằng np.add.reduceat trên
+    các dòng đã xếp liền nhau theo phân khúc. Cột được chuẩn hóa theo RMS toàn
+    bảng trước khi lập X'X để giảm số điều kiện, hệ số được đổi lại thang đo gốc.
+
+    Trả về (ped, p_value, ok): `ok` = False với phân khúc có X'X suy biến
+    (vd. 1 biến kiểm soát không đổi trong phân khúc) - cần giải lại bằng statsmodels.
+    """
+    n_seg = len(row_groups)
+    if n_seg == 0:
+        return np.array([]), np.array([]), np.array([], dtype=bool)
+
+    sizes = np.array([len(r) for r in row_groups])
+    rows = np.concatenate(row_groups)
+    seg_id = np.repeat(np.arange(n_seg), sizes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    X = np.column_stack([np.ones(len(rows)), X_all[rows]])
+    y = y_all[rows]
+    scale = np.sqrt((X ** 2).mean(axis=0))
+    scale[~(scale > 0)] = 1.0
+    Xs = X / scale
+    p = Xs.shape[1]
+
+    # X'X đối xứng: chỉ cộng dồn nửa trên (p(p+1)/2 cột), không tạo mảng n x p x p
+    XtX = np.empty((n_seg, p, p))
+    for i, j in zip(*np.triu_indices(p)):
+        XtX[:, i, j] = XtX[:, j, i] = np.add.reduceat(Xs[:, i] * Xs[:, j], starts)
+    Xty = np.column_stack([np.add.reduceat(Xs[:, i] * y, starts) for i in range(p)])
+
+    # Phân khúc hợp lệ: X'X hữu hạn và không suy biến
+    ok = np.isfinite(XtX).all(axis=(1, 2)) & np.isfinite(Xty).all(axis=1)
+    eig = np.linalg.eigvalsh(np.where(ok[:, None, None], XtX, np.eye(p)))
+    ok &= eig[:, 0] > eig[:, -1] * RCOND_BATCHED
+    ok &= sizes > p
+
+    # Giải 1 lần cho 2 vế phải: X'y (-> hệ số) và e_1 (-> cột giá của (X'X)^-1)
+    beta = np.zeros((n_seg, p))
+    inv_price = np.zeros(n_seg)
+    if ok.any():
+        rhs = np.zeros((ok.sum(), p, 2))
+        rhs[:, :, 0] = Xty[ok]
+        rhs[:, 1, 1] = 1.0
+        sol = np.linalg.solve(XtX[ok], rhs)
+        beta[ok] = sol[:, :, 0]
+        inv_price[ok] = sol[:, 1, 1]
+
+    # Sai số chuẩn: sigma^2 = RSS / (n - p), Var(b) = sigma^2 (X'X)^-1
+    resid = y - np.einsum("ij,ij->i", Xs, beta[seg_id])
+    rss = np.bincount(seg_id, weights=resid ** 2, minlength=n_seg)
+    df_resid = np.maximum(sizes - p, 1)
+    sigma2 = rss / df_resid
+
+    ped = beta[:, 1] / scale[1]
+    se = np.sqrt(sigma2 * inv_price) / scale[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_stat = ped / se
+    p_value = 2 * stats.t.sf(np.abs(t_stat), df_resid)
+
+    ped[~ok] = np.nan
+    p_value[~ok] = np.nan
+    return ped, p_value, ok
+
+
+# ==============================
+# 4. ƯỚC LƯỢNG PED CHO TẤT CẢ PHÂN KHÚC
+# ==============================
+
+def estimate_ped(df_agg_cat_macro, segment_cols=DEFAULT_SEGMENT_COLS, levels=None,
+                 min_rows=MIN_SEGMENT_ROWS, method="batched", n_jobs=None):
+    """
+    Ước lượng PED cho mọi tổ hợp phân khúc, trả về df_ped_summary_category.
+
+    - levels : dict cột -> danh sách giá trị (giữ thứ tự). Mọi tổ hợp đều có 1 dòng,
+      tổ hợp không đủ dữ liệu (<= min_rows) có PED/P_Value = NaN.
+      Mặc định: các giá trị xuất hiện trong bảng.
+    - method : 'batched' (phương trình chuẩn, mặc định) hoặc 'statsmodels'
+      (sm.OLS từng phân khúc như vòng lặp cũ).
+    - n_jobs : số process cho statsmodels (-1 = tất cả CPU). None -> tự chọn theo số phân khúc.
+
+    Cột kết quả: các cột phân khúc (Cluster đổi tên thành 'Phân khúc (Cluster)',
+    đặt sau cùng), 'PED (β1)', 'P_Value'.
+    """
+    segment_cols = list(segment_cols)
+    levels = dict(levels or {})
+    for c in segment_cols:
+        if c not in levels:
+            levels[c] = df_agg_cat_macro[c].unique()
+
+    y_all, X_all = design_matrix(df_agg_cat_macro)
+
+    # Chia dữ liệu 1 lần: khóa phân khúc -> vị trí dòng
+    groups = df_agg_cat_macro.groupby(segment_cols, observed=True, sort=False).indices
+    if len(segment_cols) == 1:
+        groups = {(k,): v for k, v in groups.items()}
+
+    keys = list(itertools.product(*[levels[c] for c in segment_cols]))
+    to_fit = []
+    for key in keys:
+        rows = groups.get(key)
+        if rows is not None and len(rows) > min_rows:
+            to_fit.append((key, rows))
+
+    row_groups = [rows for _, rows in to_fit]
+    if method == "statsmodels":
+        fitted = _fit_statsmodels(y_all, X_all, row_groups, n_jobs)
+    else:
+        ped, p_value, ok = fit_segments_batched(y_all, X_all, row_groups)
+        fitted = list(zip(ped, p_value))
+        # Phân khúc suy biến: statsmodels (pinv) để giữ đúng kết quả của vòng lặp cũ
+        redo = np.flatnonzero(~ok)
+        if len(redo):
+            refit = _fit_statsmodels(y_all, X_all, [row_groups[i] for i in redo], n_jobs)
+            for i, est in zip(redo, refit):
+                fitted[i] = est
+
+    estimates = {key: est for (key, _), est in zip(to_fit, fitted)}
+    return _summary_frame(keys, estimates, segment_cols)
+
+
+def _summary_frame(keys, estimates, segment_cols):
+    out_cols = [c for c in segment_cols if c not in SEGMENT_LABELS] + \
+               [c for c in segment_cols if c in SEGMENT_LABELS]
+    records = []
+    for key in keys:
+        ped_value, p_value = estimates.get(key, (np.nan, np.nan))
+        row = dict(zip(segment_cols, key))
+        record = {SEGMENT_LABELS.get(c, c): row[c] for c in out_cols}
+        record[PED_COL] = ped_value
+        record[PVALUE_COL] = p_value
+        records.append(record)
+    return pd.DataFrame(records, columns=[SEGMENT_LABELS.get(c, c) for c in out_cols] + [PED_COL, PVALUE_COL])
+
+
+# ==============================
+# 5. BÁO CÁO CHẨN ĐOÁN (STATSMODELS)
+# ==============================
+
+def segment_report(df_agg_cat_macro, segment, segment_cols=DEFAULT_SEGMENT_COLS):
+    """
+    Kết quả sm.OLS đầy đủ (summary(), residuals, ...) cho 1 phân khúc,
+    vd. segment_report(df_agg_cat_macro, (0, 'Coffee')).print(...)
+    """
+    mask = np.ones(len(df_agg_cat_macro), dtype=bool)
+    for col, value in zip(segment_cols, segment):
+        mask &= (df_agg_cat_macro[col] == value).to_numpy()
+    y, X = design_matrix(df_agg_cat_macro[mask])
+    X = sm.add_constant(pd.DataFrame(X, columns=REGRESSOR_NAMES))
+    return sm.OLS(pd.Series(y, name="log_Total_Quantity"), X).fit()
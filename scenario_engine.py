@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Dự báo theo lưới kịch bản (Price_Index x lịch khuyến mãi x COGS) cho phần dự báo Q1.
+
+Thay cho 2 kịch bản cố định A / B (mỗi kịch bản 1 bảng X_future, mỗi mô hình 2
+lần predict): mọi kịch bản x ngày được xếp chồng thành 1 ma trận và mỗi mô hình
+chỉ predict 1 lần. COGS không ảnh hưởng lượng bán nên chỉ các tổ hợp
+(Price_Index, lịch khuyến mãi) được dự báo; COGS được ghép vào khi tính lợi nhuận.
+
+    grid = scenario_grid([0.95, 1.00, 1.02], {"Không KM": []}, [18000, 20000])
+    df_q = forecast_scenarios({"XGB": model_xgb}, grid, df_future_2025, feature_cols)
+    df_profit = profit_surface(df_q, grid, list_price=55000)
+"""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from model_backends import predict_model
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+NO_PROMO = "Không KM"
+SCENARIO_KEYS = ["Price_Index", "Promo_Calendar"]   # Các chiều ảnh hưởng lượng bán
+
+
+# ==============================
+# 1. LƯỚI KỊCH BẢN
+# ==============================
+
+def scenario_grid(price_indices, promo_calendars=None, cogs_values=None):
+    """
+    Tích Descartes Price_Index x lịch khuyến mãi x COGS.
+    `promo_calendars`: tên -> các ngày có Promotion_Campaign = 1 (None -> chỉ NO_PROMO).
+    Trả về dict: scenarios (Scenario, Price_Index, Promo_Calendar, COGS, Demand_Scenario),
+    promo_calendars (tên -> DatetimeIndex).
+    """
+    promo_calendars = promo_calendars if promo_calendars is not None else {NO_PROMO: []}
+    cogs_values = list(cogs_values) if cogs_values is not None else [np.nan]
+    rows = itertools.product(price_indices, promo_calendars, cogs_values)
+    df = pd.DataFrame(list(rows), columns=["Price_Index", "Promo_Calendar", "COGS"])
+    df["Price_Index"] = df["Price_Index"].astype(float)
+    # Mã tổ hợp (Price_Index, lịch KM): các kịch bản chỉ khác COGS dùng chung 1 dự báo
+    df["Demand_Scenario"] = df.groupby(SCENARIO_KEYS, sort=False).ngroup()
+    df.insert(0, "Scenario", np.arange(len(df)))
+    return {
+        "scenarios": df,
+        "promo_calendars": {name: pd.DatetimeIndex(dates) for name, dates in promo_calendars.items()},
+    }
+
+
+def scenario_matrix(grid, df_future, feature_cols):
+    """
+    Ma trận đặc trưng của mọi (Demand_Scenario x ngày), n_demand * n_days dòng.
+    `df_future`: bảng tương lai (index ngày) có các cột lịch của feature_cols.
+    Trả về (X, keys) với keys = Demand_Scenario, Date của từng dòng.
+    """
+    demand = grid["scenarios"].drop_duplicates("Demand_Scenario").set_index("Demand_Scenario")[SCENARIO_KEYS]
+    dates = pd.DatetimeIndex(df_future.index)
+    n_demand, n_days = len(demand), len(dates)
+
+    X = pd.DataFrame({c: np.tile(df_future[c].to_numpy(), n_demand)
+                      for c in feature_cols if c not in ("Price_Index", "Promotion_Campaign")})
+    X["Price_Index"] = np.repeat(demand["Price_Index"].to_numpy(), n_days)
+    promo = np.zeros((n_demand, n_days), dtype=df_future["Promotion_Campaign"].dtype)
+    base_promo = df_future["Promotion_Campaign"].to_numpy()
+    for k, name in enumerate(demand["Promo_Calendar"]):
+        promo[k] = np.where(dates.isin(grid["promo_calendars"][name]), 1, base_promo)
+    X["Promotion_Campaign"] = promo.reshape(-1)
+
+    keys = pd.DataFrame({
+        "Demand_Scenario": np.repeat(demand.index.to_numpy(), n_days),
+        "Date": np.tile(dates.to_numpy(), n_demand),
+    })
+    return X[feature_cols], keys
+
+
+# ==============================
+# 2. DỰ BÁO / LỢI NHUẬN
+# ==============================
+
+def forecast_scenarios(models, grid, df_future, feature_cols, clip_min=0.0):
+    """
+    Lượng bán dự báo theo ngày cho mọi kịch bản, 1 lần predict cho mỗi mô hình.
+    `models`: tên backend (LR, RF, XGB, LSTM) -> mô hình đã fit bằng model_backends.fit_model.
+    Kết quả: Demand_Scenario, Date và 1 cột lượng bán cho mỗi mô hình.
+    """
+    X, df = scenario_matrix(grid, df_future, feature_cols)
+    for name, model in models.items():
+        pred = predict_model(name, model, X)
+        df[name] = np.maximum(pred, clip_min) if clip_min is not None else pred
+    return df
+
+
+def profit_surface(df_forecast, grid, list_price):
+    """
+    Tổng lượng bán / doanh thu / lợi nhuận của mỗi kịch bản x mô hình trên cả kỳ dự báo.
+    Giá bán = list_price x Price_Index; lợi nhuận = lượng bán x (giá bán - COGS).
+    """
+    models = [c for c in df_forecast.columns if c not in ("Demand_Scenario", "Date")]
+    totals = df_forecast.groupby("Demand_Scenario")[models].sum()
+    df = grid["scenarios"].merge(totals, left_on="Demand_Scenario", right_index=True, how="left")
+    df = df.melt(id_vars=list(grid["scenarios"].columns), value_vars=models,
+                 var_name="Model", value_name="Total_Quantity")
+    df["Price_Paid"] = list_price * df["Price_Index"]
+    df["Revenue"] = df["Total_Quantity"] * df["Price_Paid"]
+    df["Profit"] = df["Total_Quantity"] * (df["Price_Paid"] - df["COGS"])
+    return df.drop(columns="Demand_Scenario")
+
+
+def best_scenarios(df_profit, by=("Model", "COGS", "Promo_Calendar")):
+    """Kịch bản lợi nhuận cao nhất cho mỗi nhóm `by` (vd. mỗi mô hình x COGS x lịch KM)."""
+    idx = df_profit.groupby(list(by), sort=False)["Profit"].idxmax()
+    return df_profit.loc[idx].reset_index(drop=True)
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""Các khối dựng cho Giai đoạn 1 - Phân khúc khách hàng (BƯỚC 1-6).
+
+- build_rfm: RFM vector hóa (không dùng lambda theo từng khách hàng)
+- fit_minibatch_kmeans / assign_clusters: K-Means mini-batch (partial_fit theo
+  chunk khách hàng) cho tập khách hàng lớn, gán cụm cho khách mới vào tâm cụm
+  đã lưu (save_centroids / load_centroids) mà không cần huấn luyện lại
+- k_selection_table: bảng chỉ số theo K (BƯỚC 3) - silhouette lấy mẫu có khoảng
+  tin cậy, silhouette rút gọn theo tâm cụm, Davies-Bouldin, Calinski-Harabasz;
+  mỗi K chạy song song
+Mọi hàm nhận X dày hoặc thưa (CSR, đầu ra của preprocessor BƯỚC 2).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import euclidean_distances, pairwise_distances_argmin, silhouette_score
+from threadpoolctl import threadpool_limits
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+MINIBATCH_CHUNK_SIZE = 10_000   # Số khách hàng mỗi lần partial_fit / transform
+MINIBATCH_N_EPOCHS = 5          # Số lượt duyệt qua toàn bộ khách hàng
+LLOYD_MAX_PASSES = 10           # Số lượt tinh chỉnh Lloyd (cộng dồn theo chunk) sau mini-batch
+LLOYD_TOL = 1e-4                # Dừng khi tâm cụm dịch chuyển (tương đối) nhỏ hơn ngưỡng
+CENTROIDS_FILE = "kmeans_centroids.npz"
+
+K_RANGE = range(2, 9)              # Kiểm tra từ 2 đến 8 cụm
+SILHOUETTE_SAMPLE_SIZE = 5_000     # Silhouette đầy đủ là O(n^2) -> tính trên mẫu
+SILHOUETTE_N_REPEATS = 5           # Số lần lấy mẫu (để ước lượng khoảng tin cậy)
+SILHOUETTE_CI_LEVEL = 0.95
+
+
+# ==============================
+# 1. RFM
+# ==============================
+
+def build_rfm(df_trans, snapshot_date=None, windows=()):
+    """
+    Tính Recency / Frequency / Monetary cho từng Customer_ID, cùng kết quả với
+
+        df_trans.groupby('Customer_ID').agg(
+            Recency=('Date_Time', lambda x: (snapshot_date - x.max()).days),
+            Frequency=('Transaction_ID', 'nunique'),
+            Monetary=('Total_Paid', 'sum'))
+
+    nhưng chỉ dùng phép rút gọn gốc của NumPy trên mã số nguyên (factorize):
+    max theo nhóm, đếm cặp (khách, đơn) không trùng, bincount có trọng số.
+
+    `windows` (vd. (30, 90)) thêm các cột Frequency_30d, Frequency_90d:
+    số đơn trong N ngày trước snapshot_date.
+    """
+    date_time = pd.to_datetime(df_trans["Date_Time"])
+    if snapshot_date is None:
+        snapshot_date = date_time.max() + pd.Timedelta(days=1)
+
+    cust_codes, cust_uniques = pd.factorize(df_trans["Customer_ID"], sort=True)
+    txn_codes, txn_uniques = pd.factorize(df_trans["Transaction_ID"])
+    valid = cust_codes >= 0
+    n_cust = len(cust_uniques)
+
+    codes = cust_codes[valid]
+    date_time = date_time[valid]
+
+    # Recency: lần mua cuối theo khách (groupby max trên mã số, NaT bị bỏ qua)
+    last_purchase = date_time.groupby(codes).max().reindex(range(n_cust))
+    recency = (snapshot_date - last_purchase).dt.days.to_numpy()
+
+    # Frequency: số cặp (khách, đơn) khác nhau; Transaction_ID thiếu (mã -1) không tính như nunique
+    # (mã + 1) để đơn thiếu (-1 -> 0) không trùng khóa với đơn cuối của khách liền trước
+    txn = txn_codes[valid]
+    pair_key = codes.astype(np.int64) * (len(txn_uniques) + 1) + (txn + 1)
+    first_pair = ~pd.Series(pair_key).duplicated().to_numpy() & (txn >= 0)
+    frequency = np.bincount(codes[first_pair], minlength=n_cust)
+
+    # Monetary: tổng chi, bỏ qua Total_Paid thiếu như sum
+    paid = np.nan_to_num(df_trans["Total_Paid"].to_numpy(dtype=float)[valid])
+    monetary = np.bincount(codes, weights=paid, minlength=n_cust)
+
+    rfm_df = pd.DataFrame({
+        "Customer_ID": np.asarray(cust_uniques),
+        "Recency": recency,
+        "Frequency": frequency,
+        "Monetary": monetary,
+    })
+
+    for days in windows:
+        in_window = first_pair & (date_time >= snapshot_date - pd.Timedelta(days=days)).to_numpy()
+        rfm_df[f"Frequency_{days}d"] = np.bincount(codes[in_window], minlength=n_cust)
+
+    return rfm_df
+
+
+# ==============================
+# 2. TIỀN XỬ LÝ (BƯỚC 2)
+# ==============================
+
+def cast_features(X, dtype=np.float64):
+    """
+    Bước cuối của preprocessor (FunctionTransformer): ép ma trận đặc trưng
+    (dày hoặc CSR) về `dtype` mà không sao chép nếu đã đúng kiểu.
+    """
+    return X.astype(dtype, copy=False)
+
+
+# ==============================
+# 3. K-MEANS MINI-BATCH
+# ==============================
+
+def iter_feature_chunks(X, chunk_size=MINIBATCH_CHUNK_SIZE, preprocessor=None, order=None):
+    """
+    Sinh từng khối đặc trưng đã chuẩn hóa.
+    - X: ma trận đã qua preprocessor, hoặc df_model_input (khi truyền `preprocessor`
+      đã fit - khi đó chỉ 1 chunk được transform tại mỗi thời điểm)
+    - order: thứ tự dòng (vd. hoán vị ngẫu nhiên cho mỗi epoch)
+    """
+    n = X.shape[0]
+    if order is None:
+        order = np.arange(n)
+    for start in range(0, n, chunk_size):
+        idx = order[start:start + chunk_size]
+        chunk = X.iloc[idx] if isinstance(X, pd.DataFrame) else X[idx]
+        if preprocessor is not None:
+            chunk = preprocessor.transform(chunk)
+        yield idx, chunk
+
+
+def refine_centroids(X, centroids, preprocessor=None, chunk_size=MINIBATCH_CHUNK_SIZE,
+                     max_passes=LLOYD_MAX_PASSES, tol=LLOYD_TOL):
+    """
+    Các vòng Lloyd (giống KMeans.fit) nhưng đọc dữ liệu theo chunk: mỗi lượt
+    cộng dồn tổng và số lượng điểm theo cụm rồi cập nhật tâm. Bộ nhớ chỉ
+    phụ thuộc kích thước chunk.
+    """
+    centroids = np.array(centroids, dtype=float)
+    n_clusters = centroids.shape[0]
+    for _ in range(max_passes):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(n_clusters)
+        for _, chunk in iter_feature_chunks(X, chunk_size, preprocessor):
+            one_hot = np.eye(n_clusters)[pairwise_distances_argmin(chunk, centroids)]
+            sums += np.asarray((chunk.T @ one_hot).T)
+            counts += one_hot.sum(axis=0)
+        # Cụm rỗng giữ nguyên tâm cũ
+        new_centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        shift = np.abs(new_centroids - centroids).sum() / max(np.abs(centroids).sum(), 1e-12)
+        centroids = new_centroids
+        if shift < tol:
+            break
+    return centroids
+
+
+def fit_minibatch_kmeans(X, n_clusters, preprocessor=None, chunk_size=MINIBATCH_CHUNK_SIZE,
+                         n_epochs=MINIBATCH_N_EPOCHS, init_centroids=None, refine=True,
+                         random_state=42, verbose=False):
+    """
+    Huấn luyện MiniBatchKMeans bằng partial_fit trên từng chunk khách hàng
+    (xáo trộn lại thứ tự mỗi epoch). `init_centroids` (vd. từ load_centroids)
+    cho phép cập nhật tiếp mô hình cũ thay vì khởi tạo k-means++ lại từ đầu.
+    `refine=True`: sau mini-batch chạy thêm các vòng Lloyd theo chunk
+    (refine_centroids) để inertia sát với KMeans đầy đủ.
+    """
+    init = "k-means++" if init_centroids is None else np.asarray(init_centroids)
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        init=init,
+        n_init=1,
+        batch_size=chunk_size,
+        random_state=random_state,
+    )
+    rng = np.random.default_rng(random_state)
+    for epoch in range(n_epochs):
+        order = rng.permutation(X.shape[0])
+        for _, chunk in iter_feature_chunks(X, chunk_size, preprocessor, order):
+            model.partial_fit(chunk)
+        if verbose:
+            print(f"  [minibatch] Epoch {epoch + 1}/{n_epochs} xong.")
+
+    if refine:
+        model.cluster_centers_ = refine_centroids(X, model.cluster_centers_, preprocessor, chunk_size)
+    return model
+
+
+def assign_clusters(X, centroids, preprocessor=None, chunk_size=MINIBATCH_CHUNK_SIZE):
+    """Gán mỗi khách hàng vào tâm cụm gần nhất (theo chunk, không huấn luyện lại)."""
+    centroids = np.asarray(centroids)
+    labels = np.empty(X.shape[0], dtype=np.int32)
+    for idx, chunk in iter_feature_chunks(X, chunk_size, preprocessor):
+        labels[idx] = pairwise_distances_argmin(chunk, centroids)
+    return labels
+
+
+def save_centroids(centroids, path=CENTROIDS_FILE):
+    """Lưu tâm cụm (ghi nguyên tử) để BƯỚC 7 / lần chạy sau gán cụm không cần fit lại."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, centroids=np.asarray(centroids))
+    os.replace(tmp_path, path)
+
+
+def load_centroids(path=CENTROIDS_FILE):
+    with np.load(path) as data:
+        return data["centroids"]
+
+
+# ==============================
+# 4. CHỌN SỐ CỤM K (BƯỚC 3)
+# ==============================
+
+def sampled_silhouette(X, labels, sample_size=SILHOUETTE_SAMPLE_SIZE, n_repeats=SILHOUETTE_N_REPEATS,
+                       ci_level=SILHOUETTE_CI_LEVEL, random_state=42):
+    """
+    Silhouette trên `n_repeats` mẫu ngẫu nhiên cỡ `sample_size`.
+    Trả về (trung bình, cận dưới, cận trên) của khoảng tin cậy t-Student.
+    Nếu n <= sample_size thì tính chính xác trên toàn bộ (khoảng tin cậy độ rộng 0).
+    """
+    n = X.shape[0]
+    if n <= sample_size:
+        score = silhouette_score(X, labels)
+        return score, score, score
+
+    scores = np.array([
+        silhouette_score(X, labels, sample_size=sample_size, random_state=random_state + i)
+        for i in range(n_repeats)
+    ])
+    mean = scores.mean()
+    half = stats.t.ppf(0.5 + ci_level / 2, n_repeats - 1) * scores.std(ddof=1) / np.sqrt(n_repeats)
+    return mean, mean - half, mean + half
+
+
+def cluster_scores(X, labels, chunk_size=MINIBATCH_CHUNK_SIZE):
+    """
+    Các chỉ số O(n*K) tính theo tâm cụm (trung bình của cụm), đọc X theo chunk,
+    dùng được cho X thưa (CSR) - sklearn davies_bouldin_score /
+    calinski_harabasz_score chỉ nhận ma trận dày:
+    - Simplified_Silhouette: a(i) = khoảng cách tới tâm cụm của mình,
+      b(i) = khoảng cách tới tâm cụm gần nhất khác
+    - Within_SS (tổng bình phương trong cụm), Davies_Bouldin, Calinski_Harabasz
+    """
+    n = X.shape[0]
+    cluster_ids, codes = np.unique(labels, return_inverse=True)
+    n_clusters = len(cluster_ids)
+
+    # Lượt 1: tâm cụm = trung bình các điểm
+    sums = np.zeros((n_clusters, X.shape[1]))
+    for start in range(0, n, chunk_size):
+        one_hot = np.eye(n_clusters)[codes[start:start + chunk_size]]
+        sums += np.asarray((X[start:start + chunk_size].T @ one_hot).T)
+    counts = np.bincount(codes, minlength=n_clusters)
+    means = sums / counts[:, None]
+
+    # Lượt 2: khoảng cách tới các tâm
+    sil_total, within_ss = 0.0, 0.0
+    intra = np.zeros(n_clusters)
+    for start in range(0, n, chunk_size):
+        chunk_codes = codes[start:start + chunk_size]
+        dist = euclidean_distances(X[start:start + chunk_size], means)
+        rows = np.arange(len(chunk_codes))
+        a = dist[rows, chunk_codes]
+        intra += np.bincount(chunk_codes, weights=a, minlength=n_clusters)
+        within_ss += (a ** 2).sum()
+        if n_clusters > 1:
+            dist[rows, chunk_codes] = np.inf
+            b = dist.min(axis=1)
+            denom = np.maximum(a, b)
+            sil_total += np.where(denom > 0, (b - a) / np.where(denom > 0, denom, 1), 0.0).sum()
+    if n_clusters < 2:
+        return {"Simplified_Silhouette": np.nan, "Within_SS": within_ss,
+                "Davies_Bouldin": np.nan, "Calinski_Harabasz": np.nan}
+
+    # Davies-Bouldin (cùng công thức với sklearn)
+    intra /= counts
+    centroid_dist = euclidean_distances(means)
+    if np.allclose(intra, 0) or np.allclose(centroid_dist, 0):
+        davies_bouldin = 0.0
+    else:
+        centroid_dist[centroid_dist == 0] = np.inf
+        davies_bouldin = np.max((intra[:, None] + intra[None, :]) / centroid_dist, axis=1).mean()
+
+    # Calinski-Harabasz
+    overall_mean = sums.sum(axis=0) / n
+    between_ss = (counts * ((means - overall_mean) ** 2).sum(axis=1)).sum()
+    calinski = 1.0 if within_ss == 0 else between_ss * (n - n_clusters) / (within_ss * (n_clusters - 1))
+
+    return {
+        "Simplified_Silhouette": sil_total / n,
+        "Within_SS": within_ss,
+        "Davies_Bouldin": davies_bouldin,
+        "Calinski_Harabasz": calinski,
+    }
+
+
+# X dùng chung trong mỗi process (gửi 1 lần qua initializer, không pickle lại cho từng K)
+_K_SWEEP_X = None
+
+
+def _init_k_worker(X):
+    global _K_SWEEP_X
+    _K_SWEEP_X = X
+
+
+def _score_k(task):
+    k, mode, sample_size, n_repeats, random_state, n_threads = task
+    X = _K_SWEEP_X
+    with threadpool_limits(limits=n_threads):
+        if mode == "minibatch":
+            model = fit_minibatch_kmeans(X, k, random_state=random_state)
+            labels = assign_clusters(X, model.cluster_centers_)
+        else:
+            model = KMeans(n_clusters=k, init="k-means++", random_state=random_state, n_init=10)
+            labels = model.fit_predict(X)
+        sil, sil_low, sil_high = sampled_silhouette(X, labels, sample_size, n_repeats, random_state=random_state)
+        scores = cluster_scores(X, labels)
+        return {
+            "K": k,
+            "Inertia": scores["Within_SS"] if mode == "minibatch" else model.inertia_,
+            "Silhouette": sil,
+            "Silhouette_CI_Low": sil_low,
+            "Silhouette_CI_High": sil_high,
+            "Simplified_Silhouette": scores["Simplified_Silhouette"],
+            "Davies_Bouldin": scores["Davies_Bouldin"],
+            "Calinski_Harabasz": scores["Calinski_Harabasz"],
+        }
+
+
+def k_selection_table(X, k_range=K_RANGE, mode="full", sample_size=SILHOUETTE_SAMPLE_SIZE,
+                      n_repeats=SILHOUETTE_N_REPEATS, n_jobs=-1, random_state=42):
+    """
+    Bảng chỉ số theo K để chọn N_CLUSTERS (thay vòng lặp Elbow/Silhouette của BƯỚC 3).
+    - mode: 'full' (KMeans n_init=10) hoặc 'minibatch' (fit_minibatch_kmeans)
+    - n_jobs: số process (mỗi K 1 tác vụ, -1 = tất cả CPU)
+    Cùng random_state -> cùng kết quả, không phụ thuộc n_jobs.
+    """
+    k_values = list(k_range)
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(k_values)))
+    # Chia CPU giữa các process để KMeans (OpenMP/BLAS) không tranh luồng
+    n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+    tasks = [(k, mode, sample_size, n_repeats, random_state, n_threads) for k in k_values]
+
+    if n_jobs == 1:
+        _init_k_worker(X)
+        try:
+            rows = [_score_k(t) for t in tasks]
+        finally:
+            _init_k_worker(None)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_k_worker, initargs=(X,)) as executor:
+            rows = list(executor.map(_score_k, tasks))
+
+    return pd.DataFrame(rows)
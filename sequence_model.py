@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""LSTM chung cho mọi chuỗi Store_ID x Product_ID, học trên cửa sổ trượt nhiều ngày.
+
+Khác LSTM của các phần dự báo (mỗi ngày là 1 chuỗi dài 1 bước), mỗi mẫu ở đây là
+`window` ngày liên tiếp của 1 chuỗi (lượng bán đã chuẩn hóa + đặc trưng ngày / giá)
+cùng đặc trưng đã biết của ngày cần dự báo. Mọi chuỗi dùng chung 1 mạng.
+
+Dữ liệu chỉ nạp 1 lần thành 1 tensor (chuỗi x ngày x đặc trưng); pipeline tf.data
+chỉ giữ chỉ số (chuỗi, ngày) và cắt cửa sổ theo từng batch bằng tf.gather, nên bộ
+nhớ không nhân lên theo độ dài cửa sổ. Huấn luyện trên CPU với số luồng cấu hình
+được. TensorFlow chỉ được import khi gọi các hàm huấn luyện / dự báo.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from forecast_engine import (DEFAULT_SCENARIOS, FEATURE_COLS, MIN_SERIES_ROWS, N_DAYS_FORECAST,
+                             future_frame, long_frame, macro_features, series_matrix, series_pairs)
+from series_store import SERIES_DIR_NAME, open_series_store
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+SEQ_WINDOW = 28          # Số ngày lịch sử mỗi mẫu
+SEQ_UNITS = 64           # Số unit của LSTM / lớp Dense
+SEQ_EPOCHS = 20
+SEQ_BATCH_SIZE = 512
+SEQ_THREADS = 4          # Số luồng CPU cho TensorFlow (intra-op)
+SEQ_PREFIX = "LSTM_SEQ"
+
+# Kênh 0 là lượng bán đã chuẩn hóa, các kênh sau là đặc trưng đã biết trước của ngày
+SEQ_COVARIATES = ["Price_Index", "Is_Weekend", "Is_Holiday", "Promotion_Campaign", "Month", "DayOfWeek"]
+
+
+# ==============================
+# 1. TENSOR (CHUỖI x NGÀY x ĐẶC TRƯNG)
+# ==============================
+
+def _covariate_channels(price_index, df_days):
+    """Đặc trưng đã biết của từng ngày, (chuỗi x ngày x len(SEQ_COVARIATES)), đưa về khoảng [0, 1]."""
+    n_series, n_days = price_index.shape
+    C = np.empty((n_series, n_days, len(SEQ_COVARIATES)), dtype=np.float32)
+    C[:, :, 0] = price_index
+    for k, col in enumerate(SEQ_COVARIATES[1:4], start=1):
+        C[:, :, k] = df_days[col].to_numpy(dtype=np.float32)
+    C[:, :, 4] = (df_days.index.month.to_numpy() - 1) / 11.0
+    C[:, :, 5] = df_days.index.dayofweek.to_numpy() / 6.0
+    return C
+
+
+def sequence_tensor(Q, P, macro, dates):
+    """
+    Tensor float32 (chuỗi x ngày x 1 + len(SEQ_COVARIATES)) và hệ số chuẩn hóa của
+    từng chuỗi. Kênh 0 = Quantity / trung bình lượng bán của chuỗi.
+    """
+    scale = np.maximum(np.nanmean(Q, axis=1), 1e-6)
+    df_days = macro.reindex(dates).fillna(0)
+    S = np.empty((Q.shape[0], Q.shape[1], 1 + len(SEQ_COVARIATES)), dtype=np.float32)
+    S[:, :, 0] = np.nan_to_num(Q / scale[:, None])
+    S[:, :, 1:] = _covariate_channels(P, df_days)
+    return S, scale
+
+
+def window_index(n_series, n_days, window=SEQ_WINDOW):
+    """Cặp (chuỗi, ngày mục tiêu) có đủ `window` ngày lịch sử, int32 (n_mẫu x 2)."""
+    t = np.arange(window, n_days, dtype=np.int32)
+    s = np.arange(n_series, dtype=np.int32)
+    return np.stack([np.repeat(s, len(t)), np.tile(t, n_series)], axis=1)
+
+
+# ==============================
+# 2. TENSORFLOW: LUỒNG CPU, tf.data, MẠNG
+# ==============================
+
+def _tf():
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+    import tensorflow as tf  # Chỉ nạp khi thật sự huấn luyện / dự báo LSTM
+    tf.get_logger().setLevel("ERROR")
+    return tf
+
+
+def configure_threads(n_threads=SEQ_THREADS):
+    """Chạy trên CPU với `n_threads` luồng; phải gọi trước khi TensorFlow chạy phép tính đầu tiên."""
+    tf = _tf()
+    try:
+        tf.config.set_visible_devices([], "GPU")
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(max(1, n_threads // 2))
+    except RuntimeError:
+        print("[seq] TensorFlow đã khởi tạo, giữ nguyên cấu hình luồng hiện tại")
+
+
+def make_dataset(S, index, window=SEQ_WINDOW, batch_size=SEQ_BATCH_SIZE, shuffle=True, seed=42):
+    """
+    tf.data cho các mẫu `index` (chuỗi, ngày mục tiêu): ((cửa sổ, đặc trưng ngày mục tiêu), lượng bán).
+    Cửa sổ được cắt từ tensor S theo từng batch, không tạo sẵn toàn bộ cửa sổ.
+    """
+    tf = _tf()
+    n_days, n_channels = S.shape[1], S.shape[2]
+    S_flat = tf.constant(S.reshape(-1, n_channels))
+    offsets = tf.range(-window, 0, dtype=tf.int32)
+
+    ds = tf.data.Dataset.from_tensor_slices(index)
+    if shuffle:
+        ds = ds.shuffle(len(index), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+
+    def _gather(idx):
+        row = idx[:, 0] * n_days + idx[:, 1]
+        windows = tf.gather(S_flat, row[:, None] + offsets[None, :])
+        target_day = tf.gather(S_flat, row)
+        return (windows, target_day[:, 1:]), target_day[:, :1]
+
+    return ds.map(_gather, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+def build_sequence_model(window=SEQ_WINDOW, n_channels=1 + len(SEQ_COVARIATES), units=SEQ_UNITS):
+    """LSTM trên cửa sổ lịch sử, ghép với đặc trưng ngày mục tiêu -> Dense -> lượng bán đã chuẩn hóa."""
+    tf = _tf()
+    layers = tf.keras.layers
+    seq_in = tf.keras.Input(shape=(window, n_channels), name="history")
+    day_in = tf.keras.Input(shape=(n_channels - 1,), name="target_day")
+    h = layers.LSTM(units)(seq_in)
+    h = layers.Concatenate()([h, day_in])
+    h = layers.Dense(units, activation="relu")(h)
+    out = layers.Dense(1)(h)
+    model = tf.keras.Model([seq_in, day_in], out)
+    model.compile(optimizer="adam", loss="mse")
+    return model
+
+
+# ==============================
+# 3. HUẤN LUYỆN / DỰ BÁO MỌI CHUỖI
+# ==============================
+
+def fit_sequence_model(df_macro, store_dir=SERIES_DIR_NAME, window=SEQ_WINDOW, epochs=SEQ_EPOCHS,
+                       batch_size=SEQ_BATCH_SIZE, n_threads=SEQ_THREADS, units=SEQ_UNITS,
+                       min_rows=MIN_SERIES_ROWS, verbose=False):
+    """1 LSTM chung cho mọi chuỗi của kho `store_dir`. Trả về dict dùng cho forecast_sequence."""
+    configure_threads(n_threads)
+    tf = _tf()
+    series = open_series_store(store_dir)
+    pairs = series_pairs(series, min_rows)
+    Q, P, s_idx, p_idx = series_matrix(series, pairs)
+    dates = series["dates"]
+    S, scale = sequence_tensor(Q, P, macro_features(df_macro), dates)
+    index = window_index(len(pairs), len(dates), window)
+
+    model = build_sequence_model(window, S.shape[2], units)
+    early_stop = tf.keras.callbacks.EarlyStopping(monitor="loss", patience=3, restore_best_weights=True)
+    model.fit(make_dataset(S, index, window, batch_size), epochs=epochs, verbose=0, callbacks=[early_stop])
+    if verbose:
+        print(f"[seq] 1 LSTM cho {len(pairs):,} chuỗi, {len(index):,} cửa sổ {window} ngày")
+    return {
+        "model": model,
+        "pairs": pairs,
+        "store_dir": store_dir,
+        "window": window,
+        "scale": scale,
+        "s_idx": s_idx,
+        "p_idx": p_idx,
+        "history": S[:, -window:, :].copy(),   # Cửa sổ cuối, điểm xuất phát của dự báo
+    }
+
+
+def forecast_sequence(seq_model, future_start=None, n_days=N_DAYS_FORECAST, scenarios=DEFAULT_SCENARIOS,
+                      batch_size=SEQ_BATCH_SIZE, prefix=SEQ_PREFIX):
+    """
+    Dự báo đệ quy n_days ngày cho mọi chuỗi x kịch bản: mỗi ngày 1 lần predict cho cả
+    lô (chuỗi x kịch bản), giá trị dự báo được nối vào cửa sổ cho ngày kế tiếp.
+    Kết quả cùng dạng với forecast_global: Store_ID, Product_ID, Date, LSTM_SEQ_A, ...
+    """
+    series = open_series_store(seq_model["store_dir"])
+    last_date = series["dates"][-1]
+    if future_start is None:
+        future_start = last_date + pd.Timedelta(days=1)
+    if pd.Timestamp(future_start) != last_date + pd.Timedelta(days=1):
+        raise ValueError("future_start phải là ngày ngay sau ngày cuối của kho chuỗi.")
+
+    model, scale = seq_model["model"], seq_model["scale"]
+    n_series = len(seq_model["pairs"])
+    names = list(scenarios)
+    # Các kịch bản xếp chồng theo trục chuỗi: 1 lần predict mỗi ngày cho mọi kịch bản
+    days = [future_frame(future_start, n_days, scenarios[name]) for name in names]
+    future_dates = days[0].index
+    C = np.concatenate([
+        _covariate_channels(np.full((n_series, n_days), scenarios[name], dtype=np.float32), df[FEATURE_COLS])
+        for name, df in zip(names, days)
+    ])
+    buffer = np.tile(seq_model["history"], (len(names), 1, 1))
+    preds = np.empty((len(names) * n_series, n_days), dtype=np.float32)
+    for j in range(n_days):
+        y = model.predict([buffer, C[:, j, :]], batch_size=batch_size, verbose=0)[:, 0]
+        y = np.maximum(y, 0)
+        preds[:, j] = y
+        step = np.concatenate([y[:, None], C[:, j, :]], axis=1)
+        buffer = np.concatenate([buffer[:, 1:, :], step[:, None, :]], axis=1)
+
+    s_idx, p_idx = seq_model["s_idx"], seq_model["p_idx"]
+    columns = {f"{prefix}_{name}": preds[k * n_series:(k + 1) * n_series] * scale[:, None]
+               for k, name in enumerate(names)}
+    result = long_frame(series, s_idx, p_idx, future_dates, columns).drop(columns=["Month", "DayOfWeek"])
+    for c in ["Store_ID", "Product_ID"]:
+        result[c] = result[c].astype(result[c].cat.categories.dtype)
+    return result
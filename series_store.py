@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""Kho chuỗi thời gian theo ngày (cửa hàng x sản phẩm x ngày) lưu trên đĩa dạng memmap.
+
+Mỗi đại lượng (Quantity, Total_Paid, Total_List_Price) là 1 file .npy 3 chiều
+(store, product, day), thứ tự C: chuỗi theo ngày của 1 cặp (store, product)
+nằm liền nhau trên đĩa. Dự báo / PED mở file bằng np.load(mmap_mode="r") và cắt
+lát trực tiếp (view, không sao chép); hệ điều hành chỉ nạp các trang được đọc,
+nên huấn luyện trên hàng nghìn chuỗi không cần đưa toàn bộ vào RAM.
+
+    .hl_series/
+        meta.json                 (danh sách store, product, ngày bắt đầu, fingerprint nguồn)
+        Quantity.npy
+        Total_Paid.npy
+        Total_List_Price.npy
+        pair_rows.npy             (số dòng giao dịch của từng cặp store x product)
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_access import file_fingerprint, fingerprint_matches, load_table
+from streaming_aggregates import DEFAULT_CHUNKSIZE, iter_transaction_chunks, product_lookup_table
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+SERIES_DIR_NAME = ".hl_series"
+SERIES_SCHEMA_VERSION = 1
+SERIES_FIELDS = ["Quantity", "Total_Paid", "Total_List_Price"]
+SERIES_DTYPE = np.float64
+SERIES_SOURCES = ["transaction_data.csv", "product_master.csv"]
+
+# Tên cột giống df_daily_agg của file dự báo (BƯỚC 1.2)
+DAILY_AGG_COLUMNS = {
+    "Quantity": "Total_Quantity",
+    "Total_Paid": "Total_Paid_Agg",
+    "Total_List_Price": "Total_List_Price_Agg",
+}
+
+
+# ==============================
+# 1. TỔNG HỢP GIAO DỊCH THEO (STORE, PRODUCT, DAY)
+# ==============================
+
+def _to_list(values):
+    # Giữ kiểu gốc (số / chuỗi) của ID khi ghi JSON
+    return [v.item() if hasattr(v, "item") else v for v in values]
+
+
+def _chunk_cells(chunk, product_lookup, stores, products, start):
+    """
+    Rút gọn 1 chunk thành (vị trí phẳng trong mảng 3 chiều, tổng từng đại lượng,
+    số dòng). Giá niêm yết lấy từ product_master, thiếu thì dùng giá ghi nhận
+    (cùng logic BƯỚC 1.1 của file dự báo).
+    """
+    chunk = chunk.dropna(subset=["Date_Time"])
+    list_price = chunk["Unit_Price_Listed"]
+    if product_lookup is not None:
+        list_price = chunk["Product_ID"].map(product_lookup["Unit_Price_List"]).fillna(list_price)
+
+    s = stores.get_indexer(chunk["Store_ID"])
+    p = products.get_indexer(chunk["Product_ID"])
+    d = (chunk["Date_Time"].to_numpy().astype("datetime64[D]") - start).astype(np.int64)
+
+    values = pd.DataFrame({
+        "Quantity": chunk["Quantity"].to_numpy(dtype=SERIES_DTYPE),
+        "Total_Paid": chunk["Total_Paid"].to_numpy(dtype=SERIES_DTYPE),
+        "Total_List_Price": (chunk["Quantity"] * list_price).to_numpy(dtype=SERIES_DTYPE),
+    })
+    return s, p, d, values
+
+
+def _scan_keys(chunks):
+    # Lượt 1: danh sách store, product và khoảng ngày
+    stores, products = set(), set()
+    first, last = None, None
+    for chunk in chunks:
+        chunk = chunk.dropna(subset=["Date_Time"])
+        if len(chunk) == 0:
+            continue
+        stores.update(chunk["Store_ID"].unique())
+        products.update(chunk["Product_ID"].unique())
+        lo, hi = chunk["Date_Time"].min(), chunk["Date_Time"].max()
+        first = lo if first is None else min(first, lo)
+        last = hi if last is None else max(last, hi)
+    if first is None:
+        raise ValueError("transaction_data không có dòng giao dịch nào.")
+    return (
+        pd.Index(sorted(stores, key=str)),
+        pd.Index(sorted(products, key=str)),
+        np.datetime64(first.normalize(), "D"),
+        np.datetime64(last.normalize(), "D"),
+    )
+
+
+def build_series_store(df_trans, df_product=None, store_dir=SERIES_DIR_NAME,
+                       chunksize=DEFAULT_CHUNKSIZE, sources=None, verbose=False):
+    """
+    Ghi kho chuỗi từ `df_trans` (DataFrame, hoặc đường dẫn CSV / Parquet - khi đó
+    đọc theo chunk 2 lượt, bộ nhớ chỉ phụ thuộc chunksize và số ô có giao dịch).
+    `sources`: {tên file: fingerprint} lưu vào meta để load_series_store kiểm tra.
+    """
+    if isinstance(df_trans, str):
+        path = df_trans
+        chunks = lambda: iter_transaction_chunks(path, chunksize)
+    else:
+        chunks = lambda: [df_trans]
+    stores, products, start, end = _scan_keys(chunks())
+    n_days = int((end - start).astype(np.int64)) + 1
+    shape = (len(stores), len(products), n_days)
+
+    os.makedirs(store_dir, exist_ok=True)
+    meta_path = os.path.join(store_dir, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)  # Kho cũ không còn hợp lệ trong lúc ghi lại
+
+    # open_memmap tạo file toàn 0 (sparse trên đĩa); chỉ ghi các ô có giao dịch
+    arrays = {
+        f: np.lib.format.open_memmap(os.path.join(store_dir, f"{f}.npy"), mode="w+",
+                                     dtype=SERIES_DTYPE, shape=shape)
+        for f in SERIES_FIELDS
+    }
+    pair_rows = np.zeros(shape[:2], dtype=np.int64)
+    product_lookup = product_lookup_table(df_product)
+
+    for i, chunk in enumerate(chunks()):
+        s, p, d, values = _chunk_cells(chunk, product_lookup, stores, products, start)
+        flat = np.ravel_multi_index((s, p, d), shape)
+        sums = values.groupby(flat).sum()
+        cells = sums.index.to_numpy()
+        for f in SERIES_FIELDS:
+            # Ô trong `cells` là duy nhất -> cộng dồn trực tiếp (ngày có thể vắt qua 2 chunk)
+            arrays[f].reshape(-1)[cells] += sums[f].to_numpy()
+        pair_rows += np.bincount(s * shape[1] + p, minlength=shape[0] * shape[1]).reshape(shape[:2])
+        if verbose:
+            print(f"  [series] Chunk {i + 1}: {len(chunk):,} dòng, {len(cells):,} ô (store x product x ngày)")
+
+    for f in SERIES_FIELDS:
+        arrays[f].flush()
+    del arrays
+    np.save(os.path.join(store_dir, "pair_rows.npy"), pair_rows)
+
+    meta = {
+        "schema_version": SERIES_SCHEMA_VERSION,
+        "fields": SERIES_FIELDS,
+        "stores": _to_list(stores),
+        "products": _to_list(products),
+        "start": str(start),
+        "n_days": n_days,
+        "sources": sources or {},
+    }
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)  # meta ghi sau cùng: kho dở dang không bao giờ được mở
+    return open_series_store(store_dir)
+
+
+# ==============================
+# 2. MỞ KHO (MEMMAP, CHỈ ĐỌC)
+# ==============================
+
+def open_series_store(store_dir=SERIES_DIR_NAME):
+    """
+    Mở kho ở chế độ chỉ đọc. Kết quả là dict: stores / products (pd.Index),
+    dates (DatetimeIndex), pair_rows và 1 memmap (store, product, day) cho mỗi đại lượng.
+    """
+    meta_path = os.path.join(store_dir, "meta.json")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("schema_version") != SERIES_SCHEMA_VERSION:
+        raise ValueError(f"Kho chuỗi tại {store_dir} khác phiên bản, cần build_series_store lại.")
+
+    series = {
+        "meta": meta,
+        "stores": pd.Index(meta["stores"]),
+        "products": pd.Index(meta["products"]),
+        "dates": pd.date_range(meta["start"], periods=meta["n_days"], freq="D"),
+        "pair_rows": np.load(os.path.join(store_dir, "pair_rows.npy")),
+    }
+    for f in meta["fields"]:
+        series[f] = np.load(os.path.join(store_dir, f"{f}.npy"), mmap_mode="r")
+    return series
+
+
+def load_series_store(data_dir=".", store_dir=None, sources=SERIES_SOURCES,
+                      chunksize=DEFAULT_CHUNKSIZE, verbose=False):
+    """
+    Mở kho chuỗi nếu transaction_data / product_master không đổi kể từ lần ghi,
+    ngược lại đọc lại CSV theo chunk và ghi kho mới.
+    """
+    store_dir = store_dir or os.path.join(data_dir, SERIES_DIR_NAME)
+    paths = {name: os.path.join(data_dir, name) for name in sources}
+    for path in paths.values():
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+    try:
+        series = open_series_store(store_dir)
+    except (FileNotFoundError, ValueError):
+        series = None
+    if series is not None and set(series["meta"]["sources"]) == set(sources):
+        if all(fingerprint_matches(path, series["meta"]["sources"][name])[0] for name, path in paths.items()):
+            if verbose:
+                print(f"[series] Dùng lại kho chuỗi tại {store_dir}")
+            return series
+
+    if verbose:
+        print(f"[series] Ghi kho chuỗi mới tại {store_dir}...")
+    source_fps = {name: file_fingerprint(path) for name, path in paths.items()}
+    df_product = None
+    if "product_master.csv" in paths:
+        df_product = load_table("product_master", data_dir)
+    return build_series_store(paths["transaction_data.csv"], df_product, store_dir,
+                              chunksize=chunksize, sources=source_fps, verbose=verbose)
+
+
+# ==============================
+# 3. CẮT LÁT (ZERO-COPY)
+# ==============================
+
+def _axis_index(labels, key):
+    # None -> cả trục; 1 nhãn -> vị trí (bỏ trục); list nhãn -> mảng vị trí
+    if key is None:
+        return slice(None)
+    if isinstance(key, (list, tuple, np.ndarray, pd.Index, pd.Series)):
+        pos = labels.get_indexer(key)
+        if (pos < 0).any():
+            raise KeyError(f"Không có trong kho chuỗi: {list(np.asarray(key)[pos < 0])}")
+        return pos
+    return labels.get_loc(key)
+
+
+def _date_slice(dates, start=None, end=None):
+    lo = 0 if start is None else dates.searchsorted(pd.Timestamp(start))
+    hi = len(dates) if end is None else dates.searchsorted(pd.Timestamp(end), side="right")
+    return slice(lo, hi)
+
+
+def series_view(series, field="Quantity", store=None, product=None, start=None, end=None):
+    """
+    Lát cắt của 1 đại lượng theo store / product / khoảng ngày [start, end].
+    Với store, product là 1 nhãn hoặc None, kết quả là view của memmap (không sao chép);
+    truyền list nhãn thì numpy phải gom dữ liệu (có sao chép).
+    """
+    s = _axis_index(series["stores"], store)
+    p = _axis_index(series["products"], product)
+    d = _date_slice(series["dates"], start, end)
+    arr = series[field]
+    if isinstance(s, np.ndarray) and isinstance(p, np.ndarray):
+        return arr[np.ix_(s, p)][:, :, d]
+    return arr[s, p, d]
+
+
+def iter_series(series, field="Quantity", start=None, end=None, min_rows=1):
+    """
+    Duyệt (store, product, view theo ngày) của các cặp có ít nhất `min_rows`
+    dòng giao dịch - dùng khi huấn luyện từng chuỗi.
+    """
+    d = _date_slice(series["dates"], start, end)
+    arr = series[field]
+    for s, p in zip(*np.nonzero(series["pair_rows"] >= min_rows)):
+        yield series["stores"][s], series["products"][p], arr[s, p, d]
+
+
+# ==============================
+# 4. BẢNG TỔNG HỢP CHO DỰ BÁO / PED
+# ==============================
+
+def _sum_to_days(series, field, stores, products, d):
+    # Cộng theo store, product cho từng ngày, đọc lần lượt từng store (bộ nhớ ~ 1 store)
+    s_idx = _axis_index(series["stores"], stores)
+    p_idx = _axis_index(series["products"], products)
+    s_iter = range(len(series["stores"]))[s_idx] if isinstance(s_idx, slice) else np.atleast_1d(s_idx)
+    total = np.zeros(len(series["dates"][d]), dtype=SERIES_DTYPE)
+    arr = series[field]
+    for s in s_iter:
+        block = arr[s, p_idx, d]
+        total += block.sum(axis=0) if block.ndim == 2 else block
+    return total
+
+
+def daily_table(series, stores=None, products=None, start=None, end=None):
+    """
+    Bảng theo ngày cùng schema với df_daily_agg (BƯỚC 1.2 của file dự báo):
+    Date (chuỗi '%Y-%m-%d'), Total_Quantity, Total_Paid_Agg, Total_List_Price_Agg.
+    Có thể lọc theo store / product (vd. các sản phẩm của 1 Category cho PED).
+    Ngày không có giao dịch mang giá trị 0 (bị loại ở bước lọc Total_List_Price_Agg > 0).
+    """
+    d = _date_slice(series["dates"], start, end)
+    df = pd.DataFrame({"Date": series["dates"][d].strftime("%Y-%m-%d")})
+    for field, col in DAILY_AGG_COLUMNS.items():
+        df[col] = _sum_to_days(series, field, stores, products, d)
+    df["Total_Quantity"] = df["Total_Quantity"].round().astype("int64")
+    return df
+
+
+def group_daily_table(series, product_groups, group_col="Category", start=None, end=None):
+    """
+    Bảng dài Date x nhóm sản phẩm (vd. `product_groups` = Series Product_ID -> Category),
+    dùng làm đầu vào PED theo nhóm sản phẩm.
+    """
+    frames = []
+    product_groups = product_groups[product_groups.index.isin(series["products"])]
+    for group, ids in product_groups.groupby(product_groups, observed=True).groups.items():
+        df = daily_table(series, products=list(ids), start=start, end=end)
+        df.insert(1, group_col, group)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Đọc transaction_data theo từng khối (chunk) và gộp dần thành các bảng tổng hợp.
+
+Mỗi chunk được rút gọn thành "partial aggregates" có thể gộp (merge) với nhau:
+- RFM theo khách hàng (lần mua cuối, số đơn, tổng chi)
+- Tổng theo Date x Cluster x Category (đầu vào PED - BƯỚC 7)
+- Tổng theo ngày (df_daily_agg cho dự báo, daily_kpis cho EDA)
+- Doanh thu theo cửa hàng
+Bộ nhớ chỉ phụ thuộc vào kích thước chunk và số khóa tổng hợp
+(khách hàng, ngày, cửa hàng), không phụ thuộc số năm lịch sử.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_access import TABLE_SCHEMAS
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+DEFAULT_CHUNKSIZE = 500_000
+
+# Cột cần đọc từ transaction_data (bỏ qua các cột khác để tiết kiệm bộ nhớ)
+TRANSACTION_COLUMNS = [
+    "Transaction_ID", "Customer_ID", "Store_ID", "Date_Time", "Product_ID",
+    "Quantity", "Unit_Price_Listed", "Total_Paid",
+]
+
+
+# ==============================
+# 1. ĐỌC THEO CHUNK
+# ==============================
+
+def iter_transaction_chunks(path, chunksize=DEFAULT_CHUNKSIZE, columns=TRANSACTION_COLUMNS):
+    """
+    Sinh từng chunk của transaction_data (CSV hoặc Parquet của data_access),
+    Date_Time đã được parse.
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        for batch in pf.iter_batches(batch_size=chunksize, columns=columns):
+            chunk = batch.to_pandas()
+            for c in TABLE_SCHEMAS["transaction_data"]["category_cols"]:
+                if c in chunk.columns and isinstance(chunk[c].dtype, pd.CategoricalDtype):
+                    chunk[c] = chunk[c].astype(chunk[c].cat.categories.dtype)
+            yield chunk
+        return
+
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        chunk["Date_Time"] = pd.to_datetime(chunk["Date_Time"], errors="coerce")
+        yield chunk
+
+
+# ==============================
+# 2. PARTIAL AGGREGATES CỦA 1 CHUNK
+# ==============================
+
+def product_lookup_table(df_product):
+    if df_product is None:
+        return None
+    return df_product.set_index("Product_ID")[["Category", "Unit_Price_List", "COGS"]]
+
+
+def chunk_partials(chunk, product_lookup=None, customer_cluster=None, seen_transactions=None):
+    """
+    Rút gọn 1 chunk thành các bảng tổng hợp nhỏ.
+
+    - product_lookup  : DataFrame index Product_ID với Category, Unit_Price_List, COGS
+    - customer_cluster: Series Customer_ID -> Cluster (nhãn K-Means, BƯỚC 6)
+    - seen_transactions: tập Transaction_ID của chunk trước. Một đơn (giỏ hàng) nằm
+      vắt qua ranh giới 2 chunk chỉ được đếm 1 lần cho Frequency.
+    """
+    chunk = chunk.dropna(subset=["Date_Time"])
+    day = chunk["Date_Time"].dt.normalize()
+    parts = {}
+
+    # --- RFM theo khách hàng ---
+    first_rows = ~chunk.duplicated(subset=["Transaction_ID"])
+    if seen_transactions:
+        first_rows &= ~chunk["Transaction_ID"].isin(seen_transactions)
+    parts["customer"] = pd.DataFrame({
+        "Last_Purchase": chunk.groupby("Customer_ID")["Date_Time"].max(),
+        "Frequency": first_rows.groupby(chunk["Customer_ID"]).sum(),
+        "Monetary": chunk.groupby("Customer_ID")["Total_Paid"].sum(),
+    })
+
+    # --- Tổng theo ngày ---
+    list_price = chunk["Unit_Price_Listed"]
+    margin = pd.Series(np.nan, index=chunk.index)
+    if product_lookup is not None:
+        master = chunk["Product_ID"].map(product_lookup["Unit_Price_List"])
+        list_price = master.fillna(chunk["Unit_Price_Listed"])
+        margin = (master - chunk["Product_ID"].map(product_lookup["COGS"])) * chunk["Quantity"]
+    daily = pd.DataFrame({
+        "Date": day,
+        "Total_Quantity": chunk["Quantity"],
+        "Total_Paid_Agg": chunk["Total_Paid"],
+        "Total_List_Price_Agg": chunk["Quantity"] * list_price,
+        "Daily_Profit": margin,
+    })
+    parts["daily"] = daily.groupby("Date").sum(min_count=1)
+
+    # --- Doanh thu theo cửa hàng ---
+    parts["store"] = chunk.groupby("Store_ID")["Total_Paid"].sum().to_frame("Total_Paid")
+
+    # --- Date x Cluster x Category (logic BƯỚC 7: Q > 0, giá niêm yết ghi nhận) ---
+    if product_lookup is not None and customer_cluster is not None:
+        seg = pd.DataFrame({
+            "Date": day,
+            "Cluster": chunk["Customer_ID"].map(customer_cluster),
+            "Category": chunk["Product_ID"].map(product_lookup["Category"]),
+            "Total_Quantity": chunk["Quantity"],
+            "Total_Paid_Agg": chunk["Total_Paid"],
+            "Total_List_Price_Agg": chunk["Quantity"] * chunk["Unit_Price_Listed"],
+        })
+        seg = seg[(chunk["Quantity"] > 0).to_numpy()].dropna(subset=["Cluster", "Category"])
+        parts["segment"] = seg.groupby(["Date", "Cluster", "Category"]).sum()
+
+    parts["max_date_time"] = chunk["Date_Time"].max()
+    return parts
+
+
+# ==============================
+# 3. GỘP PARTIAL AGGREGATES
+# ==============================
+
+def merge_partials(acc, part):
+    """Gộp 2 bộ partial aggregates (phép gộp có tính kết hợp, thứ tự không quan trọng)."""
+    if acc is None:
+        return part
+
+    merged = {}
+    cust = pd.concat([acc["customer"], part["customer"]])
+    merged["customer"] = cust.groupby(level=0).agg(
+        {"Last_Purchase": "max", "Frequency": "sum", "Monetary": "sum"}
+    )
+    merged["daily"] = pd.concat([acc["daily"], part["daily"]]).groupby(level=0).sum(min_count=1)
+    merged["store"] = pd.concat([acc["store"], part["store"]]).groupby(level=0).sum()
+    if "segment" in acc or "segment" in part:
+        segs = [p["segment"] for p in (acc, part) if "segment" in p]
+        merged["segment"] = pd.concat(segs).groupby(level=[0, 1, 2]).sum()
+    merged["max_date_time"] = max(
+        [d for d in (acc["max_date_time"], part["max_date_time"]) if pd.notna(d)],
+        default=pd.NaT
+    )
+    return merged
+
+
+# ==============================
+# 4. KẾT QUẢ CUỐI
+# ==============================
+
+def finalize_aggregates(acc, snapshot_date=None):
+    """
+    Chuyển partial aggregates thành các bảng cùng schema với pipeline cũ:
+    rfm_df, df_agg_cat, df_daily_agg, rev_by_store.
+    """
+    if snapshot_date is None:
+        snapshot_date = acc["max_date_time"] + pd.Timedelta(days=1)
+
+    cust = acc["customer"]
+    rfm_df = pd.DataFrame({
+        "Customer_ID": cust.index,
+        "Recency": (snapshot_date - cust["Last_Purchase"]).dt.days.to_numpy(),
+        "Frequency": cust["Frequency"].astype("int64").to_numpy(),
+        "Monetary": cust["Monetary"].to_numpy(),
+    })
+
+    daily = acc["daily"].reset_index()
+    daily["Date"] = daily["Date"].dt.strftime("%Y-%m-%d")
+    df_daily_agg = daily[["Date", "Total_Quantity", "Total_Paid_Agg", "Total_List_Price_Agg"]]
+    daily_kpis = daily.rename(columns={"Total_Paid_Agg": "Daily_Revenue"})[
+        ["Date", "Daily_Revenue", "Daily_Profit"]
+    ]
+
+    rev_by_store = (
+        acc["store"]["Total_Paid"]
+        .sort_values(ascending=False)
+        .reset_index()
+    )
+
+    result = {
+        "rfm_df": rfm_df,
+        "df_daily_agg": df_daily_agg,
+        "daily_kpis": daily_kpis,
+        "rev_by_store": rev_by_store,
+        "snapshot_date": snapshot_date,
+    }
+    if "segment" in acc:
+        seg = acc["segment"].reset_index()
+        seg["Date"] = seg["Date"].dt.strftime("%Y-%m-%d")
+        result["df_agg_cat"] = seg
+    return result
+
+
+def stream_partials(path, chunksize=DEFAULT_CHUNKSIZE, df_product=None,
+                    customer_cluster=None, verbose=False):
+    """
+    Đọc `path` (transaction_data.csv hoặc .parquet) theo chunk và gộp thành
+    partial aggregates. Trả về (acc, seen) với `seen` là tập Transaction_ID
+    của chunk cuối (dùng tiếp khi nối thêm dữ liệu mới).
+
+    Đơn hàng được giả định nằm liền nhau trong file (xuất từ POS theo thời gian),
+    để khử trùng Transaction_ID chỉ cần nhớ chunk trước.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    product_lookup = product_lookup_table(df_product)
+    acc = None
+    seen = None
+    for i, chunk in enumerate(iter_transaction_chunks(path, chunksize)):
+        part = chunk_partials(chunk, product_lookup, customer_cluster, seen_transactions=seen)
+        acc = merge_partials(acc, part)
+        seen = set(chunk["Transaction_ID"].unique())
+        if verbose:
+            print(f"  [stream] Chunk {i + 1}: {len(chunk):,} dòng, {len(acc['customer']):,} khách hàng")
+
+    if acc is None:
+        raise ValueError(f"{path} không có dòng giao dịch nào.")
+    return acc, seen
+
+
+def stream_aggregates(path, chunksize=DEFAULT_CHUNKSIZE, df_product=None,
+                      customer_cluster=None, verbose=False):
+    """Như stream_partials nhưng trả về luôn kết quả của finalize_aggregates."""
+    acc, _ = stream_partials(path, chunksize, df_product, customer_cluster, verbose)
+    return finalize_aggregates(acc)
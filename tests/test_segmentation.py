@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""build_rfm phải khớp với groupby (nunique / sum) kể cả khi thiếu Transaction_ID."""
+
+import numpy as np
+import pandas as pd
+
+from segmentation import build_rfm
+
+
+def _reference_rfm(df_trans, snapshot_date):
+    return df_trans.groupby("Customer_ID").agg(
+        Recency=("Date_Time", lambda x: (snapshot_date - x.max()).days),
+        Frequency=("Transaction_ID", "nunique"),
+        Monetary=("Total_Paid", "sum"),
+    )
+
+
+def test_missing_transaction_id_at_customer_boundary():
+    # Đơn thiếu của khách 2 nằm ngay sau đơn cuối ('B') của khách 1 khi sắp theo mã khách
+    df_trans = pd.DataFrame({
+        "Customer_ID": [2, 1, 1],
+        "Transaction_ID": [None, "A", "B"],
+        "Date_Time": pd.to_datetime(["2024-01-03", "2024-01-01", "2024-01-02"]),
+        "Total_Paid": [10.0, 20.0, 30.0],
+    })
+    snapshot_date = pd.Timestamp("2024-01-04")
+
+    rfm = build_rfm(df_trans, snapshot_date=snapshot_date, windows=(30,)).set_index("Customer_ID")
+    ref = _reference_rfm(df_trans, snapshot_date)
+
+    assert rfm.loc[1, "Frequency"] == 2
+    assert rfm.loc[2, "Frequency"] == 0
+    np.testing.assert_array_equal(rfm.loc[ref.index, "Frequency"], ref["Frequency"])
+    np.testing.assert_array_equal(rfm.loc[ref.index, "Frequency_30d"], ref["Frequency"])
+    np.testing.assert_allclose(rfm.loc[ref.index, "Monetary"], ref["Monetary"])
+
+
+def test_random_missing_ids_match_groupby():
+    rng = np.random.default_rng(0)
+    n = 500
+    txn = rng.integers(0, 60, n).astype(str).astype(object)
+    txn[rng.random(n) < 0.2] = None
+    df_trans = pd.DataFrame({
+        "Customer_ID": rng.integers(0, 40, n),
+        "Transaction_ID": txn,
+        "Date_Time": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 90, n), unit="D"),
+        "Total_Paid": np.where(rng.random(n) < 0.1, np.nan, rng.random(n) * 100),
+    })
+    snapshot_date = pd.Timestamp("2024-04-01")
+
+    rfm = build_rfm(df_trans, snapshot_date=snapshot_date).set_index("Customer_ID")
+    ref = _reference_rfm(df_trans, snapshot_date)
+
+    np.testing.assert_array_equal(rfm.loc[ref.index, "Frequency"], ref["Frequency"])
+    np.testing.assert_array_equal(rfm.loc[ref.index, "Recency"], ref["Recency"])
+    np.testing.assert_allclose(rfm.loc[ref.index, "Monetary"], ref["Monetary"])
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Tinh chỉnh tham số RF / XGBoost cho phần TINH CHỈNH SÂU (thay RandomizedSearchCV).
+
+- Chia lõi CPU: `outer` process chạy song song các cặp (ứng viên, fold), mỗi
+  process dùng `inner` luồng cho mô hình (outer x inner <= số lõi), thay cho
+  n_jobs=-1 ở cả vòng tìm kiếm lẫn trong XGBoost.
+- Successive halving theo fold của TimeSeriesSplit: vòng 0 chấm mọi ứng viên
+  trên fold đầu (tập train nhỏ nhất), mỗi vòng sau chỉ giữ 1 / halving_factor
+  ứng viên tốt nhất và chấm thêm fold kế tiếp. Ứng viên còn lại ở vòng cuối
+  được xếp hạng theo MAPE trung bình trên mọi fold như RandomizedSearchCV.
+- XGBoost dừng sớm trên từng fold (eval_set = fold kiểm tra); số cây của
+  tham số tốt nhất = trung bình best_iteration + 1 qua các fold.
+- Ma trận các fold được tạo 1 lần và gửi sang mỗi process 1 lần (initializer),
+  điểm (ứng viên, fold) đã chấm được giữ lại giữa các vòng.
+
+Huấn luyện lại (warm start, GIAI ĐOẠN B): mô hình đã tinh chỉnh ở GIAI ĐOẠN A
+được học tiếp trên toàn bộ dữ liệu thay vì fit lại từ đầu - XGBoost boost thêm
+cây từ booster cũ, RF thêm cây (warm_start), LSTM học tiếp từ trọng số cũ.
+"""
+
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import mean_absolute_percentage_error
+from sklearn.model_selection import ParameterSampler
+from threadpoolctl import threadpool_limits
+
+# ==============================
+# 0. CONFIG
+# ==============================
+
+TUNING_N_ITER = 30              # Số ứng viên lấy mẫu (như n_iter của RandomizedSearchCV)
+HALVING_FACTOR = 3              # Mỗi vòng giữ 1/3 ứng viên; None -> chấm mọi ứng viên trên mọi fold
+EARLY_STOPPING_ROUNDS = 30      # XGBoost: dừng khi RMSE fold kiểm tra không giảm sau 30 cây
+
+WARM_START_MIN_TREES = 20       # Số cây thêm tối thiểu khi huấn luyện lại RF / XGBoost
+WARM_START_EPOCHS = 10          # Số epoch học tiếp của LSTM (thay vì 30 epoch từ đầu)
+
+
+# ==============================
+# 1. CHIA LÕI CPU / MA TRẬN FOLD
+# ==============================
+
+def core_split(n_tasks, n_jobs=-1):
+    """(outer, inner): số process chạy song song và số luồng cho mỗi mô hình."""
+    n_cores = os.cpu_count() or 1
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = n_cores
+    n_jobs = min(n_jobs, n_cores)
+    outer = max(1, min(n_jobs, n_tasks))
+    inner = max(1, n_jobs // outer)
+    return outer, inner
+
+
+def fold_matrices(X, y, cv):
+    """Danh sách (X_tr, y_tr, X_val, y_val) dạng numpy float64, tạo 1 lần cho mọi ứng viên."""
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return [(X[tr], y[tr], X[val], y[val]) for tr, val in cv.split(X)]
+
+
+# ==============================
+# 2. CHẤM 1 CẶP (ỨNG VIÊN, FOLD)
+# ==============================
+
+_WORKER_STATE = {}
+
+
+def _init_worker(estimator, folds, inner, early_stopping_rounds):
+    # Mỗi process nhận ma trận fold đúng 1 lần
+    _WORKER_STATE.update(estimator=estimator, folds=folds, inner=inner,
+                         early_stopping_rounds=early_stopping_rounds)
+
+
+def _fit_model(estimator, params, X_tr, y_tr, X_val=None, y_val=None, inner=1, early_stopping_rounds=None):
+    model = clone(estimator).set_params(**params)
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=inner)
+    with threadpool_limits(limits=inner):
+        if early_stopping_rounds and X_val is not None:
+            model.set_params(early_stopping_rounds=early_stopping_rounds)
+            model.fit(X_tr, y_tr, eval_set=[(X_val, y_val)], verbose=False)
+        else:
+            model.fit(X_tr, y_tr)
+    return model
+
+
+def _score_task(task):
+    cand, fold, params = task
+    state = _WORKER_STATE
+    X_tr, y_tr, X_val, y_val = state["folds"][fold]
+    model = _fit_model(state["estimator"], params, X_tr, y_tr, X_val, y_val,
+                       state["inner"], state["early_stopping_rounds"])
+    with threadpool_limits(limits=state["inner"]):
+        mape = mean_absolute_percentage_error(y_val, model.predict(X_val)) * 100
+    n_trees = getattr(model, "best_iteration", None)
+    return cand, fold, mape, (None if n_trees is None else n_trees + 1)
+
+
+def _run_tasks(tasks, estimator, folds, early_stopping_rounds, n_jobs):
+    outer, inner = core_split(len(tasks), n_jobs)
+    initargs = (estimator, folds, inner, early_stopping_rounds)
+    if outer == 1:
+        _init_worker(*initargs)
+        return [_score_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=outer, initializer=_init_worker, initargs=initargs) as executor:
+        return list(executor.map(_score_task, tasks, chunksize=max(1, len(tasks) // (outer * 4))))
+
+
+# ==============================
+# 3. SUCCESSIVE HALVING
+# ==============================
+
+def tune_model(estimator, param_distributions, X, y, cv, n_iter=TUNING_N_ITER, halving_factor=HALVING_FACTOR,
+               early_stopping_rounds=None, random_state=42, n_jobs=-1, refit=True, verbose=False):
+    """
+    Tìm tham số tốt nhất của `estimator` (chưa fit) theo MAPE trên các fold của `cv`.
+
+    - n_iter, random_state: cùng bộ ứng viên với RandomizedSearchCV (ParameterSampler)
+    - halving_factor      : None -> chấm mọi ứng viên trên mọi fold (như RandomizedSearchCV)
+    - early_stopping_rounds: chỉ cho XGBoost (fit với eval_set)
+    - n_jobs              : tổng số lõi được dùng (-1 = tất cả)
+
+    Trả về dict: best_params, best_score (MAPE %), best_estimator (fit lại trên
+    toàn bộ X, y nếu refit), results (bảng điểm từng ứng viên), n_fits.
+    """
+    folds = fold_matrices(X, y, cv)
+    n_folds = len(folds)
+    candidates = list(ParameterSampler(param_distributions, n_iter, random_state=random_state))
+    scores = np.full((len(candidates), n_folds), np.nan)
+    trees = np.full((len(candidates), n_folds), np.nan)
+
+    alive = list(range(len(candidates)))
+    n_rungs = n_folds if halving_factor else 1
+    for rung in range(n_rungs):
+        # Vòng cuối (hoặc không halving) chấm mọi fold còn thiếu của ứng viên còn lại
+        last = rung == n_rungs - 1
+        fold_ids = range(rung, n_folds) if last else [rung]
+        tasks = [(c, f, candidates[c]) for c in alive for f in fold_ids]
+        for cand, fold, mape, n_trees in _run_tasks(tasks, estimator, folds, early_stopping_rounds, n_jobs):
+            scores[cand, fold] = mape
+            if n_trees is not None:
+                trees[cand, fold] = n_trees
+        if verbose:
+            print(f"  [tuning] Vòng {rung + 1}/{n_rungs}: {len(alive)} ứng viên x {len(fold_ids)} fold")
+        if not last:
+            mean_so_far = scores[alive, :rung + 1].mean(axis=1)
+            n_keep = max(1, int(np.ceil(len(alive) / halving_factor)))
+            alive = [alive[i] for i in np.argsort(mean_so_far, kind="stable")[:n_keep]]
+
+    results = pd.DataFrame({
+        "params": candidates,
+        "n_folds": np.isfinite(scores).sum(axis=1),
+        "mean_MAPE": scores.mean(axis=1),   # NaN nếu ứng viên bị loại trước vòng cuối
+    })
+    best = alive[int(np.argmin(scores[alive].mean(axis=1)))]
+    best_params = dict(candidates[best])
+    if early_stopping_rounds and np.isfinite(trees[best]).all():
+        best_params["n_estimators"] = int(round(trees[best].mean()))
+
+    tuned = {
+        "best_params": best_params,
+        "best_score": float(scores[best].mean()),
+        "best_estimator": None,
+        "results": results.sort_values("mean_MAPE", na_position="last"),
+        "n_fits": int(np.isfinite(scores).sum()),
+    }
+    if verbose:
+        print(f"[tuning] {tuned['n_fits']} lần fit (tìm kiếm đầy đủ: {len(candidates) * n_folds}), "
+              f"MAPE CV tốt nhất {tuned['best_score']:.2f}%")
+    if refit:
+        _, inner = core_split(1, n_jobs)
+        tuned["best_estimator"] = _fit_model(estimator, best_params, X, y, inner=inner)
+    return tuned
+
+
+# ==============================
+# 4. HUẤN LUYỆN LẠI (WARM START)
+# ==============================
+
+def extra_trees(n_estimators, n_prev_rows, n_rows, min_trees=WARM_START_MIN_TREES):
+    """Số cây thêm, tỉ lệ với phần dữ liệu mới so với dữ liệu đã học."""
+    n_new = max(0, n_rows - n_prev_rows)
+    return max(min_trees, int(np.ceil(n_estimators * n_new / max(n_prev_rows, 1))))
+
+
+def warm_start_model(model, X, y, n_prev_rows, n_jobs=-1):
+    """
+    Huấn luyện lại `model` (đã fit trên `n_prev_rows` dòng đầu) trên toàn bộ X, y,
+    giữ nguyên tham số đã tinh chỉnh. Mô hình gốc không bị thay đổi.
+
+    - XGBoost: boost thêm cây từ booster cũ (xgb_model)
+    - RF      : warm_start, thêm cây fit trên toàn bộ dữ liệu
+    - Khác    : clone + fit lại (vd. LinearRegression)
+    """
+    _, inner = core_split(1, n_jobs)
+    params = model.get_params()
+    if hasattr(model, "get_booster"):
+        n_more = extra_trees(model.get_booster().num_boosted_rounds(), n_prev_rows, len(X))
+        new_model = type(model)(**{**params, "n_estimators": n_more, "early_stopping_rounds": None, "n_jobs": inner})
+        new_model.fit(X, y, xgb_model=model.get_booster(), verbose=False)
+    elif "warm_start" in params:
+        new_model = copy.deepcopy(model)
+        new_model.set_params(warm_start=True, n_jobs=inner,
+                             n_estimators=model.n_estimators + extra_trees(model.n_estimators, n_prev_rows, len(X)))
+        new_model.fit(X, y)
+    else:
+        new_model = clone(model).set_params(**({"n_jobs": inner} if "n_jobs" in params else {}))
+        new_model.fit(X, y)
+    return new_model
+
+
+def warm_start_keras(model, X, y, epochs=WARM_START_EPOCHS, batch_size=32, callbacks=None):
+    """
+    Học tiếp 1 mô hình Keras (LSTM) từ trọng số hiện tại trên X, y (đã scale bằng
+    scaler của lần fit trước). Trả về bản sao, mô hình gốc giữ nguyên.
+    """
+    from tensorflow.keras.models import clone_model  # TensorFlow chỉ cần khi có LSTM
+
+    new_model = clone_model(model)
+    new_model.set_weights(model.get_weights())
+    optimizer = type(model.optimizer).from_config(model.optimizer.get_config())
+    new_model.compile(optimizer=optimizer, loss=model.loss)
+    new_model.fit(X, y, epochs=epochs, batch_size=batch_size, verbose=0, callbacks=callbacks or [])
+    return new_model